@@ -4,32 +4,47 @@
 import logging
 import asyncio
 import json
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, types
 from telethon.errors import SessionPasswordNeededError
 from colorama import Fore, Style
+from core.backfill import HistoryBackfiller
+from core.filters import IngestFilter
+from core.database import dedup_scope
 
 logger = logging.getLogger(__name__)
 
 class Tgbot:
-    def __init__(self, config):
+    def __init__(self, config, is_primary=True):
         """
         初始化Tgbot
         
         Args:
-            config: 配置对象
+            config: 配置对象，多账号时为该账号合并后的配置
+            is_primary: 是否为主账号（配置中的第一个账号）
         """
         self.config = config
         self.api_id = config.get('api_id')
         self.api_hash = config.get('api_hash')
         self.session_name = config.get('session_name', 'autotg_session')
         self.client = None
+        # 登录后获得的账号ID，写入每条消息
+        self.account_id = None
+        self.is_primary = is_primary
+        # 多个账号共享的最近消息集合，用于丢弃重复收到的消息
+        self.recent_messages = None
         self.db = None
+        self.writer = None
         self.message_formatter = None
+        self.console = None
         self.running = False
         self.socketio = None
-        # Load filter lists from config
-        self.filter_chat_ids = config.get('filter_chat_ids', [])
-        self.filter_sender_ids = config.get('filter_sender_ids', [])
+        self.broadcaster = None
+        self.media = None
+        # 断线补录
+        self.catch_up_enabled = config.get('catch_up', {}).get('enabled', True)
+        self._catch_up_task = None
+        # 入库过滤规则，启动时编译
+        self.ingest_filter = IngestFilter.from_config(config)
         
         # 设置日志级别
         log_level = config.get('log_level', 'INFO')
@@ -41,14 +56,55 @@ class Tgbot:
         """设置数据库实例"""
         self.db = db
     
+    def set_writer(self, writer):
+        """设置消息写入队列"""
+        self.writer = writer
+    
+    async def _store_message(self, message_data):
+        """保存消息：优先放入写入队列，否则在后台线程中写入数据库，不阻塞事件循环"""
+        if self.writer:
+            await self.writer.put_async(message_data)
+        elif self.db:
+            await self.db.save_message_async(message_data)
+    
+    def set_media(self, media):
+        """设置媒体下载器，设置后新消息中的媒体会在后台下载"""
+        self.media = media
+    
+    def set_recent_messages(self, recent_messages):
+        """设置多个账号共享的最近消息集合"""
+        self.recent_messages = recent_messages
+    
+    def _tag(self, message_data, message):
+        """为消息记录接收账号和去重范围"""
+        message_data['account_id'] = self.account_id
+        message_data['dedup_scope'] = dedup_scope(self.account_id, self.is_primary, message.is_channel)
+    
     def set_message_formatter(self, formatter):
         """设置消息格式化器"""
         self.message_formatter = formatter
     
+    def set_console(self, console):
+        """设置控制台输出，设置后消息的格式化和打印在后台线程中进行"""
+        self.console = console
+    
+    def _echo(self, message_data, header=None):
+        """把消息输出到控制台"""
+        if self.console:
+            self.console.submit(message_data, header)
+            return
+        if header:
+            print(header)
+        print(self.message_formatter.format_message_for_console(message_data))
+    
     def set_socketio(self, socketio): # Add this method
         """设置SocketIO实例"""
         self.socketio = socketio
     
+    def set_broadcaster(self, broadcaster):
+        """设置实时消息推送器，设置后新消息按会话房间批量推送"""
+        self.broadcaster = broadcaster
+    
     async def _login_async(self):
         """异步登录方法"""
         try:
@@ -80,7 +136,7 @@ class Tgbot:
             
             # 检查是否已经授权
             if not await self.client.is_user_authorized():
-                logger.info("需要进行登录授权...")
+                logger.info(f"账号 {self.session_name} 需要进行登录授权...")
                 
                 # 发送验证码
                 phone = input("请输入您的手机号码 (带国家代码，例如: +86xxxxxxxxxxx): ")
@@ -97,6 +153,7 @@ class Tgbot:
             
             # 获取并显示当前账户信息
             me = await self.client.get_me()
+            self.account_id = me.id
             logger.info(f"登录成功! 用户ID: {me.id}, 用户名: {me.username}")
             return True
             
@@ -130,29 +187,35 @@ class Tgbot:
             try:
                 message = event.message
                 
-                # --- NEW: Filtering Logic ---
-                if message.chat_id in self.filter_chat_ids:
-                    logger.info(f"消息来自被过滤的群组 {message.chat_id}，已忽略。")
-                    return
-                if message.sender_id in self.filter_sender_ids:
-                    logger.info(f"消息来自被过滤的用户 {message.sender_id}，已忽略。")
+                # 在提取消息数据之前按过滤规则丢弃消息
+                if not self.ingest_filter.accepts(message):
                     return
-                # --- END NEW ---
+                
+                # 其他账号已经收到过的消息直接丢弃
+                if self.recent_messages:
+                    scope = dedup_scope(self.account_id, self.is_primary, message.is_channel)
+                    if not self.recent_messages.add((scope, message.chat_id, message.id)):
+                        return
                 
                 # 提取消息数据
                 if self.message_formatter:
                     message_data = self.message_formatter.extract_message_data(message)
+                    self._tag(message_data, message)
                     
                     # 格式化并打印消息
-                    formatted_message = self.message_formatter.format_message_for_console(message_data)
-                    print(formatted_message)
+                    self._echo(message_data)
                     
                     # 保存到数据库
-                    if self.db:
-                        self.db.save_message(message_data)
+                    await self._store_message(message_data)
+                    
+                    # 媒体在后台下载，不阻塞消息处理
+                    if self.media:
+                        self.media.submit(message, message_data)
                     
                     # 通过WebSocket发送到前端
-                    if self.socketio:
+                    if self.broadcaster:
+                        self.broadcaster.publish(message_data)
+                    elif self.socketio:
                         self.socketio.emit('new_message', message_data)
                 
             except Exception as e:
@@ -163,24 +226,42 @@ class Tgbot:
             """处理消息编辑"""
             try:
                 message = event.message
+                if not self.ingest_filter.accepts(message):
+                    return
                 
                 # 提取消息数据
                 if self.message_formatter:
                     message_data = self.message_formatter.extract_message_data(message)
                     message_data['is_edited'] = True
+                    self._tag(message_data, message)
                     
                     # 格式化并打印消息
-                    print(f"\n{Fore.RED}【消息已编辑】{Style.RESET_ALL}")
-                    formatted_message = self.message_formatter.format_message_for_console(message_data)
-                    print(formatted_message)
+                    self._echo(message_data, header=f"\n{Fore.RED}【消息已编辑】{Style.RESET_ALL}")
                     
                     # 保存到数据库
-                    if self.db:
-                        self.db.save_message(message_data)
+                    await self._store_message(message_data)
                 
             except Exception as e:
                 logger.error(f"处理编辑消息时出错: {e}")
         
+        @self.client.on(events.ChatAction)
+        async def on_chat_action(event):
+            """会话标题、成员等变化时使缓存的会话信息失效"""
+            if self.message_formatter and event.chat_id is not None:
+                self.message_formatter.entity_cache.invalidate(event.chat_id)
+        
+        @self.client.on(events.UserUpdate)
+        async def on_user_update(event):
+            """用户状态变化时使缓存的用户信息失效"""
+            if self.message_formatter and event.user_id is not None:
+                self.message_formatter.entity_cache.invalidate(event.user_id)
+        
+        @self.client.on(events.Raw(types=types.UpdateUserName))
+        async def on_user_name(update):
+            """用户修改用户名或姓名时使缓存的用户信息失效（UserUpdate不包含此类更新）"""
+            if self.message_formatter:
+                self.message_formatter.entity_cache.invalidate(update.user_id)
+        
         logger.info("消息处理器已设置")
     
     async def _start_listening(self):
@@ -192,11 +273,23 @@ class Tgbot:
             # 设置标志
             self.running = True
             
+            if self.media:
+                self.media.start()
+            
             logger.info("开始监听消息...")
             
-            # 保持运行
+            # 启动时补回停机期间缺失的消息
+            self._schedule_catch_up()
+            
+            # 保持运行，并在断线重连后补回缺失的消息
+            was_connected = self.client.is_connected()
             while self.running:
                 await asyncio.sleep(1)
+                connected = self.client.is_connected()
+                if connected and not was_connected:
+                    logger.info("与Telegram的连接已恢复，开始检查消息缺口...")
+                    self._schedule_catch_up()
+                was_connected = connected
                 
         except KeyboardInterrupt:
             logger.info("接收到键盘中断，停止监听...")
@@ -205,41 +298,107 @@ class Tgbot:
             logger.error(f"监听消息时出错: {e}")
             self.running = False
     
+    def _create_backfiller(self):
+        """创建使用当前账号的补录器"""
+        return HistoryBackfiller(
+            self.client, self.db, self.message_formatter, self.config, self.ingest_filter,
+            account_id=self.account_id, is_primary=self.is_primary
+        )
+    
+    def _schedule_catch_up(self):
+        """在后台启动一次缺口补录，已有补录在进行时跳过"""
+        if not self.catch_up_enabled or not self.db:
+            return
+        if self._catch_up_task and not self._catch_up_task.done():
+            return
+        backfiller = self._create_backfiller()
+        self._catch_up_task = asyncio.ensure_future(self._run_catch_up(backfiller))
+    
+    async def _run_catch_up(self, backfiller):
+        """执行缺口补录，失败时只记录日志"""
+        try:
+            await backfiller.catch_up()
+        except Exception as e:
+            logger.error(f"补回缺失消息时出错: {e}")
+    
+    def _prepare(self):
+        """检查登录状态和依赖，返回是否可以开始监听"""
+        # 检查是否已登录
+        if not self.client:
+            logger.error("尚未登录，请先调用login方法")
+            return False
+        
+        # 检查数据库
+        if not self.db:
+            logger.warning("未设置数据库，消息将不会被保存")
+        
+        # 检查消息格式化器
+        if not self.message_formatter:
+            from core.formatter import MessageFormatter
+            self.message_formatter = MessageFormatter
+            logger.info("使用默认消息格式化器")
+        return True
+    
     def start(self):
         """
         开始监听消息
         
+        Returns:
+            bool: 是否成功启动
+        """
+        return Tgbot.start_all([self])
+    
+    @staticmethod
+    def start_all(bots):
+        """
+        在同一个事件循环中同时监听多个账号的消息
+        
+        Args:
+            bots: 已登录的Tgbot实例列表
+            
         Returns:
             bool: 是否成功启动
         """
         try:
-            # 检查是否已登录
-            if not self.client:
-                logger.error("尚未登录，请先调用login方法")
+            bots = [bot for bot in bots if bot._prepare()]
+            if not bots:
                 return False
             
-            # 检查数据库
-            if not self.db:
-                logger.warning("未设置数据库，消息将不会被保存")
-            
-            # 检查消息格式化器
-            if not self.message_formatter:
-                from core.formatter import MessageFormatter
-                self.message_formatter = MessageFormatter
-                logger.info("使用默认消息格式化器")
-            
             # 启动监听
             loop = asyncio.get_event_loop()
-            logger.info("启动消息监听...")
-            loop.run_until_complete(self._start_listening())
+            logger.info(f"启动消息监听，共 {len(bots)} 个账号...")
+            loop.run_until_complete(asyncio.gather(*(bot._start_listening() for bot in bots)))
             
             return True
         except Exception as e:
             logger.error(f"启动监听失败: {e}")
             return False
     
+    def backfill(self, chat_ids=None):
+        """
+        补录历史消息，中断后再次运行会从每个会话的断点继续
+        
+        Args:
+            chat_ids: 要补录的会话ID列表，为空时使用配置
+            
+        Returns:
+            dict: 补录统计，未登录时返回None
+        """
+        if not self.client:
+            logger.error("尚未登录，请先调用login方法")
+            return None
+        if not self.message_formatter:
+            from core.formatter import MessageFormatter
+            self.message_formatter = MessageFormatter
+        backfiller = self._create_backfiller()
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(backfiller.run(chat_ids))
+    
     def stop(self):
         """停止监听消息"""
         self.running = False
         logger.info("停止监听消息...")
+        # 写入队列中尚未提交的消息
+        if self.writer:
+            self.writer.stop()
         return True 
\ No newline at end of file
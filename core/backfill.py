@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import logging
+from functools import partial
+from telethon.errors import FloodWaitError
+from core.database import dedup_scope
+
+logger = logging.getLogger(__name__)
+
+class HistoryBackfiller:
+    """历史消息补录器：按会话并发拉取历史消息或断线期间缺失的消息，按批写入并记录断点"""
+
+    def __init__(self, client, db, formatter, config, ingest_filter=None, account_id=None, is_primary=True):
+        """
+        初始化补录器
+
+        Args:
+            client: 已登录的TelegramClient
+            db: 数据库实例
+            formatter: 消息格式化器，用于提取消息数据
+            config: 配置对象
+            ingest_filter: 入库过滤器，可选，被过滤的消息不写入数据库
+            account_id: 补录所用账号的ID，写入每条消息
+            is_primary: 是否为主账号，决定私聊和普通群组消息的去重范围
+        """
+        backfill_config = config.get('backfill', {})
+        self.client = client
+        self.db = db
+        self.formatter = formatter
+        self.ingest_filter = ingest_filter
+        self.account_id = account_id
+        self.is_primary = is_primary
+        self.chat_ids = backfill_config.get('chat_ids') or []
+        self.concurrency = backfill_config.get('concurrency', 4)
+        self.batch_size = backfill_config.get('batch_size', 500)
+        # 每次请求之间的等待时间（秒），遇到限流时自动加大
+        self.wait_time = backfill_config.get('wait_time', 0)
+        self.max_wait_time = backfill_config.get('max_wait_time', 10)
+        self.max_retries = backfill_config.get('max_retries', 5)
+        self._stats = {
+            'chats_total': 0,
+            'chats_done': 0,
+            'chats_failed': 0,
+            'fetched': 0,
+            'saved': 0,
+            'catchup_chats': 0,
+            'catchup_gap_ids': 0,
+            'recovered': 0,
+            'flood_waits': 0,
+            'flood_wait_seconds': 0,
+        }
+
+    def _scope(self, dialog):
+        """获取会话的去重范围"""
+        return dedup_scope(self.account_id, self.is_primary, dialog.is_channel)
+    
+    async def _select_dialogs(self, chat_ids):
+        """选出需要补录的会话，未指定时补录全部会话"""
+        wanted = set(chat_ids or self.chat_ids)
+        dialogs = []
+        async for dialog in self.client.iter_dialogs():
+            # 配置中既可以写带-100前缀的ID，也可以写实体的原始ID
+            if not wanted or dialog.id in wanted or dialog.entity.id in wanted:
+                dialogs.append(dialog)
+        return dialogs
+
+    async def run(self, chat_ids=None):
+        """
+        执行补录
+
+        Args:
+            chat_ids: 要补录的会话ID列表，为空时使用配置中的backfill.chat_ids，仍为空则补录全部会话
+
+        Returns:
+            dict: 补录统计
+        """
+        started = time.monotonic()
+        dialogs = await self._select_dialogs(chat_ids)
+        self._stats['chats_total'] = len(dialogs)
+        logger.info(f"开始补录历史消息，共 {len(dialogs)} 个会话，并发数: {self.concurrency}")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(dialog):
+            async with semaphore:
+                await self._backfill_chat(dialog)
+
+        await asyncio.gather(*(worker(d) for d in dialogs))
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"历史消息补录完成: {self._stats['chats_done']}/{len(dialogs)} 个会话，"
+            f"拉取 {self._stats['fetched']} 条，新写入 {self._stats['saved']} 条，耗时 {elapsed:.0f} 秒"
+        )
+        return self.stats()
+
+    async def catch_up(self):
+        """
+        补回断线或停机期间缺失的消息
+
+        对每个已有高水位的会话，比较其最新消息ID与已入库的最大消息ID，
+        只拉取两者之间的消息，已入库的消息会被跳过。
+
+        Returns:
+            dict: 补录统计
+        """
+        loop = asyncio.get_running_loop()
+        marks = await loop.run_in_executor(None, self.db.get_high_water_marks)
+        if not marks:
+            return self.stats()
+
+        gaps = []
+        async for dialog in self.client.iter_dialogs():
+            key = (self._scope(dialog), dialog.entity.id)
+            if key not in marks or not dialog.message:
+                continue
+            top_message_id = dialog.message.id
+            gap = max(top_message_id - marks[key], 0)
+            if gap:
+                gaps.append((dialog, marks[key], top_message_id, gap))
+            else:
+                await loop.run_in_executor(
+                    None, partial(self.db.update_sync_state, key[1], 'ok', top_message_id=top_message_id, gap=0,
+                                  dedup_scope=key[0])
+                )
+
+        self._stats['catchup_chats'] = len(gaps)
+        self._stats['catchup_gap_ids'] = sum(item[-1] for item in gaps)
+        if not gaps:
+            logger.info("未发现缺失的消息")
+            return self.stats()
+        logger.info(f"发现 {len(gaps)} 个会话存在缺口，开始补回缺失的消息...")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(dialog, high_water_id, top_message_id, gap):
+            async with semaphore:
+                await self._catch_up_chat(dialog, high_water_id, top_message_id, gap)
+
+        await asyncio.gather(*(worker(*item) for item in gaps))
+        logger.info(f"缺口补回完成，共补回 {self._stats['recovered']} 条消息")
+        return self.stats()
+
+    async def _catch_up_chat(self, dialog, high_water_id, top_message_id, gap):
+        """补回单个会话在高水位与最新消息之间的消息"""
+        chat_id = dialog.entity.id
+        scope = self._scope(dialog)
+        loop = asyncio.get_running_loop()
+        # 补录期间实时消息会继续推进数据库中的高水位，断点需以检查时的高水位为起点单独记录
+        progress = {'last_message_id': high_water_id}
+
+        def get_checkpoint(_chat_id):
+            return progress['last_message_id']
+
+        def save_batch(_chat_id, batch, last_message_id):
+            saved = self.db.save_catchup_batch(_chat_id, batch)
+            if saved is not None:
+                progress['last_message_id'] = last_message_id
+            return saved
+
+        await loop.run_in_executor(
+            None, partial(self.db.update_sync_state, chat_id, 'running', top_message_id=top_message_id, gap=gap,
+                          dedup_scope=scope)
+        )
+        saved_before = self._stats['recovered']
+        ok = await self._sync_chat(
+            dialog, get_checkpoint, save_batch, 'recovered', max_id=top_message_id + 1
+        )
+        recovered = self._stats['recovered'] - saved_before
+        await loop.run_in_executor(
+            None, partial(self.db.update_sync_state, chat_id, 'ok' if ok else 'failed', recovered=recovered,
+                          dedup_scope=scope)
+        )
+        logger.info(f"会话 {dialog.name}: 缺口 {gap}，补回 {recovered} 条消息")
+
+    async def _backfill_chat(self, dialog):
+        """补录单个会话"""
+        scope = self._scope(dialog)
+        ok = await self._sync_chat(
+            dialog,
+            partial(self.db.get_backfill_checkpoint, dedup_scope=scope),
+            partial(self.db.save_backfill_batch, dedup_scope=scope),
+            'saved'
+        )
+        self._stats['chats_done' if ok else 'chats_failed'] += 1
+
+    async def _sync_chat(self, dialog, get_checkpoint, save_batch, counter, max_id=0):
+        """
+        从断点之后拉取一个会话的消息，遇到限流时等待后从断点继续
+
+        Args:
+            dialog: 会话
+            get_checkpoint: 读取断点的函数，参数为chat_id
+            save_batch: 保存一批消息的函数，参数为chat_id、消息列表和本批最大消息ID
+            counter: 累计写入条数的统计项
+            max_id: 只拉取小于该ID的消息，0表示不限制
+
+        Returns:
+            bool: 是否成功完成
+        """
+        chat_id = dialog.entity.id
+        loop = asyncio.get_running_loop()
+        retries = 0
+        while True:
+            checkpoint = await loop.run_in_executor(None, get_checkpoint, chat_id)
+            try:
+                await self._fetch_after(dialog, checkpoint, save_batch, counter, max_id)
+                return True
+            except FloodWaitError as e:
+                retries += 1
+                self._on_flood_wait(e.seconds)
+                if retries > self.max_retries:
+                    return False
+                logger.warning(f"会话 {dialog.name} 触发限流，等待 {e.seconds} 秒后从消息 {checkpoint} 之后继续")
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                logger.error(f"拉取会话 {dialog.name} ({chat_id}) 的消息失败: {e}")
+                return False
+
+    def _on_flood_wait(self, seconds):
+        """记录限流并放慢后续请求"""
+        self._stats['flood_waits'] += 1
+        self._stats['flood_wait_seconds'] += seconds
+        self.wait_time = min(max(self.wait_time * 2, 1), self.max_wait_time)
+
+    async def _fetch_after(self, dialog, checkpoint, save_batch, counter, max_id=0):
+        """从断点之后按时间正序拉取消息并分批写入"""
+        chat_id = dialog.entity.id
+        scope = self._scope(dialog)
+        loop = asyncio.get_running_loop()
+        batch = []
+
+        async def flush():
+            saved = await loop.run_in_executor(None, save_batch, chat_id, batch, batch[-1]['message_id'])
+            if saved is None:
+                raise RuntimeError("写入数据库失败")
+            self._stats[counter] += saved
+            logger.info(f"会话 {dialog.name}: 已拉取至消息 {batch[-1]['message_id']}，本批新写入 {saved} 条")
+
+        async for message in self.client.iter_messages(
+            dialog.entity, min_id=checkpoint, max_id=max_id, reverse=True, wait_time=self.wait_time
+        ):
+            self._stats['fetched'] += 1
+            if self.ingest_filter and not self.ingest_filter.accepts(message):
+                continue
+            message_data = self.formatter.extract_message_data(message)
+            if message_data.get('chat_id') is None:
+                message_data.update({'chat_id': chat_id, 'chat_title': dialog.name})
+            message_data['account_id'] = self.account_id
+            message_data['dedup_scope'] = scope
+            batch.append(message_data)
+            if len(batch) >= self.batch_size:
+                await flush()
+                batch = []
+        if batch:
+            await flush()
+
+    def stats(self):
+        """
+        获取补录统计
+
+        Returns:
+            dict: 会话数、拉取和写入条数、限流次数等
+        """
+        stats = dict(self._stats)
+        stats['wait_time'] = self.wait_time
+        return stats
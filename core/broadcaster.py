@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# 紧凑模式下推送的字段，会话标题和类型由前端的会话列表提供
+COMPACT_FIELDS = (
+    'message_id', 'chat_id', 'sender_id', 'sender_username', 'sender_first_name',
+    'sender_last_name', 'text', 'date', 'media_type', 'is_forwarded', 'forward_from',
+    'reply_to_msg_id', 'is_edited', 'dedup_scope'
+)
+
+def room_for_chat(chat_id, dedup_scope=0):
+    """
+    获取会话对应的Socket.IO房间名
+
+    Args:
+        chat_id: 聊天ID
+        dedup_scope: 去重范围，不同账号与同一用户的私聊属于不同的房间
+
+    Returns:
+        str: 房间名
+    """
+    return f'chat:{dedup_scope or 0}:{chat_id}'
+
+class SocketBroadcaster:
+    """实时消息推送器：按会话房间合并消息，按固定间隔批量推送"""
+
+    def __init__(self, socketio, interval=0.1, compact=False, max_buffer=5000):
+        """
+        初始化推送器
+
+        Args:
+            socketio: SocketIO实例
+            interval: 推送间隔（秒）
+            compact: 是否只推送前端需要的非空字段
+            max_buffer: 缓冲区最多保留的消息数，超出时丢弃最早的消息
+        """
+        self.socketio = socketio
+        self.interval = interval
+        self.compact = compact
+        self.running = False
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = Lock()
+        self._stats = {
+            'published': 0,
+            'dropped': 0,
+            'frames': 0,
+            'emitted_messages': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config, socketio):
+        """
+        根据配置创建推送器
+
+        Args:
+            config: 配置对象
+            socketio: SocketIO实例
+
+        Returns:
+            SocketBroadcaster实例
+        """
+        realtime_config = config.get('realtime', {})
+        return cls(
+            socketio,
+            interval=realtime_config.get('interval_ms', 100) / 1000.0,
+            compact=realtime_config.get('compact', False),
+            max_buffer=realtime_config.get('max_buffer', 5000)
+        )
+
+    def start(self):
+        """在后台任务中启动推送循环"""
+        if self.running:
+            return
+        self.running = True
+        self.socketio.start_background_task(self._run)
+        logger.info(f"实时推送已启动 (间隔: {int(self.interval * 1000)}ms)")
+
+    def stop(self):
+        """停止推送循环"""
+        self.running = False
+
+    def publish(self, message_data):
+        """
+        提交一条待推送的消息，只做内存操作，不会阻塞调用方
+
+        Args:
+            message_data: 消息数据字典
+        """
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._stats['dropped'] += 1
+            self._buffer.append(message_data)
+            self._stats['published'] += 1
+
+    def _run(self):
+        """推送循环"""
+        while self.running:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"推送实时消息失败: {e}")
+
+    def _payload(self, message_data):
+        """生成单条消息的推送内容"""
+        if not self.compact:
+            return message_data
+        return {k: message_data[k] for k in COMPACT_FIELDS if message_data.get(k) not in (None, '')}
+
+    def flush(self):
+        """把缓冲区中的消息按会话分组，每个会话房间推送一帧"""
+        with self._lock:
+            if not self._buffer:
+                return
+            pending = list(self._buffer)
+            self._buffer.clear()
+
+        by_chat = {}
+        for message_data in pending:
+            key = (message_data.get('dedup_scope') or 0, message_data.get('chat_id'))
+            by_chat.setdefault(key, []).append(message_data)
+
+        activity = []
+        for (scope, chat_id), messages in by_chat.items():
+            self.socketio.emit(
+                'new_messages',
+                {'chat_id': chat_id, 'dedup_scope': scope, 'messages': [self._payload(m) for m in messages]},
+                to=room_for_chat(chat_id, scope)
+            )
+            activity.append({
+                'chat_id': chat_id,
+                'dedup_scope': scope,
+                'chat_title': messages[-1].get('chat_title'),
+                'count': len(messages)
+            })
+        # 会话活动摘要推送给所有客户端，用于侧边栏的新消息提示
+        self.socketio.emit('session_activity', activity)
+
+        with self._lock:
+            self._stats['frames'] += len(by_chat)
+            self._stats['emitted_messages'] += len(pending)
+
+    def stats(self):
+        """
+        获取推送指标
+
+        Returns:
+            dict: 提交、丢弃和推送的消息数以及推送帧数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+        return stats
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import zlib
+import time
+import struct
+import logging
+import threading
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 压缩数据的头部：编码方式（1字节）+ 字典ID（2字节）
+HEADER = struct.Struct('>BH')
+CODEC_IDS = {'zlib': 1, 'zstd': 2}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+# zlib的预设字典只有最后32KB有效
+ZLIB_MAX_DICT_SIZE = 32768
+
+# 构造zlib字典时统计的片段：连续的拉丁字母数字（如链接、用户名）和2到4个汉字
+SEGMENT_PATTERN = re.compile(r'[A-Za-z0-9_@#:/.\-]{3,}|[\u4e00-\u9fff]{2,4}')
+
+def available_codecs():
+    """
+    获取可用的压缩方式
+
+    Returns:
+        list: 'zlib'始终可用，安装了zstandard时还包括'zstd'
+    """
+    return ['zlib', 'zstd'] if zstandard else ['zlib']
+
+def train_dictionary(codec, samples, size):
+    """
+    根据样本文本训练压缩字典
+
+    Args:
+        codec: 压缩方式，'zlib'或'zstd'
+        samples: 样本文本列表
+        size: 字典大小（字节）
+
+    Returns:
+        bytes: 字典数据
+    """
+    encoded = [s.encode('utf-8') for s in samples if s]
+    if codec == 'zstd':
+        return zstandard.train_dictionary(size, encoded).as_bytes()
+
+    # zlib字典是一段原始数据，出现次数多、越长的片段越有用，放在越靠后的位置
+    counter = Counter()
+    for text in samples:
+        if not text:
+            continue
+        counter.update(SEGMENT_PATTERN.findall(text))
+        if len(text) <= 64:
+            # 短消息常整条重复出现（如机器人模板、表情回复）
+            counter[text] += 1
+    size = min(size, ZLIB_MAX_DICT_SIZE)
+    chosen = []
+    total = 0
+    for segment, count in sorted(counter.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2:
+            break
+        data = segment.encode('utf-8')
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+    return b''.join(reversed(chosen))
+
+class TextCodec:
+    """消息文本的压缩和解压，支持多个字典，压缩数据的头部记录所用的编码方式和字典"""
+
+    def __init__(self, loader=None):
+        """
+        初始化编解码器
+
+        Args:
+            loader: 可选，loader(字典ID)返回 (压缩方式, 字典数据) 或None；遇到未登记的字典时调用，
+                    用于加载其他进程（如单独运行的维护任务）之后训练的字典
+        """
+        self.dictionaries = {}
+        self.loader = loader
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._decompressions = 0
+        self._decompress_seconds = 0.0
+
+    def add_dictionary(self, dict_id, codec, data):
+        """
+        登记一个字典
+
+        Args:
+            dict_id: 字典ID
+            codec: 压缩方式
+            data: 字典数据
+        """
+        self.dictionaries[dict_id] = (codec, data)
+
+    def _dictionary(self, dict_id):
+        """获取一个字典，未登记时通过loader加载"""
+        entry = self.dictionaries.get(dict_id)
+        if entry is None:
+            with self._load_lock:
+                entry = self.dictionaries.get(dict_id)
+                if entry is None and self.loader is not None:
+                    loaded = self.loader(dict_id)
+                    if loaded is not None:
+                        self.add_dictionary(dict_id, *loaded)
+                        entry = self.dictionaries[dict_id]
+                        logger.info(f"已加载新的压缩字典 (ID: {dict_id}, {entry[0]})")
+            if entry is None:
+                raise KeyError(f"未知的压缩字典: {dict_id}")
+        return entry
+
+    def _zstd(self, kind, dict_id, level=3):
+        """获取当前线程的zstd压缩器或解压器，zstandard的实例不能跨线程共用"""
+        cache = self._local.__dict__.setdefault('zstd', {})
+        key = (kind, dict_id, level if kind == 'c' else None)
+        if key not in cache:
+            zstd_dict = zstandard.ZstdCompressionDict(self._dictionary(dict_id)[1])
+            if kind == 'c':
+                cache[key] = zstandard.ZstdCompressor(level=level, dict_data=zstd_dict)
+            else:
+                cache[key] = zstandard.ZstdDecompressor(dict_data=zstd_dict)
+        return cache[key]
+
+    def compress(self, text, dict_id, level=6):
+        """
+        压缩一条文本
+
+        Args:
+            text: 文本
+            dict_id: 使用的字典ID
+            level: 压缩级别
+
+        Returns:
+            bytes: 带头部的压缩数据
+        """
+        codec, zdict = self._dictionary(dict_id)
+        raw = text.encode('utf-8')
+        if codec == 'zstd':
+            payload = self._zstd('c', dict_id, level).compress(raw)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict) \
+                if zdict else zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+            payload = compressor.compress(raw) + compressor.flush()
+        return HEADER.pack(CODEC_IDS[codec], dict_id) + payload
+
+    def decompress(self, blob):
+        """
+        解压一条文本，注册为SQLite函数text_decompress
+
+        Args:
+            blob: 带头部的压缩数据，None原样返回
+
+        Returns:
+            str: 原始文本
+        """
+        if blob is None:
+            return None
+        started = time.perf_counter()
+        codec_id, dict_id = HEADER.unpack_from(blob)
+        payload = blob[HEADER.size:]
+        if CODEC_NAMES.get(codec_id) == 'zstd':
+            raw = self._zstd('d', dict_id).decompress(payload)
+        else:
+            zdict = self._dictionary(dict_id)[1]
+            decompressor = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+            raw = decompressor.decompress(payload) + decompressor.flush()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._decompressions += 1
+            self._decompress_seconds += elapsed
+        return raw.decode('utf-8')
+
+    def stats(self):
+        """
+        获取解压指标
+
+        Returns:
+            dict: 解压次数和平均每条的解压耗时（微秒）
+        """
+        with self._lock:
+            count = self._decompressions
+            seconds = self._decompress_seconds
+        return {
+            'decompressions': count,
+            'decompress_us_avg': round(seconds / count * 1e6, 1) if count else 0.0,
+        }
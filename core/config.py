@@ -86,4 +86,20 @@ class Config:
         if key in self.config:
             del self.config[key]
             return self.save_config()
-        return True 
\ No newline at end of file
+        return True
+
+    def accounts(self):
+        """
+        获取要登录的账号列表
+        
+        配置了accounts时，每个账号的设置覆盖顶层的同名设置（如api_id、api_hash、
+        session_name、proxy、filters），未配置时顶层配置即为唯一的账号。
+        列表中的第一个账号为主账号。
+        
+        Returns:
+            list: 每个账号合并后的配置字典
+        """
+        accounts = self.config.get('accounts') or []
+        if not accounts:
+            return [self.config]
+        return [{**self.config, **account} for account in accounts]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import queue
+import logging
+from threading import Thread, Lock
+
+logger = logging.getLogger(__name__)
+
+# 控制台输出模式：off不输出，sampled每隔若干条输出一条，full全部输出
+CONSOLE_MODES = ('off', 'sampled', 'full')
+
+class ConsoleWriter:
+    """异步控制台输出：消息的格式化和打印在后台线程中进行，队列已满时丢弃输出，不阻塞消息接收"""
+
+    def __init__(self, formatter, mode='full', sample_every=100, max_queue_size=1000):
+        """
+        初始化控制台输出
+
+        Args:
+            formatter: 消息格式化器
+            mode: 输出模式，'off'、'sampled'或'full'
+            sample_every: sampled模式下每隔多少条消息输出一条
+            max_queue_size: 等待输出的消息上限，超出时丢弃
+        """
+        if mode not in CONSOLE_MODES:
+            raise ValueError(f"未知的控制台输出模式: {mode}")
+        self.formatter = formatter
+        self.mode = mode
+        self.sample_every = max(int(sample_every), 1)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self._seen = 0
+        self._lock = Lock()
+        self._stats = {'printed': 0, 'skipped': 0, 'dropped': 0}
+
+    @classmethod
+    def from_config(cls, config, formatter, headless=False):
+        """
+        根据配置创建控制台输出
+
+        Args:
+            config: 配置对象
+            formatter: 消息格式化器
+            headless: 是否以无界面模式运行，为True时不输出消息
+
+        Returns:
+            ConsoleWriter实例
+        """
+        mode = 'off' if headless else config.get('console_output', 'full')
+        return cls(formatter, mode=mode, sample_every=config.get('console_sample_every', 100))
+
+    def start(self):
+        """在后台线程中启动输出循环"""
+        if self.mode == 'off' or self.thread:
+            logger.info(f"控制台消息输出模式: {self.mode}")
+            return
+        self.thread = Thread(target=self._run, name='ConsoleWriter', daemon=True)
+        self.thread.start()
+        logger.info(f"控制台消息输出模式: {self.mode}")
+
+    def submit(self, message_data, header=None):
+        """
+        提交一条待输出的消息，不会阻塞调用方
+
+        Args:
+            message_data: 消息数据字典
+            header: 输出在消息前的额外一行，可选
+        """
+        if self.mode == 'off':
+            return
+        with self._lock:
+            self._seen += 1
+            if self.mode == 'sampled' and (self._seen - 1) % self.sample_every:
+                self._stats['skipped'] += 1
+                return
+        try:
+            self.queue.put_nowait((message_data, header))
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+
+    def _run(self):
+        """输出循环"""
+        while True:
+            message_data, header = self.queue.get()
+            try:
+                if header:
+                    print(header)
+                print(self.formatter.format_message_for_console(message_data))
+                with self._lock:
+                    self._stats['printed'] += 1
+            except Exception as e:
+                logger.error(f"输出消息到控制台失败: {e}")
+
+    def stats(self):
+        """
+        获取输出指标
+
+        Returns:
+            dict: 输出模式，已输出、被采样跳过和被丢弃的条数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['mode'] = self.mode
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
@@ -2,120 +2,2139 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import queue
+import base64
+import time
+import shutil
 import sqlite3
+import asyncio
 import logging
+from threading import Lock, RLock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from core.compression import TextCodec, train_dictionary, available_codecs
 
 logger = logging.getLogger(__name__)
 
+def to_epoch(value):
+    """
+    将时间转换为UTC纪元秒
+    
+    Args:
+        value: datetime对象、ISO格式字符串或数字，None原样返回
+        
+    Returns:
+        int: 纪元秒，无法解析时返回None
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        if isinstance(value, str):
+            if value.isdigit():
+                return int(value)
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def dedup_scope(account_id, is_primary, is_channel):
+    """
+    计算消息的去重范围
+    
+    频道和超级群组的消息ID在所有账号中相同，多个账号收到的同一条消息按范围0去重；
+    私聊和普通群组的消息ID由每个账号单独编号，非主账号的这类消息以账号ID为范围。
+    主账号始终使用范围0，与多账号之前写入的数据保持一致。
+    
+    Args:
+        account_id: 接收消息的账号ID
+        is_primary: 是否为主账号（配置中的第一个账号）
+        is_channel: 消息是否来自频道或超级群组
+        
+    Returns:
+        int: 去重范围
+    """
+    if is_channel or is_primary or account_id is None:
+        return 0
+    return account_id
+
 class Database:
     """数据库管理类"""
     
-    def __init__(self, db_file='data.db'):
+    # 聊天标题、类型和发送者姓名保存在chats/users表中，不再随每条消息重复存储
+    # 同一去重范围内同一会话的同一条消息只保存一行，重复到达的消息（包括其他账号收到的）被忽略
+    INSERT_MESSAGE_SQL = '''
+    INSERT INTO messages (
+        message_id, chat_id, sender_id, text, date, media_type,
+        is_forwarded, forward_from, reply_to_msg_id, created_at,
+        date_ts, created_ts, account_id, dedup_scope
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(dedup_scope, chat_id, message_id) DO NOTHING
+    '''
+    
+    # 编辑后的消息更新当前文本，旧版本由触发器写入message_edits；尚未入库的消息直接插入
+    UPSERT_EDIT_SQL = '''
+    INSERT INTO messages (
+        message_id, chat_id, sender_id, text, date, media_type,
+        is_forwarded, forward_from, reply_to_msg_id, created_at,
+        date_ts, created_ts, account_id, dedup_scope
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(dedup_scope, chat_id, message_id) DO UPDATE SET
+        text = excluded.text,
+        text_z = NULL,
+        media_type = excluded.media_type
+    WHERE COALESCE(messages.text, text_decompress(messages.text_z)) IS NOT excluded.text
+        OR messages.media_type IS NOT excluded.media_type
+    '''
+    
+    UPSERT_CHAT_SQL = '''
+    INSERT INTO chats (chat_id, title, chat_type, first_seen, last_seen, message_count)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        title = COALESCE(excluded.title, chats.title),
+        chat_type = COALESCE(excluded.chat_type, chats.chat_type),
+        first_seen = COALESCE(MIN(chats.first_seen, excluded.first_seen), chats.first_seen, excluded.first_seen),
+        last_seen = COALESCE(MAX(chats.last_seen, excluded.last_seen), chats.last_seen, excluded.last_seen),
+        message_count = chats.message_count + excluded.message_count
+    '''
+    
+    UPSERT_USER_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_name, first_seen, last_seen, message_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        first_seen = COALESCE(MIN(users.first_seen, excluded.first_seen), users.first_seen, excluded.first_seen),
+        last_seen = COALESCE(MAX(users.last_seen, excluded.last_seen), users.last_seen, excluded.last_seen),
+        message_count = users.message_count + excluded.message_count
+    '''
+    
+    # messages_view的定义，{messages}为消息表；查询已归档的分片时替换为附加分片中的消息表
+    # 较早的消息文本可能已压缩到text_z列，由text_decompress()透明解压
+    MESSAGES_VIEW_SQL = '''
+        SELECT
+            m.id, m.message_id, m.chat_id,
+            COALESCE(c.title, m.chat_title) AS chat_title,
+            COALESCE(c.chat_type, m.chat_type) AS chat_type,
+            m.sender_id,
+            COALESCE(u.username, m.sender_username) AS sender_username,
+            COALESCE(u.first_name, m.sender_first_name) AS sender_first_name,
+            COALESCE(u.last_name, m.sender_last_name) AS sender_last_name,
+            COALESCE(m.text, text_decompress(m.text_z)) AS text,
+            m.date, m.media_type, m.is_forwarded, m.forward_from,
+            m.reply_to_msg_id, m.created_at, m.date_ts, m.created_ts,
+            m.account_id, m.dedup_scope
+        FROM {messages} m
+        LEFT JOIN chats c ON c.chat_id = m.chat_id
+        LEFT JOIN users u ON u.user_id = m.sender_id
+    '''
+    
+    def __init__(self, db_file='data.db', read_pool_size=4):
+        """
+        初始化数据库管理器
+        
+        Args:
+            db_file: 数据库文件路径，默认为'data.db'
+            read_pool_size: 只读连接池的最大连接数，默认为4
+        """
+        self.db_file = db_file
+        # 唯一的写连接，所有写操作都需持有写锁
+        self.conn = None
+        self._write_lock = RLock()
+        # 只读连接池，每个读操作独占一个连接和游标
+        self.read_pool_size = read_pool_size
+        self._readers = queue.Queue()
+        self._reader_conns = []
+        self._reader_lock = Lock()
+        # 是否启用FTS5全文索引（取决于SQLite是否支持trigram分词器）
+        self.fts_enabled = False
+        # 较早消息文本的压缩和解压，字典在初始化时从数据库加载，其他进程之后训练的字典在首次用到时加载
+        self.codec = TextCodec(loader=self._load_dictionary)
+        # 单线程执行器，供事件循环中的异步写入使用，保证写入顺序
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.init_db()
+    
+    def init_db(self):
+        """初始化数据库连接和表结构"""
+        try:
+            db_exists = os.path.exists(self.db_file)
+            
+            # 创建写连接
+            self.conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+            # 设置行工厂为字典
+            self.conn.row_factory = sqlite3.Row
+            self._register_functions(self.conn)
+            # 新数据库使用增量auto_vacuum，删除数据后可由维护任务逐步回收空间；对已有数据库不生效
+            self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # WAL模式下读不阻塞写，写也不阻塞读
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            cursor = self.conn.cursor()
+            
+            # 创建表（如果不存在）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, chat_id INTEGER,
+                    chat_title TEXT, chat_type TEXT, sender_id INTEGER, sender_username TEXT,
+                    sender_first_name TEXT, sender_last_name TEXT, text TEXT, date TEXT,
+                    media_type TEXT, is_forwarded BOOLEAN, forward_from TEXT,
+                    reply_to_msg_id INTEGER, created_at TEXT,
+                    date_ts INTEGER, created_ts INTEGER,
+                    account_id INTEGER, dedup_scope INTEGER NOT NULL DEFAULT 0,
+                    text_z BLOB
+                )
+            ''')
+            self._migrate_timestamps(cursor)
+            self._migrate_accounts(cursor)
+            self._init_compression(cursor)
+            
+            # 创建索引
+            # 时间条件一律使用整数纪元秒列，可直接做索引范围扫描
+            # (chat_id, date_ts, id) 支撑按会话的游标分页和按会话的时间窗口查询
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_date_ts ON messages(chat_id, date_ts, id)
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_sender_date_ts ON messages(sender_id, date_ts)
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_date_ts ON messages(date_ts)
+            ''')
+            # 以上索引已覆盖旧索引的用途
+            for old_index in ('idx_messages_chat_id', 'idx_messages_chat_date_id',
+                              'idx_messages_sender_id', 'idx_messages_date'):
+                cursor.execute(f'DROP INDEX IF EXISTS {old_index}')
+            
+            self._init_entity_tables(cursor)
+            self._init_rollup_tables(cursor)
+            self._init_term_counts(cursor)
+            self._init_edit_history(cursor)
+            # 历史补录进度：每个去重范围内每个会话已入库的最大消息ID
+            self._create_scoped_table(cursor, 'backfill_state', '''
+                CREATE TABLE IF NOT EXISTS backfill_state (
+                    dedup_scope INTEGER NOT NULL DEFAULT 0, chat_id INTEGER NOT NULL,
+                    last_message_id INTEGER NOT NULL DEFAULT 0,
+                    saved_count INTEGER NOT NULL DEFAULT 0, updated_at TEXT,
+                    PRIMARY KEY (dedup_scope, chat_id)
+                )
+            ''')
+            self._init_sync_state(cursor)
+            self._init_media_tables(cursor)
+            self._init_report_outbox(cursor)
+            self._init_search_index(cursor)
+            self._init_shard_table(cursor)
+            
+            self.conn.commit()
+            
+            if not db_exists:
+                logger.info(f"数据库初始化成功: {self.db_file}")
+            else:
+                logger.info(f"连接到现有数据库: {self.db_file}")
+                
+        except Exception as e:
+            logger.error(f"初始化数据库失败: {e}")
+    
+    def _migrate_timestamps(self, cursor, batch_size=10000):
+        """
+        为旧数据库添加date_ts/created_ts整数列，并分批回填已有消息
+        """
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(messages)')}
+        if 'date_ts' in columns:
+            return
+        cursor.execute('ALTER TABLE messages ADD COLUMN date_ts INTEGER')
+        cursor.execute('ALTER TABLE messages ADD COLUMN created_ts INTEGER')
+        self.conn.commit()
+        
+        max_id = cursor.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+        if not max_id:
+            return
+        logger.info("正在为已有消息回填整数时间戳...")
+        for start in range(0, max_id + 1, batch_size):
+            cursor.execute('''
+                UPDATE messages
+                SET date_ts = CAST(strftime('%s', date) AS INTEGER),
+                    created_ts = CAST(strftime('%s', created_at) AS INTEGER)
+                WHERE id > ? AND id <= ?
+            ''', (start, start + batch_size))
+            self.conn.commit()
+        logger.info("整数时间戳回填完成")
+    
+    def _migrate_accounts(self, cursor):
+        """为旧数据库添加account_id/dedup_scope列，已有消息均属于主账号，去重范围为0"""
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(messages)')}
+        if 'dedup_scope' in columns:
+            return
+        cursor.execute('ALTER TABLE messages ADD COLUMN account_id INTEGER')
+        cursor.execute('ALTER TABLE messages ADD COLUMN dedup_scope INTEGER NOT NULL DEFAULT 0')
+        self.conn.commit()
+    
+    def _register_functions(self, conn):
+        """在连接上注册自定义SQL函数，视图和触发器依赖这些函数"""
+        conn.create_function('text_decompress', 1, self.codec.decompress, deterministic=True)
+    
+    def _init_compression(self, cursor):
+        """
+        为旧数据库添加text_z列，创建压缩字典表和压缩进度表，并加载字典
+        
+        压缩后的消息text为NULL，text_z保存带头部的压缩数据，头部记录编码方式和字典ID。
+        """
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(messages)')}
+        if 'text_z' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN text_z BLOB')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS text_dictionaries (
+                id INTEGER PRIMARY KEY, codec TEXT NOT NULL, data BLOB NOT NULL,
+                sample_count INTEGER, created_ts INTEGER
+            )
+        ''')
+        # 单行表：已压缩到的时间点和累计的压缩前后字节数
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compression_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1), compressed_before_ts INTEGER NOT NULL DEFAULT 0,
+                row_count INTEGER NOT NULL DEFAULT 0, raw_bytes INTEGER NOT NULL DEFAULT 0,
+                compressed_bytes INTEGER NOT NULL DEFAULT 0, updated_at TEXT
+            )
+        ''')
+        for row in cursor.execute('SELECT id, codec, data FROM text_dictionaries'):
+            self.codec.add_dictionary(row['id'], row['codec'], row['data'])
+    
+    def _load_dictionary(self, dict_id):
+        """
+        从text_dictionaries读取一个字典，在解压函数中调用，因此使用单独的只读连接
+        
+        Args:
+            dict_id: 字典ID
+            
+        Returns:
+            tuple: (压缩方式, 字典数据)，不存在时返回None
+        """
+        if self.db_file == ':memory:':
+            return None
+        conn = sqlite3.connect(f'file:{os.path.abspath(self.db_file)}?mode=ro', uri=True)
+        try:
+            row = conn.execute('SELECT codec, data FROM text_dictionaries WHERE id = ?', (dict_id,)).fetchone()
+        finally:
+            conn.close()
+        return (row[0], row[1]) if row else None
+    
+    def _create_scoped_table(self, cursor, table, create_sql):
+        """
+        创建以 (dedup_scope, chat_id) 为主键的状态表
+        
+        旧版本的表以chat_id为主键，升级时重建表结构，已有记录的去重范围记为0。
+        """
+        columns = {row['name'] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        if columns and 'dedup_scope' not in columns:
+            cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            cursor.execute(create_sql)
+            column_list = ', '.join(sorted(columns))
+            cursor.execute(f'INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {table}_old')
+            cursor.execute(f'DROP TABLE {table}_old')
+        else:
+            cursor.execute(create_sql)
+    
+    def _init_entity_tables(self, cursor):
+        """
+        创建聊天表、用户表及消息视图，并从旧数据迁移
+        
+        chats/users保存每个会话和用户的当前名称、类型、首次/最后出现时间和消息数，
+        在写入消息的同一事务中更新。messages_view将其与消息关联，
+        旧数据中每行自带的名称仅在找不到对应记录时使用。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY, title TEXT, chat_type TEXT,
+                first_seen TEXT, last_seen TEXT, message_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+                first_seen TEXT, last_seen TEXT, message_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # 记录每个会话用过的标题
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_title_history (
+                chat_id INTEGER NOT NULL, title TEXT NOT NULL, first_seen TEXT,
+                PRIMARY KEY (chat_id, title)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chats_title_insert AFTER INSERT ON chats
+            WHEN new.title IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO chat_title_history (chat_id, title, first_seen)
+                VALUES (new.chat_id, new.title, new.last_seen);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chats_title_update AFTER UPDATE OF title ON chats
+            WHEN new.title IS NOT NULL AND new.title IS NOT old.title BEGIN
+                INSERT OR IGNORE INTO chat_title_history (chat_id, title, first_seen)
+                VALUES (new.chat_id, new.title, new.last_seen);
+            END
+        ''')
+        cursor.execute('DROP VIEW IF EXISTS messages_view')
+        cursor.execute('CREATE VIEW messages_view AS ' + self.MESSAGES_VIEW_SQL.format(messages='messages'))
+        
+        # 迁移：根据已有消息生成chats和users
+        if cursor.execute('SELECT 1 FROM chats LIMIT 1').fetchone():
+            return
+        if not cursor.execute('SELECT 1 FROM messages WHERE chat_id IS NOT NULL LIMIT 1').fetchone():
+            return
+        logger.info("正在从已有消息生成会话表和用户表...")
+        # 只有一个MAX()聚合时，其余列取自最大值所在的行，即最新一条消息
+        cursor.execute('''
+            INSERT INTO chats (chat_id, title, chat_type, first_seen, last_seen, message_count)
+            SELECT l.chat_id, l.chat_title, l.chat_type, a.first_seen, l.last_seen, a.message_count
+            FROM (
+                SELECT chat_id, chat_title, chat_type, MAX(date) AS last_seen
+                FROM messages WHERE chat_id IS NOT NULL GROUP BY chat_id
+            ) l
+            JOIN (
+                SELECT chat_id, MIN(date) AS first_seen, COUNT(*) AS message_count
+                FROM messages WHERE chat_id IS NOT NULL GROUP BY chat_id
+            ) a ON a.chat_id = l.chat_id
+        ''')
+        cursor.execute('''
+            INSERT OR IGNORE INTO chat_title_history (chat_id, title, first_seen)
+            SELECT chat_id, chat_title, MIN(date) FROM messages
+            WHERE chat_id IS NOT NULL AND chat_title IS NOT NULL
+            GROUP BY chat_id, chat_title
+        ''')
+        cursor.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name, first_seen, last_seen, message_count)
+            SELECT l.sender_id, l.sender_username, l.sender_first_name, l.sender_last_name,
+                   a.first_seen, l.last_seen, a.message_count
+            FROM (
+                SELECT sender_id, sender_username, sender_first_name, sender_last_name, MAX(date) AS last_seen
+                FROM messages WHERE sender_id IS NOT NULL GROUP BY sender_id
+            ) l
+            JOIN (
+                SELECT sender_id, MIN(date) AS first_seen, COUNT(*) AS message_count
+                FROM messages WHERE sender_id IS NOT NULL GROUP BY sender_id
+            ) a ON a.sender_id = l.sender_id
+        ''')
+        logger.info("会话表和用户表生成完成")
+    
+    # 按小时汇总的统计表：(表名, 维度列, 维度取值表达式, 触发条件)
+    ROLLUP_TABLES = (
+        ('stats_hourly_chat', 'chat_id', 'chat_id', 'chat_id IS NOT NULL'),
+        ('stats_hourly_sender', 'sender_id', 'sender_id', 'sender_id IS NOT NULL'),
+        # 纯文本消息的media_type记为空字符串
+        ('stats_hourly_media', 'media_type', "COALESCE(media_type, '')", '1'),
+    )
+    
+    def _init_rollup_tables(self, cursor):
+        """
+        创建按小时汇总的统计表及维护触发器
+        
+        插入消息时由触发器在同一事务中累加计数，统计接口只需读取这些小表；编辑改变媒体类型时，
+        计数随之移到新类型。删除原始消息不会减少计数，汇总数据可以比原始消息保留更久。
+        """
+        created = False
+        for table, column, expression, condition in self.ROLLUP_TABLES:
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            created = created or not exists
+            column_type = 'TEXT' if column == 'media_type' else 'INTEGER'
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    hour_ts INTEGER NOT NULL, {column} {column_type} NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (hour_ts, {column})
+                ) WITHOUT ROWID
+            ''')
+            new_expression = expression.replace(column, f'new.{column}')
+            new_condition = condition.replace(column, f'new.{column}')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON messages
+                WHEN new.date_ts IS NOT NULL BEGIN
+                    INSERT INTO {table} (hour_ts, {column}, count)
+                    SELECT new.date_ts - new.date_ts % 3600, {new_expression}, 1
+                    WHERE {new_condition}
+                    ON CONFLICT (hour_ts, {column}) DO UPDATE SET count = count + 1;
+                END
+            ''')
+        # 编辑消息时媒体可能被添加或替换，把计数从旧类型移到新类型
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS stats_hourly_media_update AFTER UPDATE OF media_type ON messages
+            WHEN new.date_ts IS NOT NULL AND COALESCE(old.media_type, '') != COALESCE(new.media_type, '') BEGIN
+                UPDATE stats_hourly_media SET count = count - 1
+                WHERE hour_ts = old.date_ts - old.date_ts % 3600 AND media_type = COALESCE(old.media_type, '')
+                    AND count > 0;
+                INSERT INTO stats_hourly_media (hour_ts, media_type, count)
+                VALUES (new.date_ts - new.date_ts % 3600, COALESCE(new.media_type, ''), 1)
+                ON CONFLICT (hour_ts, media_type) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        if created:
+            self._rebuild_rollups(cursor)
+    
+    def _rebuild_rollups(self, cursor):
+        """根据messages表重新计算全部统计表，需在写锁中调用"""
+        for table, column, expression, condition in self.ROLLUP_TABLES:
+            cursor.execute(f'DELETE FROM {table}')
+        self._accumulate_rollups(cursor, 'main.messages')
+    
+    def _accumulate_rollups(self, cursor, source):
+        """把一个消息表中的消息累加到统计表，需在写锁中调用"""
+        for table, column, expression, condition in self.ROLLUP_TABLES:
+            cursor.execute(f'''
+                INSERT INTO {table} (hour_ts, {column}, count)
+                SELECT date_ts - date_ts % 3600 AS hour_ts, {expression} AS dim, COUNT(*)
+                FROM {source}
+                WHERE date_ts IS NOT NULL AND {condition}
+                GROUP BY hour_ts, dim
+                HAVING 1
+                ON CONFLICT (hour_ts, {column}) DO UPDATE SET count = count + excluded.count
+            ''')
+    
+    def _init_term_counts(self, cursor):
+        """
+        创建每日词频表和分词进度表
+        
+        词频由后台任务按消息ID增量分词后累加，day为报告时区下的纪元天数。
+        每日报告只需合并词频表中的高频词，耗时与词汇量相关，与消息量无关。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS term_counts (
+                day INTEGER NOT NULL, chat_id INTEGER NOT NULL, term TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, chat_id, term)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS term_index_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1), last_message_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            )
+        ''')
+    
+    def rebuild_rollups(self):
+        """
+        根据历史消息重建按小时汇总的统计表
+        
+        已归档到分片的消息同样计入，分片逐个附加到写连接上。
+        
+        Returns:
+            bool: 是否重建成功
+        """
+        try:
+            logger.info("开始重建统计汇总表...")
+            with self._write_lock, self.conn:
+                cursor = self.conn.cursor()
+                self._rebuild_rollups(cursor)
+                months = [row['month'] for row in cursor.execute('SELECT month FROM message_shards WHERE row_count > 0')]
+            for month in months:
+                with self._write_lock:
+                    self.conn.execute('ATTACH DATABASE ? AS shard_rollup', (self._shard_path(month),))
+                    try:
+                        with self.conn:
+                            self._accumulate_rollups(self.conn.cursor(), 'shard_rollup.messages')
+                    finally:
+                        self.conn.execute('DETACH DATABASE shard_rollup')
+            logger.info("统计汇总表重建完成")
+            return True
+        except Exception as e:
+            logger.error(f"重建统计汇总表失败: {e}")
+            return False
+    
+    def _init_edit_history(self, cursor):
+        """
+        创建消息编辑历史表，并为 (dedup_scope, chat_id, message_id) 建立唯一索引
+        
+        旧版本每次编辑都会插入一整行重复消息。首次升级时先合并重复行：
+        保留最早的一行并更新为最后一次编辑的内容，之前的版本移入message_edits，
+        然后重算统计表和会话、用户的消息数。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_edits (
+                id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL,
+                text TEXT, media_type TEXT, replaced_ts INTEGER,
+                dedup_scope INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(message_edits)')}
+        if 'dedup_scope' not in columns:
+            cursor.execute('ALTER TABLE message_edits ADD COLUMN dedup_scope INTEGER NOT NULL DEFAULT 0')
+            cursor.execute('DROP INDEX IF EXISTS idx_message_edits_chat_message')
+            cursor.execute('DROP TRIGGER IF EXISTS messages_edit_history')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_edits_scope_chat_message
+            ON message_edits(dedup_scope, chat_id, message_id, id)
+        ''')
+        
+        indexes = {
+            row['name'] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+        if 'idx_messages_scope_chat_message' not in indexes:
+            if 'idx_messages_chat_message_unique' not in indexes:
+                self._dedup_messages(cursor)
+            # 按 (dedup_scope, chat_id, message_id) 判断消息是否已入库，供去重和编辑更新使用
+            cursor.execute('''
+                CREATE UNIQUE INDEX idx_messages_scope_chat_message ON messages(dedup_scope, chat_id, message_id)
+            ''')
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_chat_message_unique')
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_chat_message')
+        # 合并重复行之后再创建触发器，避免迁移本身被记为编辑
+        # 压缩文本（写入text_z）不是编辑；编辑已压缩的消息时旧版本解压后记录
+        cursor.execute('DROP TRIGGER IF EXISTS messages_edit_history')
+        cursor.execute('''
+            CREATE TRIGGER messages_edit_history AFTER UPDATE OF text, media_type ON messages
+            WHEN new.text_z IS NULL AND (
+                COALESCE(old.text, text_decompress(old.text_z)) IS NOT new.text
+                OR old.media_type IS NOT new.media_type
+            ) BEGIN
+                INSERT INTO message_edits (chat_id, message_id, text, media_type, replaced_ts, dedup_scope)
+                VALUES (old.chat_id, old.message_id, COALESCE(old.text, text_decompress(old.text_z)),
+                        old.media_type, CAST(strftime('%s', 'now') AS INTEGER), old.dedup_scope);
+            END
+        ''')
+    
+    def _dedup_messages(self, cursor):
+        """合并同一会话中重复保存的消息，需在事务中调用"""
+        cursor.execute('DROP TABLE IF EXISTS temp.message_dups')
+        cursor.execute('''
+            CREATE TEMP TABLE message_dups AS
+            SELECT chat_id, message_id, MIN(id) AS keep_id, MAX(id) AS last_id
+            FROM messages
+            WHERE chat_id IS NOT NULL AND message_id IS NOT NULL
+            GROUP BY chat_id, message_id HAVING COUNT(*) > 1
+        ''')
+        groups = cursor.execute('SELECT COUNT(*) FROM temp.message_dups').fetchone()[0]
+        if not groups:
+            cursor.execute('DROP TABLE temp.message_dups')
+            return
+        logger.info(f"发现 {groups} 条消息存在重复行，正在合并...")
+        # 除最后一行外的各个版本写入编辑历史，被替换的时间取下一个版本的入库时间
+        cursor.execute('''
+            INSERT INTO message_edits (chat_id, message_id, text, media_type, replaced_ts)
+            SELECT chat_id, message_id, text, media_type, replaced_ts FROM (
+                SELECT m.id, m.chat_id, m.message_id, m.text, m.media_type, d.last_id,
+                       LEAD(m.created_ts) OVER (PARTITION BY m.chat_id, m.message_id ORDER BY m.id) AS replaced_ts
+                FROM messages m
+                JOIN temp.message_dups d ON d.chat_id = m.chat_id AND d.message_id = m.message_id
+            )
+            WHERE id <> last_id
+            ORDER BY id
+        ''')
+        # 保留最早的一行，内容更新为最后一个版本
+        cursor.execute('''
+            UPDATE messages SET
+                text = (SELECT l.text FROM temp.message_dups d JOIN messages l ON l.id = d.last_id
+                        WHERE d.keep_id = messages.id),
+                media_type = (SELECT l.media_type FROM temp.message_dups d JOIN messages l ON l.id = d.last_id
+                              WHERE d.keep_id = messages.id)
+            WHERE id IN (SELECT keep_id FROM temp.message_dups)
+        ''')
+        deleted = cursor.execute('''
+            DELETE FROM messages WHERE id IN (
+                SELECT m.id FROM messages m
+                JOIN temp.message_dups d ON d.chat_id = m.chat_id AND d.message_id = m.message_id
+                WHERE m.id <> d.keep_id
+            )
+        ''').rowcount
+        cursor.execute('DROP TABLE temp.message_dups')
+        
+        # 重复行已计入统计，需要重新计算
+        self._rebuild_rollups(cursor)
+        cursor.execute('''
+            UPDATE chats SET message_count = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.chat_id)
+        ''')
+        cursor.execute('''
+            UPDATE users SET message_count = (SELECT COUNT(*) FROM messages m WHERE m.sender_id = users.user_id)
+        ''')
+        logger.info(f"重复消息合并完成，删除 {deleted} 行")
+    
+    def _init_sync_state(self, cursor):
+        """
+        创建会话同步状态表
+        
+        high_water_id为每个去重范围内每个会话已入库的最大消息ID，随每次写入在同一事务中推进；
+        其余列记录最近一次缺口检查的结果。
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_sync_state'"
+        ).fetchone()
+        self._create_scoped_table(cursor, 'chat_sync_state', '''
+            CREATE TABLE IF NOT EXISTS chat_sync_state (
+                dedup_scope INTEGER NOT NULL DEFAULT 0, chat_id INTEGER NOT NULL,
+                high_water_id INTEGER NOT NULL DEFAULT 0,
+                top_message_id INTEGER, last_gap INTEGER NOT NULL DEFAULT 0,
+                last_recovered INTEGER NOT NULL DEFAULT 0, status TEXT, last_checked_at TEXT,
+                PRIMARY KEY (dedup_scope, chat_id)
+            )
+        ''')
+        if not exists:
+            cursor.execute('''
+                INSERT INTO chat_sync_state (dedup_scope, chat_id, high_water_id)
+                SELECT dedup_scope, chat_id, MAX(message_id) FROM messages
+                WHERE chat_id IS NOT NULL AND message_id IS NOT NULL
+                GROUP BY dedup_scope, chat_id
+            ''')
+    
+    def _init_media_tables(self, cursor):
+        """
+        创建媒体文件表和消息媒体关联表
+        
+        media_files按文件内容的sha256保存每个文件一次，media把消息关联到文件。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_files (
+                sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL,
+                mime_type TEXT, telegram_file_id INTEGER, created_ts INTEGER
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_media_files_telegram_id ON media_files(telegram_file_id)
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media (
+                dedup_scope INTEGER NOT NULL DEFAULT 0, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL,
+                media_type TEXT, sha256 TEXT NOT NULL,
+                PRIMARY KEY (dedup_scope, chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_media_sha256 ON media(sha256)
+        ''')
+    
+    def _init_report_outbox(self, cursor):
+        """
+        创建报告邮件发件箱
+        
+        邮件生成后先写入发件箱再发送，发送前标记为sending，发送成功后删除；发送失败的邮件
+        按退避时间重试，超过重试次数后标记为failed保留备查。sending状态的邮件不会被重试，
+        进程在发送途中退出时不会重复发送。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS report_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT NOT NULL, subject TEXT, payload BLOB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_ts INTEGER NOT NULL, last_error TEXT, created_ts INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_report_outbox_due ON report_outbox(status, next_attempt_ts)
+        ''')
+    
+    def _init_search_index(self, cursor):
+        """
+        创建全文索引表及同步触发器
+        
+        使用FTS5的trigram分词器，按三字粒度索引，中文无需分词即可检索。
+        索引为外部内容表，由触发器与messages保持同步。
+        """
+        try:
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            ).fetchone()
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    text, content='messages', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                END
+            ''')
+            # 索引中保存的是原始文本，删除条目时需要传入解压后的文本；压缩文本不改变内容，无需更新索引
+            cursor.execute('DROP TRIGGER IF EXISTS messages_fts_delete')
+            cursor.execute('''
+                CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, text)
+                    VALUES ('delete', old.id, COALESCE(old.text, text_decompress(old.text_z)));
+                END
+            ''')
+            cursor.execute('DROP TRIGGER IF EXISTS messages_fts_update')
+            cursor.execute('''
+                CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages
+                WHEN new.text_z IS NULL BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, text)
+                    VALUES ('delete', old.id, COALESCE(old.text, text_decompress(old.text_z)));
+                    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                END
+            ''')
+            self.fts_enabled = True
+            if not exists and cursor.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+                logger.warning("已创建全文索引，现有消息尚未建立索引，请运行 python main.py --rebuild-search-index")
+        except sqlite3.OperationalError as e:
+            self.fts_enabled = False
+            logger.warning(f"当前SQLite不支持FTS5 trigram分词器，搜索将使用LIKE扫描: {e}")
+    
+    def rebuild_search_index(self):
+        """
+        根据messages表重建全文索引，用于为已有数据库建立索引
+        
+        Returns:
+            bool: 是否重建成功
+        """
+        if not self.fts_enabled:
+            logger.error("全文索引不可用，无法重建")
+            return False
+        try:
+            logger.info("开始重建全文索引...")
+            with self._write_lock, self.conn:
+                self._reindex_fts('main')
+                self.conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+            logger.info("全文索引重建完成")
+            return True
+        except Exception as e:
+            logger.error(f"重建全文索引失败: {e}")
+            return False
+    
+    def _init_shard_table(self, cursor):
+        """
+        创建消息分片登记表
+        
+        较早月份的消息可以归档到按月划分的分片文件（如data.2024-05.db），
+        每个分片在这里登记其时间范围和是否已冻结，查询时据此只附加需要的分片。
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_shards (
+                month TEXT PRIMARY KEY, file TEXT NOT NULL,
+                row_count INTEGER NOT NULL DEFAULT 0, min_ts INTEGER, max_ts INTEGER,
+                frozen INTEGER NOT NULL DEFAULT 0, updated_at TEXT
+            )
+        ''')
+        # 主库的唯一索引只覆盖主库中的消息，已归档消息的 (dedup_scope, chat_id, message_id)
+        # 登记在这里，写入时据此跳过重复消息，并把编辑转到消息所在的分片
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archived_keys'"
+        ).fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_keys (
+                dedup_scope INTEGER NOT NULL, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                PRIMARY KEY (dedup_scope, chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_keys_month ON archived_keys(month)')
+        if not exists:
+            # 为之前归档的分片补登记消息键
+            for row in cursor.execute('SELECT month FROM message_shards ORDER BY month').fetchall():
+                self._register_shard_keys(cursor, row['month'])
+    
+    def _register_shard_keys(self, cursor, month):
+        """读取一个分片中全部消息的键并登记到archived_keys"""
+        path = self._shard_path(month)
+        if not os.path.exists(path):
+            return
+        shard_conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            rows = shard_conn.execute('''
+                SELECT dedup_scope, chat_id, message_id FROM messages
+                WHERE chat_id IS NOT NULL AND message_id IS NOT NULL
+            ''')
+            while True:
+                chunk = rows.fetchmany(10000)
+                if not chunk:
+                    break
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO archived_keys (dedup_scope, chat_id, message_id, month) VALUES (?, ?, ?, ?)',
+                    [(scope or 0, chat_id, message_id, month) for scope, chat_id, message_id in chunk]
+                )
+        finally:
+            shard_conn.close()
+    
+    @staticmethod
+    def _shift_month(months_back, now=None):
+        """获取若干个月之前的月份，格式为YYYY-MM"""
+        now = now or datetime.now(timezone.utc)
+        index = now.year * 12 + now.month - 1 - months_back
+        return f'{index // 12:04d}-{index % 12 + 1:02d}'
+    
+    @staticmethod
+    def _month_range(month):
+        """获取月份的起止纪元秒，结束时间不包含"""
+        year, month_number = (int(part) for part in month.split('-'))
+        start = datetime(year, month_number, 1, tzinfo=timezone.utc)
+        end = datetime(year + month_number // 12, month_number % 12 + 1, 1, tzinfo=timezone.utc)
+        return int(start.timestamp()), int(end.timestamp())
+    
+    def _shard_path(self, month):
+        """获取分片文件路径，与主数据库位于同一目录"""
+        base, ext = os.path.splitext(os.path.abspath(self.db_file))
+        return f'{base}.{month}{ext or ".db"}'
+    
+    def _init_shard_schema(self, cursor, alias):
+        """在附加的分片中创建消息表、索引和全文索引，列与主库的消息表一致"""
+        columns = [
+            f"{row['name']} {row['type']}" for row in cursor.execute('PRAGMA main.table_info(messages)')
+            if row['name'] != 'id'
+        ]
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {alias}.messages (id INTEGER PRIMARY KEY, {', '.join(columns)})
+        ''')
+        # 分片创建之后主库新增的列
+        existing = {row['name'] for row in cursor.execute(f'PRAGMA {alias}.table_info(messages)')}
+        for column in columns:
+            if column.split(' ', 1)[0] not in existing:
+                cursor.execute(f'ALTER TABLE {alias}.messages ADD COLUMN {column}')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_messages_chat_date_ts ON messages(chat_id, date_ts, id)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_messages_sender_date_ts ON messages(sender_id, date_ts)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_messages_date_ts ON messages(date_ts)')
+        if self.fts_enabled:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {alias}.messages_fts USING fts5(
+                    text, content='messages', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+    
+    def archive_shards(self, keep_months=1, freeze_after_months=3, batch_size=5000):
+        """
+        把较早月份的消息移入按月划分的分片文件
+        
+        主库只保留最近keep_months个整月之后的消息，新消息始终写入主库。每批消息在同一事务中
+        复制到分片并从主库删除，只在每批期间持有写锁；按小时的统计表、会话表、用户表和同步状态
+        仍保存在主库，不受影响。早于freeze_after_months个月的分片会被整理并冻结，此后以只读、
+        不可变方式打开，不再写入，备份一次即可。
+        
+        Args:
+            keep_months: 主库保留的整月数，默认为1（保留上个月和本月）
+            freeze_after_months: 早于多少个月的分片被冻结，默认为3
+            batch_size: 每批移动的消息数，默认为5000
+            
+        Returns:
+            dict: 移动的消息数、涉及的月份、新冻结的分片，以及因分片已冻结而留在主库的消息数；失败返回None
+        """
+        if self.db_file == ':memory:':
+            logger.error("内存数据库不支持消息分片")
+            return None
+        keep_month = self._shift_month(keep_months)
+        freeze_month = self._shift_month(max(freeze_after_months, keep_months))
+        summary = {'moved': 0, 'months': [], 'frozen': [], 'kept_in_main': 0}
+        try:
+            with self._write_lock:
+                frozen = {row['month'] for row in self.conn.execute('SELECT month FROM message_shards WHERE frozen = 1')}
+                pending = self.conn.execute('''
+                    SELECT strftime('%Y-%m', date_ts, 'unixepoch') AS month, COUNT(*) AS count
+                    FROM messages WHERE date_ts < ?
+                    GROUP BY month ORDER BY month
+                ''', (self._month_range(keep_month)[0],)).fetchall()
+            
+            for row in pending:
+                if row['month'] in frozen:
+                    # 已冻结的分片不再写入，迟到的补录消息留在主库，查询时一并返回
+                    summary['kept_in_main'] += row['count']
+                    continue
+                logger.info(f"正在归档 {row['month']} 的 {row['count']} 条消息...")
+                summary['moved'] += self._archive_month(row['month'], batch_size)
+                summary['months'].append(row['month'])
+            
+            with self._write_lock:
+                to_freeze = [
+                    row['month'] for row in self.conn.execute(
+                        'SELECT month FROM message_shards WHERE frozen = 0 AND month < ? ORDER BY month', (freeze_month,)
+                    )
+                ]
+            for month in to_freeze:
+                self._freeze_shard(month)
+                summary['frozen'].append(month)
+            
+            logger.info(
+                f"消息分片归档完成: 移动 {summary['moved']} 条，涉及 {len(summary['months'])} 个月，"
+                f"冻结 {len(summary['frozen'])} 个分片"
+            )
+            return summary
+        except Exception as e:
+            logger.error(f"归档消息分片失败: {e}")
+            return None
+    
+    def _archive_month(self, month, batch_size):
+        """把一个月的消息分批移入对应分片，并更新分片登记信息"""
+        start_ts, end_ts = self._month_range(month)
+        batch = 'SELECT id FROM main.messages WHERE date_ts >= ? AND date_ts < ? ORDER BY id LIMIT ?'
+        params = (start_ts, end_ts, batch_size)
+        moved = 0
+        with self._write_lock:
+            self.conn.execute('ATTACH DATABASE ? AS shard_archive', (self._shard_path(month),))
+        try:
+            with self._write_lock, self.conn:
+                cursor = self.conn.cursor()
+                self._init_shard_schema(cursor, 'shard_archive')
+                columns = ', '.join(row['name'] for row in cursor.execute('PRAGMA shard_archive.table_info(messages)'))
+            while True:
+                # 分片的登记信息与消息移动在同一事务中更新，查询不会漏掉已移出主库的消息
+                with self._write_lock, self.conn:
+                    count, min_ts, max_ts = self.conn.execute(
+                        f'SELECT COUNT(*), MIN(date_ts), MAX(date_ts) FROM main.messages WHERE id IN ({batch})', params
+                    ).fetchone()
+                    if not count:
+                        break
+                    self.conn.execute(f'''
+                        INSERT OR IGNORE INTO shard_archive.messages ({columns})
+                        SELECT {columns} FROM main.messages WHERE id IN ({batch})
+                    ''', params)
+                    self.conn.execute(f'''
+                        INSERT OR IGNORE INTO archived_keys (dedup_scope, chat_id, message_id, month)
+                        SELECT dedup_scope, chat_id, message_id, ? FROM main.messages
+                        WHERE id IN ({batch}) AND chat_id IS NOT NULL AND message_id IS NOT NULL
+                    ''', (month,) + params)
+                    self.conn.execute(f'DELETE FROM main.messages WHERE id IN ({batch})', params)
+                    self.conn.execute('''
+                        INSERT INTO message_shards (month, file, row_count, min_ts, max_ts, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(month) DO UPDATE SET
+                            row_count = message_shards.row_count + excluded.row_count,
+                            min_ts = MIN(message_shards.min_ts, excluded.min_ts),
+                            max_ts = MAX(message_shards.max_ts, excluded.max_ts),
+                            updated_at = excluded.updated_at
+                    ''', (month, os.path.basename(self._shard_path(month)), count, min_ts, max_ts,
+                          datetime.now(timezone.utc).isoformat()))
+                moved += count
+            if self.fts_enabled:
+                with self._write_lock, self.conn:
+                    self._reindex_fts('shard_archive')
+        finally:
+            with self._write_lock:
+                self.conn.execute('DETACH DATABASE shard_archive')
+        return moved
+    
+    def _freeze_shard(self, month):
+        """整理分片文件并标记为冻结，冻结后改用单文件的回滚日志模式，便于直接复制备份"""
+        conn = sqlite3.connect(self._shard_path(month))
+        try:
+            if self.fts_enabled:
+                conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+                conn.commit()
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        with self._write_lock, self.conn:
+            self.conn.execute(
+                'UPDATE message_shards SET frozen = 1, updated_at = ? WHERE month = ?',
+                (datetime.now(timezone.utc).isoformat(), month)
+            )
+        logger.info(f"分片 {month} 已冻结")
+    
+    def get_shards(self):
+        """
+        获取已登记的消息分片
+        
+        Returns:
+            list: 按月份排列的分片，包含文件名、消息数、时间范围和是否冻结
+        """
+        try:
+            return [dict(row) for row in self.fetch_all('SELECT * FROM message_shards ORDER BY month')]
+        except Exception as e:
+            logger.error(f"获取消息分片失败: {e}")
+            return []
+    
+    def drop_shard(self, month):
+        """
+        删除一个消息分片文件及其登记信息，用于按保留策略整月清理已归档的消息
+        
+        Args:
+            month: 分片月份，格式为YYYY-MM
+            
+        Returns:
+            int: 释放的字节数，失败返回0
+        """
+        path = self._shard_path(month)
+        try:
+            with self._write_lock, self.conn:
+                self.conn.execute('DELETE FROM message_shards WHERE month = ?', (month,))
+                self.conn.execute('''
+                    DELETE FROM media WHERE (dedup_scope, chat_id, message_id) IN (
+                        SELECT dedup_scope, chat_id, message_id FROM archived_keys WHERE month = ?
+                    )
+                ''', (month,))
+                self.conn.execute('DELETE FROM archived_keys WHERE month = ?', (month,))
+            size = 0
+            for suffix in ('', '-journal', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    size += os.path.getsize(path + suffix)
+                    os.remove(path + suffix)
+            logger.info(f"分片 {month} 已删除")
+            return size
+        except Exception as e:
+            logger.error(f"删除分片失败 ({month}): {e}")
+            return 0
+    
+    def delete_messages_batch(self, where, params=(), batch_size=2000):
+        """
+        删除一批符合条件的消息，只在这一批期间持有写锁
+        
+        全文索引由触发器同步删除，消息与媒体文件的关联在同一事务中删除；
+        统计表、会话和用户的消息数为累计值，不会减少。
+        
+        Args:
+            where: 消息表的筛选条件
+            params: 条件参数
+            batch_size: 本批最多删除的条数
+            
+        Returns:
+            int: 删除的条数
+        """
+        with self._write_lock, self.conn:
+            rows = self.conn.execute(
+                f'SELECT id, dedup_scope, chat_id, message_id FROM messages WHERE {where} LIMIT ?',
+                (*params, batch_size)
+            ).fetchall()
+            if not rows:
+                return 0
+            self.conn.executemany('DELETE FROM messages WHERE id = ?', [(row['id'],) for row in rows])
+            self._unlink_media([(row['dedup_scope'], row['chat_id'], row['message_id']) for row in rows])
+            return len(rows)
+    
+    def _unlink_media(self, keys):
+        """删除已删除消息与媒体文件的关联，需在写锁和事务中调用"""
+        self.conn.executemany(
+            'DELETE FROM media WHERE dedup_scope = ? AND chat_id = ? AND message_id = ?',
+            [key for key in keys if key[1] is not None and key[2] is not None]
+        )
+    
+    def _delete_from_shard_conn(self, conn, where, params, batch_size):
+        """在分片连接上删除一批符合条件的消息及其全文索引，返回被删除消息的键"""
+        rows = conn.execute(f'''
+            SELECT id, dedup_scope, chat_id, message_id, COALESCE(text, text_decompress(text_z)) AS text
+            FROM messages WHERE {where} LIMIT ?
+        ''', (*params, batch_size)).fetchall()
+        if self.fts_enabled and rows:
+            # 分片的全文索引没有触发器，按删除前的文本移除索引项
+            conn.executemany(
+                "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', ?, ?)",
+                [(row['id'], row['text']) for row in rows if row['text'] is not None]
+            )
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(row['id'],) for row in rows])
+        return [(row['dedup_scope'] or 0, row['chat_id'], row['message_id']) for row in rows]
+    
+    def _open_shard_writer(self, path):
+        """打开一个分片文件的写连接，注册解压函数"""
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        self._register_functions(conn)
+        return conn
+    
+    def _forget_shard_messages(self, month, keys):
+        """从主库中移除已在分片中删除的消息的键和媒体关联，并更新分片的消息数"""
+        with self._write_lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM archived_keys WHERE dedup_scope = ? AND chat_id = ? AND message_id = ?',
+                [key for key in keys if key[1] is not None and key[2] is not None]
+            )
+            self._unlink_media(keys)
+            self.conn.execute(
+                'UPDATE message_shards SET row_count = MAX(row_count - ?, 0), updated_at = ? WHERE month = ?',
+                (len(keys), datetime.now(timezone.utc).isoformat(), month)
+            )
+    
+    def delete_shard_messages_batch(self, month, where, params=(), batch_size=2000):
+        """
+        在未冻结的分片中删除一批符合条件的消息
+        
+        分片的全文索引同步删除，主库中对应的归档键和媒体关联随后删除。
+        
+        Args:
+            month: 分片月份
+            where: 消息表的筛选条件
+            params: 条件参数
+            batch_size: 本批最多删除的条数
+            
+        Returns:
+            int: 删除的条数
+        """
+        conn = self._open_shard_writer(self._shard_path(month))
+        try:
+            with conn:
+                keys = self._delete_from_shard_conn(conn, where, params, batch_size)
+        finally:
+            conn.close()
+        if keys:
+            self._forget_shard_messages(month, keys)
+        return len(keys)
+    
+    def rewrite_frozen_shard(self, month, rules, batch_size=2000):
+        """
+        按删除规则重写一个已冻结的分片
+        
+        冻结的分片以不可变方式打开，不能原地修改：先复制一份，在副本中删除消息并整理（VACUUM），
+        再替换原文件。已经打开原文件的查询继续读取旧文件，之后附加的查询读取新文件。
+        
+        Args:
+            month: 分片月份
+            rules: (规则名, 筛选条件, 条件参数) 列表
+            batch_size: 每批删除的条数
+            
+        Returns:
+            tuple: (各规则删除的条数, 分片文件减少的字节数)
+        """
+        path = self._shard_path(month)
+        deleted = {}
+        reader = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True)
+        try:
+            matching = [rule for rule in rules if reader.execute(
+                f'SELECT 1 FROM messages WHERE {rule[1]} LIMIT 1', rule[2]
+            ).fetchone()]
+        finally:
+            reader.close()
+        if not matching:
+            return deleted, 0
+        
+        size_before = os.path.getsize(path)
+        rewrite_path = path + '.rewrite'
+        shutil.copyfile(path, rewrite_path)
+        keys = []
+        try:
+            conn = self._open_shard_writer(rewrite_path)
+            try:
+                for name, where, params in matching:
+                    deleted[name] = 0
+                    while True:
+                        with conn:
+                            batch = self._delete_from_shard_conn(conn, where, params, batch_size)
+                        if not batch:
+                            break
+                        keys += batch
+                        deleted[name] += len(batch)
+                if self.fts_enabled:
+                    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+                    conn.commit()
+                conn.execute('VACUUM')
+            finally:
+                conn.close()
+            os.replace(rewrite_path, path)
+        finally:
+            if os.path.exists(rewrite_path):
+                os.remove(rewrite_path)
+        if keys:
+            self._forget_shard_messages(month, keys)
+        logger.info(f"已重写冻结的分片 {month}，删除 {len(keys)} 条消息")
+        return deleted, max(size_before - os.path.getsize(path), 0)
+    
+    def delete_orphan_media(self, batch_size=2000):
+        """
+        删除一批不再被任何消息引用的媒体文件记录
+        
+        Args:
+            batch_size: 本批最多删除的记录数
+            
+        Returns:
+            list: 被删除记录的 (相对路径, 字节数)，文件本身由调用方删除
+        """
+        with self._write_lock, self.conn:
+            rows = self.conn.execute('''
+                SELECT sha256, path, size FROM media_files f
+                WHERE NOT EXISTS (SELECT 1 FROM media m WHERE m.sha256 = f.sha256)
+                LIMIT ?
+            ''', (batch_size,)).fetchall()
+            self.conn.executemany('DELETE FROM media_files WHERE sha256 = ?', [(row['sha256'],) for row in rows])
+        return [(row['path'], row['size']) for row in rows]
+    
+    def delete_edits_batch(self, before_ts, batch_size=2000):
+        """
+        删除一批早于指定时间被替换的编辑历史
+        
+        Args:
+            before_ts: 纪元秒，replaced_ts早于此时间的记录被删除
+            batch_size: 本批最多删除的条数
+            
+        Returns:
+            int: 删除的条数
+        """
+        with self._write_lock, self.conn:
+            return self.conn.execute('''
+                DELETE FROM message_edits WHERE id IN (
+                    SELECT id FROM message_edits WHERE replaced_ts < ? LIMIT ?
+                )
+            ''', (before_ts, batch_size)).rowcount
+    
+    def delete_rollups_before(self, before_ts):
+        """
+        删除早于指定时间的按小时统计和每日词频
+        
+        Args:
+            before_ts: 纪元秒
+            
+        Returns:
+            int: 删除的行数
+        """
+        deleted = 0
+        with self._write_lock, self.conn:
+            for table, _, _, _ in self.ROLLUP_TABLES:
+                deleted += self.conn.execute(f'DELETE FROM {table} WHERE hour_ts < ?', (before_ts,)).rowcount
+            deleted += self.conn.execute('DELETE FROM term_counts WHERE day < ?', (before_ts // 86400,)).rowcount
+        return deleted
+    
+    def get_storage_stats(self):
+        """
+        获取数据库文件的空间使用情况
+        
+        Returns:
+            dict: 页大小、总页数、空闲页数、auto_vacuum模式，数据库文件的字节数（不含WAL）、
+                  其中空闲页的字节数，以及WAL文件的字节数
+        """
+        with self._write_lock:
+            stats = {
+                name: self.conn.execute(f'PRAGMA {name}').fetchone()[0]
+                for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')
+            }
+        # WAL中的页在检查点后写回数据库文件，计入文件大小会把截断WAL误算为回收的空间
+        stats['file_bytes'] = stats['page_count'] * stats['page_size']
+        stats['free_bytes'] = stats['freelist_count'] * stats['page_size']
+        wal_file = self.db_file + '-wal'
+        stats['wal_bytes'] = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+        return stats
+    
+    def incremental_vacuum(self, pages=1000):
+        """
+        把最多pages个空闲页归还给文件系统，需要数据库处于增量auto_vacuum模式
+        
+        Args:
+            pages: 本次最多回收的页数
+            
+        Returns:
+            int: 回收的页数
+        """
+        with self._write_lock:
+            before = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # execute()只执行一步（回收一页），executescript()会执行到结束
+            self.conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+            return before - self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+    
+    def checkpoint(self):
+        """把WAL中的内容写回数据库文件并截断WAL"""
+        with self._write_lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    
+    def optimize(self, analysis_limit=1000):
+        """
+        更新查询规划器的统计信息
+        
+        Args:
+            analysis_limit: ANALYZE每个索引最多检查的行数，0表示不限
+        """
+        with self._write_lock:
+            self.conn.execute(f'PRAGMA analysis_limit={int(analysis_limit)}')
+            self.conn.execute('ANALYZE')
+            self.conn.execute('PRAGMA optimize')
+            self.conn.commit()
+    
+    def enable_incremental_vacuum(self):
+        """
+        把已有数据库切换为增量auto_vacuum模式，需要完整执行一次VACUUM，期间阻塞写入
+        
+        Returns:
+            bool: 是否切换成功
+        """
+        try:
+            logger.info("正在切换为增量空间回收模式并整理数据库，可能需要较长时间...")
+            with self._write_lock:
+                self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.conn.execute('VACUUM')
+            logger.info("数据库整理完成")
+            return True
+        except Exception as e:
+            logger.error(f"整理数据库失败: {e}")
+            return False
+    
+    def _dictionary_for(self, codec, cutoff_ts, sample_size, dictionary_size):
+        """获取指定编码方式最新的字典，没有时用早于cutoff_ts的最新消息训练一个"""
+        # 先登记其他进程训练的字典，避免重复训练
+        for row in self.fetch_all('SELECT id, codec, data FROM text_dictionaries'):
+            if row['id'] not in self.codec.dictionaries:
+                self.codec.add_dictionary(row['id'], row['codec'], row['data'])
+        ids = [dict_id for dict_id, (name, _) in self.codec.dictionaries.items() if name == codec]
+        if ids:
+            return max(ids)
+        samples = [row['text'] for row in self.fetch_all('''
+            SELECT text FROM messages
+            WHERE date_ts < ? AND text IS NOT NULL AND text != ''
+            ORDER BY date_ts DESC LIMIT ?
+        ''', (cutoff_ts, sample_size))]
+        if not samples:
+            return None
+        data = train_dictionary(codec, samples, dictionary_size)
+        with self._write_lock, self.conn:
+            dict_id = self.conn.execute(
+                'INSERT INTO text_dictionaries (codec, data, sample_count, created_ts) VALUES (?, ?, ?, ?)',
+                (codec, data, len(samples), int(datetime.now(timezone.utc).timestamp()))
+            ).lastrowid
+        self.codec.add_dictionary(dict_id, codec, data)
+        logger.info(f"已根据 {len(samples)} 条消息训练压缩字典 (ID: {dict_id}, {codec}, {len(data)} 字节)")
+        return dict_id
+    
+    def compress_cold_text(self, min_age_days=30, codec='zlib', level=6, batch_size=2000,
+                           sample_size=5000, dictionary_size=32768):
+        """
+        压缩早于min_age_days天的消息文本
+        
+        首次运行时用较早的消息训练一个字典，每条消息单独压缩，读取时可按行解压。
+        只处理上次压缩之后新变旧的消息，压缩后不比原文小的消息保持原样。每批只在写入时持有写锁。
+        
+        Args:
+            min_age_days: 消息超过多少天后压缩，近期消息保持不压缩
+            codec: 压缩方式，'zlib'或'zstd'（需安装zstandard）
+            level: 压缩级别
+            batch_size: 每批处理的消息数
+            sample_size: 训练字典使用的消息数
+            dictionary_size: 字典大小（字节），zlib最多使用32KB
+            
+        Returns:
+            dict: 本次压缩的条数、压缩前后的字节数、压缩率和单条解压耗时；失败返回None
+        """
+        if codec not in available_codecs():
+            logger.error(f"压缩方式 {codec} 不可用，zstd需要安装zstandard")
+            return None
+        cutoff_ts = int(datetime.now(timezone.utc).timestamp()) - min_age_days * 86400
+        report = {'rows': 0, 'skipped': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+        try:
+            state = self.fetch_one('SELECT compressed_before_ts FROM compression_state WHERE id = 1')
+            position = (state['compressed_before_ts'] if state else 0, 0)
+            dict_id = self._dictionary_for(codec, cutoff_ts, sample_size, dictionary_size)
+            if dict_id is None:
+                logger.info("没有需要压缩的消息")
+                return report
+            
+            while True:
+                rows = self.fetch_all('''
+                    SELECT id, date_ts, text FROM messages
+                    WHERE (date_ts, id) > (?, ?) AND date_ts < ? AND text IS NOT NULL AND text != ''
+                    ORDER BY date_ts, id LIMIT ?
+                ''', (*position, cutoff_ts, batch_size))
+                if not rows:
+                    break
+                position = (rows[-1]['date_ts'], rows[-1]['id'])
+                updates = []
+                raw_bytes = compressed_bytes = 0
+                for row in rows:
+                    raw = len(row['text'].encode('utf-8'))
+                    blob = self.codec.compress(row['text'], dict_id, level)
+                    if len(blob) >= raw:
+                        report['skipped'] += 1
+                        continue
+                    updates.append((blob, row['id'], row['text']))
+                    raw_bytes += raw
+                    compressed_bytes += len(blob)
+                with self._write_lock, self.conn:
+                    # 文本在读取之后被编辑过的消息不压缩
+                    self.conn.executemany(
+                        'UPDATE messages SET text = NULL, text_z = ? WHERE id = ? AND text = ?', updates
+                    )
+                report['rows'] += len(updates)
+                report['raw_bytes'] += raw_bytes
+                report['compressed_bytes'] += compressed_bytes
+            
+            with self._write_lock, self.conn:
+                self.conn.execute('''
+                    INSERT INTO compression_state (id, compressed_before_ts, row_count, raw_bytes, compressed_bytes, updated_at)
+                    VALUES (1, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        compressed_before_ts = MAX(compression_state.compressed_before_ts, excluded.compressed_before_ts),
+                        row_count = compression_state.row_count + excluded.row_count,
+                        raw_bytes = compression_state.raw_bytes + excluded.raw_bytes,
+                        compressed_bytes = compression_state.compressed_bytes + excluded.compressed_bytes,
+                        updated_at = excluded.updated_at
+                ''', (cutoff_ts, report['rows'], report['raw_bytes'], report['compressed_bytes'],
+                      datetime.now(timezone.utc).isoformat()))
+            
+            report['ratio'] = round(report['raw_bytes'] / report['compressed_bytes'], 2) if report['compressed_bytes'] else None
+            report['decompress_us_avg'] = self._benchmark_decompress()
+            logger.info(
+                f"消息文本压缩完成: {report['rows']} 条，{report['raw_bytes'] / 1024 / 1024:.1f}MB -> "
+                f"{report['compressed_bytes'] / 1024 / 1024:.1f}MB (压缩率 {report['ratio']})，"
+                f"单条解压 {report['decompress_us_avg']}微秒"
+            )
+            return report
+        except Exception as e:
+            logger.error(f"压缩消息文本失败: {e}")
+            return None
+    
+    def _benchmark_decompress(self, sample_size=1000):
+        """解压一批已压缩的消息，返回平均每条的耗时（微秒）"""
+        blobs = [row['text_z'] for row in self.fetch_all(
+            'SELECT text_z FROM messages WHERE text_z IS NOT NULL ORDER BY id DESC LIMIT ?', (sample_size,)
+        )]
+        if not blobs:
+            return None
+        started = time.perf_counter()
+        for blob in blobs:
+            self.codec.decompress(blob)
+        return round((time.perf_counter() - started) / len(blobs) * 1e6, 1)
+    
+    def get_compression_stats(self):
+        """
+        获取文本压缩的累计指标
+        
+        Returns:
+            dict: 已压缩的条数、压缩前后的字节数、压缩率、已压缩到的时间点，以及查询中的解压次数和平均耗时
+        """
+        try:
+            state = self.fetch_one('SELECT * FROM compression_state WHERE id = 1')
+            stats = dict(state) if state else {'row_count': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+            stats.pop('id', None)
+            stats['ratio'] = round(stats['raw_bytes'] / stats['compressed_bytes'], 2) if stats['compressed_bytes'] else None
+            stats['dictionaries'] = len(self.codec.dictionaries)
+            stats.update(self.codec.stats())
+            return stats
+        except Exception as e:
+            logger.error(f"获取压缩指标失败: {e}")
+            return {}
+    
+    def _shards_for_range(self, cursor, start_ts=None, end_ts=None):
+        """获取与时间范围 [start_ts, end_ts) 重叠的分片，最新的在前"""
+        if self.db_file == ':memory:':
+            return []
+        return cursor.execute('''
+            SELECT month, min_ts, max_ts, frozen FROM message_shards
+            WHERE row_count > 0
+                AND (? IS NULL OR max_ts >= ?)
+                AND (? IS NULL OR min_ts < ?)
+            ORDER BY max_ts DESC
+        ''', (start_ts, start_ts, end_ts, end_ts)).fetchall()
+    
+    def _attach_shard(self, cursor, shard):
+        """在只读连接上附加一个分片，已冻结的分片以不可变方式打开，无需加锁"""
+        alias = 'shard_' + shard['month'].replace('-', '')
+        uri = 'file:' + self._shard_path(shard['month']) + '?mode=ro'
+        if shard['frozen']:
+            uri += '&immutable=1'
+        cursor.execute(f'ATTACH DATABASE ? AS {alias}', (uri,))
+        return alias
+    
+    def _fetch_across_shards(self, sql, params, start_ts=None, end_ts=None, sort_key=None,
+                             limit=None, newest_first=False):
+        """
+        在主库和与时间范围重叠的分片上分别执行同一查询并合并结果
+        
+        sql中的{view}、{messages}和{fts}分别替换为各数据源的消息视图、消息表和全文索引表。
+        分片逐个附加到同一个只读连接上，查询后立即分离。
+        
+        Args:
+            sql: 查询语句模板
+            params: 查询参数，每个数据源相同
+            start_ts: 时间范围起点（包含），None表示不限
+            end_ts: 时间范围终点（不包含），None表示不限
+            sort_key: 合并排序的键函数，可选
+            limit: 合并后保留的行数，可选
+            newest_first: 结果是否按date_ts倒序；为True时，已取满limit行且更早的分片不可能
+                          进入结果时停止查询
+            
+        Returns:
+            list: sqlite3.Row列表
+        """
+        sources = {'view': 'messages_view', 'messages': 'messages', 'fts': 'messages_fts'}
+        with self.read_cursor() as cursor:
+            rows = cursor.execute(sql.format(**sources), tuple(params)).fetchall()
+            for shard in self._shards_for_range(cursor, start_ts, end_ts):
+                if newest_first and limit and len(rows) >= limit:
+                    rows.sort(key=sort_key)
+                    if shard['max_ts'] < rows[limit - 1]['date_ts']:
+                        break
+                try:
+                    alias = self._attach_shard(cursor, shard)
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"无法打开分片 {shard['month']}，已跳过: {e}")
+                    continue
+                try:
+                    messages = f'{alias}.messages'
+                    rows += cursor.execute(sql.format(
+                        view=f'({self.MESSAGES_VIEW_SQL.format(messages=messages)})',
+                        messages=messages, fts=f'{alias}.messages_fts'
+                    ), tuple(params)).fetchall()
+                finally:
+                    cursor.execute(f'DETACH DATABASE {alias}')
+        if sort_key:
+            rows.sort(key=sort_key)
+        return rows[:limit] if limit else rows
+    
+    def _reindex_fts(self, schema):
+        """
+        根据消息表重建指定库中的全文索引，需在写锁和事务中调用
+        
+        FTS5的rebuild命令直接读取text列，会漏掉已压缩的消息，因此清空后按解压后的文本重新写入。
+        """
+        self.conn.execute(f"INSERT INTO {schema}.messages_fts(messages_fts) VALUES ('delete-all')")
+        self.conn.execute(f'''
+            INSERT INTO {schema}.messages_fts(rowid, text)
+            SELECT id, COALESCE(text, text_decompress(text_z)) FROM {schema}.messages
+        ''')
+    
+    def close(self):
+        """关闭数据库连接"""
+        self._executor.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns = []
+        if self.conn:
+            self.conn.close()
+            logger.info("数据库连接已关闭")
+    
+    def _open_reader(self):
+        """创建一个只读连接"""
+        if self.db_file == ':memory:':
+            # 内存数据库无法被其他连接打开，只能复用写连接
+            return self.conn
+        uri = 'file:' + os.path.abspath(self.db_file) + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        self._register_functions(conn)
+        return conn
+    
+    def _acquire_reader(self):
+        """从连接池取出一个只读连接，池空且未达上限时新建"""
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            if len(self._reader_conns) < self.read_pool_size:
+                conn = self._open_reader()
+                self._reader_conns.append(conn)
+                return conn
+        return self._readers.get()
+    
+    @contextmanager
+    def read_cursor(self):
+        """
+        获取一个只读游标，使用完毕后连接自动归还连接池
+        
+        Yields:
+            sqlite3.Cursor: 独占的只读游标
+        """
+        conn = self._acquire_reader()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self._readers.put(conn)
+    
+    def fetch_all(self, query, params=()):
+        """
+        在只读连接上执行查询并返回全部结果
+        
+        Args:
+            query: SQL语句
+            params: 查询参数
+            
+        Returns:
+            list: sqlite3.Row列表
+        """
+        with self.read_cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            return cursor.fetchall()
+    
+    def fetch_one(self, query, params=()):
+        """
+        在只读连接上执行查询并返回第一行
+        
+        Args:
+            query: SQL语句
+            params: 查询参数
+            
+        Returns:
+            sqlite3.Row，没有结果时返回None
+        """
+        with self.read_cursor() as cursor:
+            cursor.execute(query, tuple(params))
+            return cursor.fetchone()
+    
+    @staticmethod
+    def _message_params(message_data, now):
+        """将消息数据字典转换为INSERT语句的参数元组"""
+        return (
+            message_data.get('message_id'),
+            message_data.get('chat_id'),
+            message_data.get('sender_id'),
+            message_data.get('text'),
+            message_data.get('date'),
+            message_data.get('media_type'),
+            message_data.get('is_forwarded'),
+            message_data.get('forward_from'),
+            message_data.get('reply_to_msg_id'),
+            now.isoformat(),
+            to_epoch(message_data.get('date')),
+            int(now.timestamp()),
+            message_data.get('account_id'),
+            message_data.get('dedup_scope') or 0
+        )
+    
+    def _upsert_entities(self, messages):
+        """
+        根据一批消息更新chats和users表，需在写锁和事务中调用
+        
+        同一会话/用户在批内只写一次，名称取批内最后一条消息的值。
+        """
+        chats = {}
+        users = {}
+        for m in messages:
+            date = m.get('date')
+            chat_id = m.get('chat_id')
+            if chat_id is not None:
+                row = chats.get(chat_id)
+                if row is None:
+                    chats[chat_id] = [chat_id, m.get('chat_title'), m.get('chat_type'), date, date, 1]
+                else:
+                    row[1] = m.get('chat_title') or row[1]
+                    row[2] = m.get('chat_type') or row[2]
+                    row[3] = min(filter(None, (row[3], date)), default=None)
+                    row[4] = max(filter(None, (row[4], date)), default=None)
+                    row[5] += 1
+            sender_id = m.get('sender_id')
+            if sender_id is not None:
+                row = users.get(sender_id)
+                if row is None:
+                    users[sender_id] = [sender_id, m.get('sender_username'), m.get('sender_first_name'),
+                                        m.get('sender_last_name'), date, date, 1]
+                else:
+                    row[1:4] = [m.get('sender_username'), m.get('sender_first_name'), m.get('sender_last_name')]
+                    row[4] = min(filter(None, (row[4], date)), default=None)
+                    row[5] = max(filter(None, (row[5], date)), default=None)
+                    row[6] += 1
+        if chats:
+            self.conn.executemany(self.UPSERT_CHAT_SQL, list(chats.values()))
+        if users:
+            self.conn.executemany(self.UPSERT_USER_SQL, list(users.values()))
+    
+    def _advance_high_water(self, messages):
+        """根据一批消息推进各会话的high_water_id，需在写锁和事务中调用"""
+        marks = {}
+        for m in messages:
+            chat_id = m.get('chat_id')
+            message_id = m.get('message_id')
+            if chat_id is None or message_id is None:
+                continue
+            key = (m.get('dedup_scope') or 0, chat_id)
+            marks[key] = max(marks.get(key, 0), message_id)
+        if marks:
+            self.conn.executemany('''
+                INSERT INTO chat_sync_state (dedup_scope, chat_id, high_water_id) VALUES (?, ?, ?)
+                ON CONFLICT(dedup_scope, chat_id) DO UPDATE SET
+                    high_water_id = MAX(chat_sync_state.high_water_id, excluded.high_water_id)
+            ''', [(scope, chat_id, high_water_id) for (scope, chat_id), high_water_id in marks.items()])
+    
+    def _record_ingest(self, messages):
+        """写入消息后更新会话、用户和同步状态，需在写锁和事务中调用"""
+        self._upsert_entities(messages)
+        self._advance_high_water(messages)
+    
+    def _write_messages(self, messages, now):
         """
-        初始化数据库管理器
+        写入一批消息，需在写锁和事务中调用
+        
+        新消息遇到已入库的 (dedup_scope, chat_id, message_id) 时被忽略，包括已归档到分片的消息；
+        带is_edited标记的消息更新已入库消息的当前内容，旧版本由触发器写入message_edits，
+        已归档的消息在其分片中更新。会话、用户的消息数只按实际新插入的行累加。
         
         Args:
-            db_file: 数据库文件路径，默认为'data.db'
+            messages: 消息数据字典列表
+            now: 写入时间
+            
+        Returns:
+            list: 实际新插入的消息
         """
-        self.db_file = db_file
-        self.conn = None
-        self.cursor = None
-        self.init_db()
+        archived = self._archived_months(messages)
+        if archived:
+            # 已归档的消息不再写入主库：重复到达的消息被忽略，编辑转到消息所在的分片
+            for m in messages:
+                month = archived.get((m.get('dedup_scope') or 0, m.get('chat_id'), m.get('message_id')))
+                if month and m.get('is_edited'):
+                    self._apply_archived_edit(m, month, now)
+            pending = [
+                m for m in messages
+                if (m.get('dedup_scope') or 0, m.get('chat_id'), m.get('message_id')) not in archived
+            ]
+        else:
+            pending = messages
+        new_messages = [m for m in pending if not m.get('is_edited')]
+        edits = [m for m in pending if m.get('is_edited')]
+        last_id = self.conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+        inserted_count = 0
+        if new_messages:
+            inserted_count = self.conn.executemany(
+                self.INSERT_MESSAGE_SQL, [self._message_params(m, now) for m in new_messages]
+            ).rowcount
+        if edits:
+            self.conn.executemany(self.UPSERT_EDIT_SQL, [self._message_params(m, now) for m in edits])
+        
+        if not edits and inserted_count == len(new_messages):
+            inserted = new_messages
+        else:
+            # 有重复或编辑时，按自增ID找出本次新插入的行
+            keys = {
+                tuple(row) for row in self.conn.execute(
+                    'SELECT dedup_scope, chat_id, message_id FROM messages WHERE id > ?', (last_id,)
+                )
+            }
+            inserted = []
+            for m in pending:
+                key = (m.get('dedup_scope') or 0, m.get('chat_id'), m.get('message_id'))
+                if key in keys:
+                    keys.discard(key)
+                    inserted.append(m)
+        self._upsert_entities(inserted)
+        self._advance_high_water(messages)
+        return inserted
     
-    def init_db(self):
-        """初始化数据库连接和表结构"""
+    def _archived_months(self, messages):
+        """
+        查找一批消息中已归档到分片的消息，需在写锁中调用
+        
+        消息的时间不会改变，只有时间不晚于最新分片的消息才可能已归档，实时消息无需逐条查找。
+        
+        Returns:
+            dict: (dedup_scope, chat_id, message_id) -> 分片月份
+        """
+        latest = self.conn.execute('SELECT MAX(max_ts) FROM message_shards').fetchone()[0]
+        if latest is None:
+            return {}
+        archived = {}
+        for m in messages:
+            date_ts = to_epoch(m.get('date'))
+            if date_ts is None or date_ts > latest:
+                continue
+            key = (m.get('dedup_scope') or 0, m.get('chat_id'), m.get('message_id'))
+            row = self.conn.execute(
+                'SELECT month FROM archived_keys WHERE dedup_scope = ? AND chat_id = ? AND message_id = ?', key
+            ).fetchone()
+            if row:
+                archived[key] = row[0]
+        return archived
+    
+    def _apply_archived_edit(self, message_data, month, now):
+        """
+        在分片中更新一条已归档消息的当前内容，需在写锁和事务中调用
+        
+        分片的全文索引随之更新；旧版本写入主库的message_edits，媒体类型改变时同步调整按小时的
+        媒体统计。已冻结的分片不再写入，对其中消息的编辑只记录日志。
+        
+        Args:
+            message_data: 编辑后的消息数据字典
+            month: 消息所在分片的月份
+            now: 写入时间
+            
+        Returns:
+            bool: 是否更新了消息
+        """
+        scope = message_data.get('dedup_scope') or 0
+        chat_id = message_data.get('chat_id')
+        message_id = message_data.get('message_id')
+        shard = self.conn.execute('SELECT frozen FROM message_shards WHERE month = ?', (month,)).fetchone()
+        if shard is None or shard['frozen']:
+            logger.warning(f"消息所在的分片 {month} 已冻结，忽略编辑 (chat_id: {chat_id}, message_id: {message_id})")
+            return False
+        text = message_data.get('text')
+        media_type = message_data.get('media_type')
+        shard_conn = sqlite3.connect(self._shard_path(month), timeout=30)
+        shard_conn.row_factory = sqlite3.Row
+        self._register_functions(shard_conn)
         try:
-            db_exists = os.path.exists(self.db_file)
+            with shard_conn:
+                old = shard_conn.execute('''
+                    SELECT id, COALESCE(text, text_decompress(text_z)) AS text, media_type, date_ts
+                    FROM messages WHERE chat_id = ? AND dedup_scope = ? AND message_id = ?
+                ''', (chat_id, scope, message_id)).fetchone()
+                if old is None or (old['text'] == text and old['media_type'] == media_type):
+                    return False
+                shard_conn.execute(
+                    'UPDATE messages SET text = ?, text_z = NULL, media_type = ? WHERE id = ?',
+                    (text, media_type, old['id'])
+                )
+                if self.fts_enabled:
+                    if old['text'] is not None:
+                        shard_conn.execute(
+                            "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', ?, ?)",
+                            (old['id'], old['text'])
+                        )
+                    if text is not None:
+                        shard_conn.execute('INSERT INTO messages_fts(rowid, text) VALUES (?, ?)', (old['id'], text))
+        finally:
+            shard_conn.close()
+        self.conn.execute('''
+            INSERT INTO message_edits (chat_id, message_id, text, media_type, replaced_ts, dedup_scope)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (chat_id, message_id, old['text'], old['media_type'], int(now.timestamp()), scope))
+        if (old['media_type'] or '') != (media_type or '') and old['date_ts'] is not None:
+            hour_ts = old['date_ts'] - old['date_ts'] % 3600
+            self.conn.execute(
+                'UPDATE stats_hourly_media SET count = count - 1 WHERE hour_ts = ? AND media_type = ? AND count > 0',
+                (hour_ts, old['media_type'] or '')
+            )
+            self.conn.execute('''
+                INSERT INTO stats_hourly_media (hour_ts, media_type, count) VALUES (?, ?, 1)
+                ON CONFLICT (hour_ts, media_type) DO UPDATE SET count = count + 1
+            ''', (hour_ts, media_type or ''))
+        return True
+    
+    def save_message(self, message_data):
+        """
+        保存消息到数据库，已入库的消息不会重复保存，编辑过的消息会更新当前内容
+        
+        Args:
+            message_data: 消息数据字典
             
-            # 创建连接
-            self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
-            # 设置行工厂为字典
-            self.conn.row_factory = sqlite3.Row
-            self.cursor = self.conn.cursor()
+        Returns:
+            消息在数据库中的ID
+        """
+        try:
+            now = datetime.now(timezone.utc)
+            with self._write_lock, self.conn:
+                if self._write_messages([message_data], now):
+                    last_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                else:
+                    row = self.conn.execute(
+                        'SELECT id FROM messages WHERE dedup_scope = ? AND chat_id = ? AND message_id = ?',
+                        (message_data.get('dedup_scope') or 0, message_data.get('chat_id'),
+                         message_data.get('message_id'))
+                    ).fetchone()
+                    last_id = row[0] if row else None
+            logger.debug(f"消息保存成功，ID: {last_id}")
+            return last_id
+        except Exception as e:
+            logger.error(f"保存消息失败: {e}")
+            return None
+    
+    async def save_message_async(self, message_data):
+        """
+        在事件循环中保存消息，实际写入在后台线程中执行
+        
+        Args:
+            message_data: 消息数据字典
             
-            # 创建表（如果不存在）
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, chat_id INTEGER,
-                    chat_title TEXT, chat_type TEXT, sender_id INTEGER, sender_username TEXT,
-                    sender_first_name TEXT, sender_last_name TEXT, text TEXT, date TEXT,
-                    media_type TEXT, is_forwarded BOOLEAN, forward_from TEXT,
-                    reply_to_msg_id INTEGER, created_at TEXT
-                )
-            ''')
+        Returns:
+            插入的消息ID
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.save_message, message_data)
+    
+    def save_messages(self, messages):
+        """
+        在一个事务中批量保存消息，重复的消息被忽略，编辑过的消息更新当前内容
+        
+        Args:
+            messages: 消息数据字典列表
             
-            # 创建索引
-            self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)
-            ''')
-            self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages(sender_id)
-            ''')
-            self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date)
-            ''')
+        Returns:
+            int: 成功处理的条数（含被忽略的重复消息），失败返回0
+        """
+        if not messages:
+            return 0
+        try:
+            now = datetime.now(timezone.utc)
+            with self._write_lock, self.conn:
+                inserted = self._write_messages(messages, now)
+            logger.debug(f"批量保存消息成功，共 {len(messages)} 条，新增 {len(inserted)} 条")
+            return len(messages)
+        except Exception as e:
+            logger.error(f"批量保存消息失败: {e}")
+            return 0
+    
+    def save_backfill_batch(self, chat_id, messages, last_message_id, dedup_scope=0):
+        """
+        保存一批历史消息并推进该会话的补录进度，二者在同一事务中完成
+        
+        已入库的消息（按dedup_scope、chat_id和message_id判断）会被跳过，中断后重跑不会产生重复。
+        
+        Args:
+            chat_id: 聊天ID
+            messages: 按message_id升序排列的消息数据字典列表
+            last_message_id: 本批处理到的最大消息ID
+            dedup_scope: 去重范围，默认为0
             
-            self.conn.commit()
+        Returns:
+            int: 实际写入的条数，失败返回None
+        """
+        try:
+            now = datetime.now(timezone.utc)
+            with self._write_lock, self.conn:
+                new_messages = self._write_messages(messages, now)
+                self.conn.execute('''
+                    INSERT INTO backfill_state (dedup_scope, chat_id, last_message_id, saved_count, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(dedup_scope, chat_id) DO UPDATE SET
+                        last_message_id = MAX(backfill_state.last_message_id, excluded.last_message_id),
+                        saved_count = backfill_state.saved_count + excluded.saved_count,
+                        updated_at = excluded.updated_at
+                ''', (dedup_scope, chat_id, last_message_id, len(new_messages), now.isoformat()))
+            return len(new_messages)
+        except Exception as e:
+            logger.error(f"保存历史消息失败 (chat_id: {chat_id}): {e}")
+            return None
+    
+    def save_catchup_batch(self, chat_id, messages):
+        """
+        保存断线期间缺失的一批消息，已入库的消息会被跳过
+        
+        Args:
+            chat_id: 聊天ID
+            messages: 按message_id升序排列的消息数据字典列表
             
-            if not db_exists:
-                logger.info(f"数据库初始化成功: {self.db_file}")
-            else:
-                logger.info(f"连接到现有数据库: {self.db_file}")
-                
+        Returns:
+            int: 实际写入的条数，失败返回None
+        """
+        try:
+            with self._write_lock, self.conn:
+                new_messages = self._write_messages(messages, datetime.now(timezone.utc))
+            return len(new_messages)
         except Exception as e:
-            logger.error(f"初始化数据库失败: {e}")
+            logger.error(f"保存缺失消息失败 (chat_id: {chat_id}): {e}")
+            return None
     
-    def close(self):
-        """关闭数据库连接"""
-        if self.conn:
-            self.conn.close()
-            logger.info("数据库连接已关闭")
+    def get_high_water_marks(self):
+        """
+        获取所有会话已入库的最大消息ID
+        
+        Returns:
+            dict: (dedup_scope, chat_id) -> high_water_id
+        """
+        rows = self.fetch_all('SELECT dedup_scope, chat_id, high_water_id FROM chat_sync_state')
+        return {(row['dedup_scope'], row['chat_id']): row['high_water_id'] for row in rows}
     
-    def save_message(self, message_data):
+    def get_high_water_mark(self, chat_id, dedup_scope=0):
         """
-        保存消息到数据库
+        获取单个会话已入库的最大消息ID
         
         Args:
-            message_data: 消息数据字典
+            chat_id: 聊天ID
+            dedup_scope: 去重范围，默认为0
             
         Returns:
-            插入的消息ID
+            int: 最大消息ID，没有记录时返回0
+        """
+        row = self.fetch_one(
+            'SELECT high_water_id FROM chat_sync_state WHERE dedup_scope = ? AND chat_id = ?',
+            (dedup_scope, chat_id)
+        )
+        return row['high_water_id'] if row else 0
+    
+    def update_sync_state(self, chat_id, status, top_message_id=None, gap=None, recovered=None, dedup_scope=0):
+        """
+        记录一次缺口检查的结果
+        
+        Args:
+            chat_id: 聊天ID
+            status: 状态，如'running'、'ok'、'failed'
+            top_message_id: 会话当前最新的消息ID，可选
+            gap: 检查时发现的消息ID差距，可选
+            recovered: 补回的消息条数，可选
+            dedup_scope: 去重范围，默认为0
         """
         try:
-            now = datetime.now(timezone.utc).isoformat()
-            self.cursor.execute('''
-            INSERT INTO messages (
-                message_id, chat_id, chat_title, chat_type, sender_id,
-                sender_username, sender_first_name, sender_last_name, text,
-                date, media_type, is_forwarded, forward_from, reply_to_msg_id,
-                created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                message_data.get('message_id'),
-                message_data.get('chat_id'),
-                message_data.get('chat_title'),
-                message_data.get('chat_type'),
-                message_data.get('sender_id'),
-                message_data.get('sender_username'),
-                message_data.get('sender_first_name'),
-                message_data.get('sender_last_name'),
-                message_data.get('text'),
-                message_data.get('date'),
-                message_data.get('media_type'),
-                message_data.get('is_forwarded'),
-                message_data.get('forward_from'),
-                message_data.get('reply_to_msg_id'),
-                now
-            ))
+            with self._write_lock, self.conn:
+                self.conn.execute('''
+                    INSERT INTO chat_sync_state (
+                        dedup_scope, chat_id, top_message_id, last_gap, last_recovered, status, last_checked_at
+                    )
+                    VALUES (?, ?, ?, COALESCE(?, 0), COALESCE(?, 0), ?, ?)
+                    ON CONFLICT(dedup_scope, chat_id) DO UPDATE SET
+                        top_message_id = COALESCE(excluded.top_message_id, chat_sync_state.top_message_id),
+                        last_gap = COALESCE(?, chat_sync_state.last_gap),
+                        last_recovered = COALESCE(?, chat_sync_state.last_recovered),
+                        status = excluded.status,
+                        last_checked_at = excluded.last_checked_at
+                ''', (dedup_scope, chat_id, top_message_id, gap, recovered, status,
+                      datetime.now(timezone.utc).isoformat(), gap, recovered))
+        except Exception as e:
+            logger.error(f"更新同步状态失败 (chat_id: {chat_id}): {e}")
+    
+    def get_sync_status(self):
+        """
+        获取各会话的同步状态
+        
+        Returns:
+            list: 每个会话的高水位、最新消息ID、最近一次缺口大小和补回条数
+        """
+        rows = self.fetch_all('''
+            SELECT s.*, c.title FROM chat_sync_state s
+            LEFT JOIN chats c ON c.chat_id = s.chat_id
+            ORDER BY s.last_gap DESC, s.chat_id, s.dedup_scope
+        ''')
+        return [dict(row) for row in rows]
+    
+    def get_backfill_checkpoint(self, chat_id, dedup_scope=0):
+        """
+        获取会话的补录进度
+        
+        Args:
+            chat_id: 聊天ID
+            dedup_scope: 去重范围，默认为0
             
-            self.conn.commit()
-            last_id = self.cursor.lastrowid
-            logger.debug(f"消息保存成功，ID: {last_id}")
-            return last_id
+        Returns:
+            int: 已补录的最大消息ID，尚未补录过返回0
+        """
+        row = self.fetch_one(
+            'SELECT last_message_id FROM backfill_state WHERE dedup_scope = ? AND chat_id = ?',
+            (dedup_scope, chat_id)
+        )
+        return row['last_message_id'] if row else 0
+    
+    def save_media(self, dedup_scope, chat_id, message_id, media_type, sha256,
+                   path=None, size=None, mime_type=None, telegram_file_id=None):
+        """
+        登记一条消息的媒体文件
+        
+        Args:
+            dedup_scope: 去重范围
+            chat_id: 聊天ID
+            message_id: Telegram消息ID
+            media_type: 媒体类型
+            sha256: 文件内容的sha256
+            path: 相对于媒体目录的文件路径，为空时表示文件已登记过，只关联消息
+            size: 文件大小（字节）
+            mime_type: 文件的MIME类型
+            telegram_file_id: Telegram中照片或文档的ID，用于识别重复发送的文件
+            
+        Returns:
+            bool: 是否登记成功
+        """
+        try:
+            with self._write_lock, self.conn:
+                if path is not None:
+                    self.conn.execute('''
+                        INSERT INTO media_files (sha256, path, size, mime_type, telegram_file_id, created_ts)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(sha256) DO UPDATE SET
+                            telegram_file_id = COALESCE(media_files.telegram_file_id, excluded.telegram_file_id)
+                    ''', (sha256, path, size, mime_type, telegram_file_id, int(datetime.now(timezone.utc).timestamp())))
+                self.conn.execute('''
+                    INSERT INTO media (dedup_scope, chat_id, message_id, media_type, sha256)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(dedup_scope, chat_id, message_id) DO UPDATE SET
+                        media_type = excluded.media_type, sha256 = excluded.sha256
+                ''', (dedup_scope, chat_id, message_id, media_type, sha256))
+            return True
         except Exception as e:
-            logger.error(f"保存消息失败: {e}")
-            return None
+            logger.error(f"登记媒体文件失败: {e}")
+            return False
+    
+    def find_media_by_telegram_id(self, telegram_file_id):
+        """
+        根据Telegram文件ID查找已下载的文件
+        
+        Args:
+            telegram_file_id: Telegram中照片或文档的ID
+            
+        Returns:
+            str: 文件的sha256，未下载过时返回None
+        """
+        row = self.fetch_one(
+            'SELECT sha256 FROM media_files WHERE telegram_file_id = ? LIMIT 1', (telegram_file_id,)
+        )
+        return row['sha256'] if row else None
+    
+    def get_media_usage(self):
+        """
+        获取已下载媒体文件的总大小
+        
+        Returns:
+            int: 字节数
+        """
+        row = self.fetch_one('SELECT COALESCE(SUM(size), 0) AS total FROM media_files')
+        return row['total'] if row else 0
     
     def get_message_by_id(self, message_id):
         """
@@ -128,27 +2147,59 @@ class Database:
             消息数据字典
         """
         try:
-            self.cursor.execute('SELECT * FROM messages WHERE id = ?', (message_id,))
-            row = self.cursor.fetchone()
-            if row:
-                return dict(row)
+            rows = self._fetch_across_shards('SELECT * FROM {view} WHERE id = ?', (message_id,), limit=1)
+            if rows:
+                return dict(rows[0])
             return None
         except Exception as e:
             logger.error(f"获取消息失败: {e}")
             return None
     
-    def get_messages(self, chat_id=None, sender_id=None, limit=100, offset=0):
+    def get_message_edits(self, chat_id, message_id, dedup_scope=0):
+        """
+        获取一条消息的编辑历史
+        
+        Args:
+            chat_id: 聊天ID
+            message_id: Telegram消息ID
+            dedup_scope: 去重范围，默认为0
+            
+        Returns:
+            list: 按时间先后排列的旧版本，每项包含text、media_type和被替换的时间replaced_ts
+        """
+        try:
+            rows = self.fetch_all('''
+                SELECT text, media_type, replaced_ts FROM message_edits
+                WHERE dedup_scope = ? AND chat_id = ? AND message_id = ?
+                ORDER BY id
+            ''', (dedup_scope, chat_id, message_id))
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"获取消息编辑历史失败: {e}")
+            return []
+    
+    def get_messages(self, chat_id=None, sender_id=None, limit=100, offset=0,
+                     before_date=None, before_id=None, before_ts=None, dedup_scope=None):
         """
         获取消息列表
         
+        传入before_ts（或before_date）和before_id时按游标分页，返回早于该位置的消息，
+        每页的开销与翻页深度无关；否则使用offset分页。时间缺失（date_ts为NULL）的旧消息
+        排在最后，游标位于这些消息上时before_ts为-1。
+        
         Args:
             chat_id: 聊天ID，可选
             sender_id: 发送者ID，可选
             limit: 返回条数限制，默认100
-            offset: 偏移量，默认0
+            offset: 偏移量，默认0，仅在未传入游标时使用
+            before_date: 游标位置的消息时间（ISO格式或纪元秒），可选，before_ts优先
+            before_id: 游标位置的消息ID（messages.id），可选
+            before_ts: 游标位置的消息的date_ts，-1表示该消息没有时间，可选
+            dedup_scope: 去重范围，可选；私聊的chat_id是对方的用户ID，需同时指定去重范围
+                才能区分不同账号与同一用户的会话
             
         Returns:
-            消息列表
+            消息列表，按时间正序排列
         """
         try:
             conditions = []
@@ -162,42 +2213,70 @@ class Database:
                 conditions.append('sender_id = ?')
                 params.append(sender_id)
             
+            if dedup_scope is not None:
+                conditions.append('dedup_scope = ?')
+                params.append(dedup_scope)
+            
+            if before_ts is None:
+                before_ts = to_epoch(before_date)
+            end_ts = None
+            if before_ts is not None and before_id is not None:
+                if before_ts < 0:
+                    # 已翻到没有时间的旧消息，这些消息只在主库中
+                    conditions.append('date_ts IS NULL AND id < ?')
+                    params.append(before_id)
+                    end_ts = 0
+                else:
+                    # 行值比较可以直接利用 (chat_id, date_ts, id) 索引做范围扫描；
+                    # 没有时间的消息排在最后，也在游标之后
+                    conditions.append('((date_ts, id) < (?, ?) OR date_ts IS NULL)')
+                    params.extend([before_ts, before_id])
+                    end_ts = before_ts + 1
+                offset = 0
+            
             where_clause = ''
             if conditions:
                 where_clause = 'WHERE ' + ' AND '.join(conditions)
             
+            # 每个数据源各取最新的limit + offset条，合并后再跳过offset条
             query = f'''
-            SELECT * FROM (
-                SELECT * FROM messages 
+                SELECT * FROM {{view}}
                 {where_clause}
-                ORDER BY date DESC
-                LIMIT ? OFFSET ?
-            )
-            ORDER BY date ASC
+                ORDER BY date_ts DESC, id DESC
+                LIMIT ?
             '''
-            
-            params.extend([limit, offset])
-            self.cursor.execute(query, tuple(params))
-            messages = [dict(row) for row in self.cursor.fetchall()]
+            params.append(limit + offset)
+            rows = self._fetch_across_shards(
+                query, params, end_ts=end_ts, sort_key=lambda r: (-(r['date_ts'] or 0), -r['id']),
+                limit=limit + offset, newest_first=True
+            )
+            messages = [dict(row) for row in reversed(rows[offset:])]
 
             # --- NEW: Fetch content for replied messages ---
-            reply_ids = [m['reply_to_msg_id'] for m in messages if m.get('reply_to_msg_id')]
-            if reply_ids and chat_id:
+            # 被回复的消息与回复属于同一去重范围，避免关联到其他账号与同一用户的私聊
+            reply_keys = {(m['dedup_scope'], m['reply_to_msg_id']) for m in messages if m.get('reply_to_msg_id')}
+            if reply_keys and chat_id:
+                reply_ids = sorted({message_id for _, message_id in reply_keys})
+                scopes = sorted({scope for scope, _ in reply_keys})
                 placeholders = ','.join('?' for _ in reply_ids)
-                reply_query_params = reply_ids + [chat_id]
+                scope_placeholders = ','.join('?' for _ in scopes)
+                reply_query_params = reply_ids + [chat_id] + scopes
                 reply_query = f"""
-                    SELECT message_id, text, sender_first_name, sender_username, sender_id 
-                    FROM messages 
-                    WHERE message_id IN ({placeholders}) AND chat_id = ?
+                    SELECT message_id, dedup_scope, text, sender_first_name, sender_username, sender_id 
+                    FROM {{view}} 
+                    WHERE message_id IN ({placeholders}) AND chat_id = ? AND dedup_scope IN ({scope_placeholders})
                 """
-                self.cursor.execute(reply_query, reply_query_params)
-                replied_messages_rows = self.cursor.fetchall()
+                # 被回复的消息不会晚于本页最后一条消息
+                latest_ts = max((m['date_ts'] or 0 for m in messages), default=None)
+                replied_messages_rows = self._fetch_across_shards(
+                    reply_query, reply_query_params, end_ts=latest_ts + 1 if latest_ts else None
+                )
                 
-                replied_map = {row['message_id']: dict(row) for row in replied_messages_rows}
+                replied_map = {(row['dedup_scope'], row['message_id']): dict(row) for row in replied_messages_rows}
                 
                 for msg in messages:
-                    if msg.get('reply_to_msg_id') in replied_map:
-                        original_msg = replied_map[msg['reply_to_msg_id']]
+                    original_msg = replied_map.get((msg['dedup_scope'], msg.get('reply_to_msg_id')))
+                    if original_msg:
                         sender_name = original_msg.get('sender_first_name') or original_msg.get('sender_username') or f"ID:{original_msg.get('sender_id')}"
                         msg['reply_content'] = {
                             'sender': sender_name,
@@ -210,77 +2289,321 @@ class Database:
             logger.error(f"获取消息列表失败: {e}")
             return [] 
 
-    def get_messages_for_today(self, chat_id=None):
+    def get_term_watermark(self, initial_since_ts):
         """
-        获取指定chat_id或所有聊天今天的消息文本。
+        获取已分词的最大消息ID
         
         Args:
-            chat_id (int, optional): 单个chat_id。如果为None，则获取所有消息。
+            initial_since_ts: 尚无分词记录时，从这个时间之后的消息开始分词，避免首次运行处理全部历史消息
             
         Returns:
-            str: 拼接好的所有消息文本。
+            int: 已分词的最大消息ID
         """
-        try:
-            today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
-            
-            query = """
-                SELECT text FROM messages 
-                WHERE 
-                    date(date) = ? 
-                    AND text IS NOT NULL 
-                    AND text != ''
-                    AND (media_type IS NULL OR media_type != 'MessageMediaUnsupported')
-            """
-            params = [today]
-            
-            if chat_id:
-                query += " AND chat_id = ?"
-                params.append(chat_id)
-            
-            self.cursor.execute(query, tuple(params))
+        row = self.fetch_one('SELECT last_message_id FROM term_index_state WHERE id = 1')
+        if row:
+            return row['last_message_id']
+        row = self.fetch_one('SELECT MIN(id) FROM messages WHERE date_ts >= ?', (initial_since_ts,))
+        if row[0] is not None:
+            return row[0] - 1
+        return self.fetch_one('SELECT COALESCE(MAX(id), 0) FROM messages')[0]
+    
+    def iter_texts_after(self, last_id, chunk_size=2000):
+        """
+        按ID顺序逐块读取待分词的消息
+        
+        每块单独查询（WHERE id > 上一块最大ID LIMIT chunk_size），块与块之间不占用读连接，
+        调用方分词期间不会持有读事务而阻碍WAL检查点。
+        
+        Args:
+            last_id: 已分词的最大消息ID
+            chunk_size: 每块的条数
             
-            all_texts = [row['text'] for row in self.cursor.fetchall()]
-            return " ".join(all_texts)
+        Yields:
+            list: sqlite3.Row列表，包含id、chat_id、date_ts、text和media_type
+        """
+        while True:
+            rows = self.fetch_all('''
+                SELECT id, chat_id, date_ts, COALESCE(text, text_decompress(text_z)) AS text, media_type
+                FROM messages WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, chunk_size))
+            if not rows:
+                break
+            yield rows
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1]['id']
+    
+    def save_term_counts(self, counts, last_id):
+        """
+        累加一批词频并推进分词进度，二者在同一事务中完成
+        
+        Args:
+            counts: dict，(day, chat_id, term) -> 出现次数
+            last_id: 本批处理到的最大消息ID
             
+        Returns:
+            bool: 是否保存成功
+        """
+        try:
+            with self._write_lock, self.conn:
+                self.conn.executemany('''
+                    INSERT INTO term_counts (day, chat_id, term, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(day, chat_id, term) DO UPDATE SET count = count + excluded.count
+                ''', [(day, chat_id, term, count) for (day, chat_id, term), count in counts.items()])
+                self.conn.execute('''
+                    INSERT INTO term_index_state (id, last_message_id, updated_at) VALUES (1, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        last_message_id = excluded.last_message_id, updated_at = excluded.updated_at
+                ''', (last_id, datetime.now(timezone.utc).isoformat()))
+            return True
         except Exception as e:
-            logger.error(f"获取今日消息失败 (chat_id: {chat_id}): {e}")
-            return ""
-
-    def get_messages_for_last_24_hours(self, chat_id=None):
+            logger.error(f"保存词频失败: {e}")
+            return False
+    
+    def get_top_terms(self, days, chat_id=None, limit=200):
         """
-        获取过去24小时内的消息文本。
+        合并若干天的词频，返回出现次数最多的词
         
         Args:
-            chat_id (int, optional): 单个chat_id。如果为None，则获取所有消息。
+            days: 纪元天数列表
+            chat_id: 聊天ID，为None时合并所有会话
+            limit: 返回的词数
             
         Returns:
-            str: 拼接好的所有消息文本。
+            list: (词, 次数) 列表，按次数倒序
         """
         try:
-            # SQLite's datetime function works with ISO 8601 strings directly
-            query = """
-                SELECT text FROM messages 
-                WHERE 
-                    created_at >= datetime('now', '-24 hours')
-                    AND text IS NOT NULL 
-                    AND text != ''
-                    AND (media_type IS NULL OR media_type != 'MessageMediaUnsupported')
-            """
-            params = []
-            
-            if chat_id:
-                query += " AND chat_id = ?"
+            placeholders = ','.join('?' for _ in days)
+            query = f'SELECT term, SUM(count) AS count FROM term_counts WHERE day IN ({placeholders})'
+            params = list(days)
+            if chat_id is not None:
+                query += ' AND chat_id = ?'
                 params.append(chat_id)
+            query += ' GROUP BY term ORDER BY count DESC LIMIT ?'
+            params.append(limit)
+            return [(row['term'], row['count']) for row in self.fetch_all(query, params)]
+        except Exception as e:
+            logger.error(f"获取高频词失败 (chat_id: {chat_id}): {e}")
+            return []
+    
+    def add_outbox_message(self, recipient, subject, payload):
+        """
+        把一封待发送的邮件写入发件箱
+        
+        Args:
+            recipient: 收件人，多个收件人以逗号分隔
+            subject: 邮件主题
+            payload: 完整的邮件内容（bytes）
             
-            self.cursor.execute(query, tuple(params))
+        Returns:
+            int: 发件箱记录ID，失败返回None
+        """
+        try:
+            now_ts = int(datetime.now(timezone.utc).timestamp())
+            with self._write_lock, self.conn:
+                cursor = self.conn.execute('''
+                    INSERT INTO report_outbox (recipient, subject, payload, next_attempt_ts, created_ts)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (recipient, subject, payload, now_ts, now_ts))
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"写入发件箱失败: {e}")
+            return None
+    
+    def get_due_outbox(self, limit=100):
+        """
+        获取已到重试时间的待发邮件
+        
+        Args:
+            limit: 最多返回的条数
             
-            all_texts = [row['text'] for row in self.cursor.fetchall()]
-            return " ".join(all_texts)
+        Returns:
+            list: sqlite3.Row列表，按ID顺序
+        """
+        now_ts = int(datetime.now(timezone.utc).timestamp())
+        return self.fetch_all('''
+            SELECT id, recipient, subject, payload, attempts FROM report_outbox
+            WHERE status = 'pending' AND next_attempt_ts <= ? ORDER BY id LIMIT ?
+        ''', (now_ts, limit))
+    
+    def mark_outbox_sending(self, outbox_id):
+        """
+        在发送前把邮件标记为发送中，之后不再被get_due_outbox取出重试
+        
+        Args:
+            outbox_id: 发件箱记录ID
+        """
+        with self._write_lock, self.conn:
+            self.conn.execute("UPDATE report_outbox SET status = 'sending' WHERE id = ?", (outbox_id,))
+    
+    def mark_outbox_sent(self, outbox_id):
+        """
+        删除已发送的邮件
+        
+        Args:
+            outbox_id: 发件箱记录ID
+        """
+        with self._write_lock, self.conn:
+            self.conn.execute('DELETE FROM report_outbox WHERE id = ?', (outbox_id,))
+    
+    def mark_outbox_failed(self, outbox_id, error, next_attempt_ts=None):
+        """
+        记录一次发送失败
+        
+        Args:
+            outbox_id: 发件箱记录ID
+            error: 错误信息
+            next_attempt_ts: 下次重试的纪元秒，为None时不再重试，标记为failed
+        """
+        with self._write_lock, self.conn:
+            self.conn.execute('''
+                UPDATE report_outbox SET attempts = attempts + 1, last_error = ?,
+                    status = CASE WHEN ? IS NULL THEN 'failed' ELSE 'pending' END,
+                    next_attempt_ts = COALESCE(?, next_attempt_ts)
+                WHERE id = ?
+            ''', (error, next_attempt_ts, next_attempt_ts, outbox_id))
+    
+    def get_outbox_stats(self):
+        """
+        获取发件箱中各状态的邮件数
+        
+        Returns:
+            dict: 状态 -> 邮件数，以及最早的待发邮件的创建时间
+        """
+        try:
+            stats = {'pending': 0, 'sending': 0, 'failed': 0}
+            for row in self.fetch_all('SELECT status, COUNT(*) AS count FROM report_outbox GROUP BY status'):
+                stats[row['status']] = row['count']
+            row = self.fetch_one("SELECT MIN(created_ts) FROM report_outbox WHERE status = 'pending'")
+            stats['oldest_pending_ts'] = row[0] if row else None
+            return stats
+        except Exception as e:
+            logger.error(f"获取发件箱状态失败: {e}")
+            return {}
+    
+    @staticmethod
+    def _encode_cursor(values):
+        """将分页位置编码为不透明的游标字符串"""
+        raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+    
+    @staticmethod
+    def _decode_cursor(cursor):
+        """解析游标字符串，无效时返回None"""
+        try:
+            return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except Exception:
+            return None
+    
+    def search_messages(self, query, chat_id=None, sender_id=None, date_from=None, date_to=None,
+                        media_type=None, limit=50, cursor=None, sort='rank', dedup_scope=None):
+        """
+        全文搜索消息
+        
+        关键词按空白拆分，所有关键词都需命中。关键词均不少于3个字符时使用全文索引，
+        否则（trigram无法索引过短的词）退化为LIKE扫描。
+        
+        Args:
+            query: 搜索关键词
+            chat_id: 聊天ID，可选
+            sender_id: 发送者ID，可选
+            date_from: 起始时间（ISO格式或纪元秒，包含），可选
+            date_to: 结束时间（ISO格式或纪元秒，不包含），可选
+            media_type: 媒体类型，可选；'text'表示纯文本消息
+            limit: 每页条数，默认50
+            cursor: 上一页返回的游标，可选
+            sort: 排序方式，'rank'按相关度，'date'按时间倒序
+            dedup_scope: 去重范围，可选；与chat_id一起指定某个账号的私聊
             
+        Returns:
+            dict: {'results': 消息列表, 'next_cursor': 下一页游标或None}
+        """
+        terms = query.split()
+        if not terms:
+            return {'results': [], 'next_cursor': None}
+        
+        use_fts = self.fts_enabled and all(len(t) >= 3 for t in terms)
+        if not use_fts:
+            sort = 'date'
+        
+        conditions = []
+        params = []
+        if use_fts:
+            conditions.append('messages_fts MATCH ?')
+            params.append(' '.join('"' + t.replace('"', '""') + '"' for t in terms))
+        else:
+            for term in terms:
+                conditions.append("m.text LIKE ? ESCAPE '\\'")
+                escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append(f'%{escaped}%')
+        
+        if chat_id is not None:
+            conditions.append('m.chat_id = ?')
+            params.append(chat_id)
+        if sender_id is not None:
+            conditions.append('m.sender_id = ?')
+            params.append(sender_id)
+        if dedup_scope is not None:
+            conditions.append('m.dedup_scope = ?')
+            params.append(dedup_scope)
+        start_ts = to_epoch(date_from)
+        end_ts = to_epoch(date_to)
+        if start_ts is not None:
+            conditions.append('m.date_ts >= ?')
+            params.append(start_ts)
+        if end_ts is not None:
+            conditions.append('m.date_ts < ?')
+            params.append(end_ts)
+        if media_type == 'text':
+            conditions.append("(m.media_type IS NULL OR m.media_type = '')")
+        elif media_type:
+            conditions.append('m.media_type = ?')
+            params.append(media_type)
+        
+        position = self._decode_cursor(cursor) if cursor else None
+        if sort == 'rank':
+            score_column = 'messages_fts.rank'
+            if position:
+                conditions.append(f'({score_column} > ? OR ({score_column} = ? AND m.id < ?))')
+                params.extend([position[0], position[0], position[1]])
+            order_by = f'{score_column}, m.id DESC'
+            sort_key = lambda r: (r['score'], -r['id'])
+        else:
+            score_column = 'NULL'
+            if position:
+                conditions.append('(m.date_ts, m.id) < (?, ?)')
+                params.extend([position[0], position[1]])
+            order_by = 'm.date_ts DESC, m.id DESC'
+            sort_key = lambda r: (-(r['date_ts'] or 0), -r['id'])
+        
+        from_clause = '{fts} JOIN {view} m ON m.id = messages_fts.rowid' if use_fts else '{view} m'
+        sql = f'''
+            SELECT m.*, {score_column} AS score
+            FROM {from_clause}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order_by}
+            LIMIT ?
+        '''
+        params.append(limit + 1)
+        
+        try:
+            # 各分片的相关度按各自的索引计算，合并后近似于单库的排序
+            rows = [dict(row) for row in self._fetch_across_shards(
+                sql, params, start_ts=start_ts, end_ts=end_ts, sort_key=sort_key,
+                limit=limit + 1, newest_first=sort != 'rank'
+            )]
         except Exception as e:
-            logger.error(f"获取过去24小时消息失败 (chat_id: {chat_id}): {e}")
-            return ""
-
+            logger.error(f"搜索消息失败: {e}")
+            return {'results': [], 'next_cursor': None}
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            key = last['score'] if sort == 'rank' else last['date_ts']
+            next_cursor = self._encode_cursor([key, last['id']])
+        return {'results': rows, 'next_cursor': next_cursor}
+    
     def get_chat_title(self, chat_id):
         """
         根据chat_id获取最新的聊天标题。
@@ -292,10 +2615,8 @@ class Database:
             str: 聊天标题，如果找不到则返回chat_id本身。
         """
         try:
-            query = "SELECT chat_title FROM messages WHERE chat_id = ? ORDER BY date DESC LIMIT 1"
-            self.cursor.execute(query, (chat_id,))
-            row = self.cursor.fetchone()
-            return row['chat_title'] if row and row['chat_title'] else str(chat_id)
+            row = self.fetch_one("SELECT title FROM chats WHERE chat_id = ?", (chat_id,))
+            return row['title'] if row and row['title'] else str(chat_id)
         except Exception as e:
             logger.error(f"获取聊天标题失败 (chat_id: {chat_id}): {e}")
             return str(chat_id) 
\ No newline at end of file
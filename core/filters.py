@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import OrderedDict, Counter, deque
+from threading import Lock
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from telethon.utils import get_peer_id
+from core.formatter import MessageFormatter
+
+logger = logging.getLogger(__name__)
+
+# 按会话、发送者、会话类型和媒体类型的规则，按检查顺序排列
+SET_RULES = ('chat_ids', 'sender_ids', 'chat_types', 'media_types')
+
+# 转发消息的处理方式：any不限制，deny丢弃转发消息，only只保留转发消息
+FORWARDED_MODES = ('any', 'deny', 'only')
+
+# 不带前缀的原始会话ID需写明peer类型，如 "channel:1234567"
+PEER_TYPES = {'user': PeerUser, 'chat': PeerChat, 'channel': PeerChannel}
+
+class KeywordMatcher:
+    """多关键词匹配（Aho-Corasick自动机），每条文本只扫描一遍，耗时与关键词数量无关，不区分大小写"""
+
+    def __init__(self, keywords):
+        """
+        构建自动机
+
+        Args:
+            keywords: 关键词列表
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        # 在该状态结束的关键词（含经失配链接可达的）中最长的一个
+        self._output = [None]
+        for keyword in keywords:
+            node = 0
+            for char in keyword.lower():
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                node = next_node
+            if self._output[node] is None or len(keyword) > len(self._output[node]):
+                self._output[node] = keyword
+        # 按广度优先计算失配链接
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, next_node in self._goto[node].items():
+                pending.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[next_node] = target if target != next_node else 0
+                if self._output[next_node] is None:
+                    self._output[next_node] = self._output[self._fail[next_node]]
+
+    def search(self, text):
+        """
+        查找文本中出现的关键词
+
+        Args:
+            text: 文本
+
+        Returns:
+            str: 最先出现的一个关键词，没有时返回None
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for char in text.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node] is not None:
+                return output[node]
+        return None
+
+class IngestFilter:
+    """入库过滤器：启动时把规则编译成集合和正则，在提取消息数据之前判断是否接收消息"""
+
+    def __init__(self, allow=None, deny=None, forwarded='any', deny_keywords=None):
+        """
+        初始化过滤器
+
+        Args:
+            allow: 白名单，键为SET_RULES中的规则名，值为列表；非空时只接收列表中的值
+            deny: 黑名单，格式同allow；命中时丢弃消息
+            forwarded: 转发消息的处理方式，见FORWARDED_MODES
+            deny_keywords: 关键词黑名单，消息文本包含任一关键词（不区分大小写）时丢弃
+        """
+        if forwarded not in FORWARDED_MODES:
+            raise ValueError(f"未知的转发过滤方式: {forwarded}")
+        allow = allow or {}
+        deny = deny or {}
+        self.allow = {rule: self._compile_set(rule, allow.get(rule)) for rule in SET_RULES if allow.get(rule)}
+        self.deny = {rule: self._compile_set(rule, deny.get(rule)) for rule in SET_RULES if deny.get(rule)}
+        self.forwarded = forwarded
+        self.keywords = sorted({k for k in deny_keywords or [] if k})
+        self.keyword_matcher = KeywordMatcher(self.keywords) if self.keywords else None
+        self._lock = Lock()
+        self._hits = {'accepted': 0, 'errors': 0}
+        for rule in self.allow:
+            self._hits[f'allow_{rule}'] = 0
+        for rule in self.deny:
+            self._hits[f'deny_{rule}'] = 0
+        if forwarded != 'any':
+            self._hits['forwarded'] = 0
+        if self.keyword_matcher:
+            self._hits['deny_keywords'] = 0
+        # 每条黑名单规则（会话、发送者等的某个值，或某个关键词）的命中次数
+        self._rule_hits = Counter()
+
+    @staticmethod
+    def _marked_chat_id(value):
+        """
+        把配置中的会话ID转换为消息中使用的带标记ID（用户为正数，普通群组为负数，频道和超级群组带-100前缀）
+
+        Args:
+            value: 带标记的ID，或 "类型:原始ID" 形式的字符串，类型为PEER_TYPES中的键
+
+        Returns:
+            int: 带标记的会话ID
+        """
+        if isinstance(value, str) and ':' in value:
+            peer_type, raw_id = value.split(':', 1)
+            peer_class = PEER_TYPES.get(peer_type.strip().lower())
+            if peer_class is None:
+                raise ValueError(f"未知的会话类型: {peer_type}")
+            return get_peer_id(peer_class(int(raw_id)))
+        return int(value)
+
+    @classmethod
+    def _compile_set(cls, rule, values):
+        """把规则值编译成集合，会话ID统一转换为带标记的ID，避免不同类型的会话因原始ID相同而混淆"""
+        if rule == 'chat_ids':
+            return frozenset(cls._marked_chat_id(v) for v in values)
+        if rule == 'sender_ids':
+            return frozenset(int(v) for v in values)
+        return frozenset(str(v).lower() for v in values)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        根据配置创建过滤器，兼容旧的filter_chat_ids和filter_sender_ids配置
+
+        Args:
+            config: 配置对象
+
+        Returns:
+            IngestFilter实例
+        """
+        filter_config = config.get('filters', {})
+        allow = {rule: filter_config.get(f'allow_{rule}', []) for rule in SET_RULES}
+        deny = {rule: list(filter_config.get(f'deny_{rule}', [])) for rule in SET_RULES}
+        deny['chat_ids'] += config.get('filter_chat_ids', [])
+        deny['sender_ids'] += config.get('filter_sender_ids', [])
+        ingest_filter = cls(
+            allow=allow,
+            deny=deny,
+            forwarded=filter_config.get('forwarded', 'any'),
+            deny_keywords=filter_config.get('deny_keywords', [])
+        )
+        logger.info(f"入库过滤规则已加载: {ingest_filter.describe()}")
+        return ingest_filter
+
+    def describe(self):
+        """
+        获取规则摘要
+
+        Returns:
+            str: 各规则的条目数
+        """
+        parts = [f"allow_{rule}={len(values)}" for rule, values in self.allow.items()]
+        parts += [f"deny_{rule}={len(values)}" for rule, values in self.deny.items()]
+        if self.forwarded != 'any':
+            parts.append(f"forwarded={self.forwarded}")
+        if self.keywords:
+            parts.append(f"deny_keywords={len(self.keywords)}")
+        return ', '.join(parts) or '无'
+
+    @staticmethod
+    def _chat_type(message):
+        """根据消息的peer类型判断会话类型，不需要获取会话实体"""
+        if message.is_private:
+            return 'private'
+        if message.is_channel:
+            return 'supergroup' if message.is_group else 'channel'
+        return 'group'
+
+    @staticmethod
+    def _media_kind(message):
+        """获取媒体类型，文档类型去掉文件名"""
+        media_type = MessageFormatter.get_media_type(message.media)
+        if media_type is None:
+            return None
+        return media_type.split(':', 1)[0].lower()
+
+    def _rule_value(self, rule, message):
+        """获取消息在某条规则下的取值"""
+        if rule == 'chat_ids':
+            return message.chat_id
+        if rule == 'sender_ids':
+            return message.sender_id
+        if rule == 'chat_types':
+            return self._chat_type(message)
+        return self._media_kind(message)
+
+    def _reject(self, rule, value=None):
+        """记录一次规则命中，value为命中的具体规则值（会话ID、关键词等）"""
+        with self._lock:
+            self._hits[rule] += 1
+            if value is not None:
+                self._rule_hits[f'{rule}:{value}'] += 1
+        logger.debug(f"消息被过滤规则 {rule} 丢弃")
+        return False
+
+    def accepts(self, message):
+        """
+        判断是否接收一条消息
+
+        Args:
+            message: Telethon消息对象
+
+        Returns:
+            bool: 是否接收，判断出错时接收
+        """
+        try:
+            for rule in SET_RULES:
+                allowed = self.allow.get(rule)
+                denied = self.deny.get(rule)
+                if allowed is None and denied is None:
+                    continue
+                value = self._rule_value(rule, message)
+                if allowed is not None and value not in allowed:
+                    return self._reject(f'allow_{rule}')
+                if denied is not None and value in denied:
+                    return self._reject(f'deny_{rule}', value)
+
+            if self.forwarded != 'any':
+                is_forwarded = message.fwd_from is not None
+                if is_forwarded != (self.forwarded == 'only'):
+                    return self._reject('forwarded')
+
+            if self.keyword_matcher and message.message:
+                keyword = self.keyword_matcher.search(message.message)
+                if keyword is not None:
+                    return self._reject('deny_keywords', keyword)
+        except Exception as e:
+            logger.error(f"执行过滤规则时出错: {e}")
+            with self._lock:
+                self._hits['errors'] += 1
+
+        with self._lock:
+            self._hits['accepted'] += 1
+        return True
+
+    def stats(self):
+        """
+        获取各规则的命中次数
+
+        Returns:
+            dict: 规则名 -> 丢弃的消息数，以及接收的消息数；rule_hits为命中最多的100条黑名单规则（"规则名:值" -> 丢弃的消息数）
+        """
+        with self._lock:
+            stats = dict(self._hits)
+            stats['rule_hits'] = dict(self._rule_hits.most_common(100))
+            return stats
+
+class RecentMessages:
+    """最近收到的消息键集合，用于丢弃多个账号重复收到的同一条消息"""
+
+    def __init__(self, max_size=100000):
+        """
+        初始化集合
+
+        Args:
+            max_size: 最多记住的消息数，超出时淘汰最早的记录
+        """
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = Lock()
+        self.duplicates = 0
+
+    def add(self, key):
+        """
+        记录一条消息
+
+        Args:
+            key: 消息键，如 (去重范围, 会话ID, 消息ID)
+
+        Returns:
+            bool: 是否为首次出现，已出现过时返回False
+        """
+        with self._lock:
+            if key in self._keys:
+                self.duplicates += 1
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def stats(self):
+        """
+        获取去重指标
+
+        Returns:
+            dict: 记住的消息数和丢弃的重复消息数
+        """
+        with self._lock:
+            return {'size': len(self._keys), 'duplicates': self.duplicates}
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
 import datetime
 import logging
+from collections import OrderedDict
+from threading import Lock
 from colorama import init, Fore, Back, Style
 from zoneinfo import ZoneInfo
 
@@ -12,9 +15,91 @@ init(autoreset=True)
 
 logger = logging.getLogger(__name__)
 
+class EntityCache:
+    """会话和用户信息缓存（LRU + TTL），按peer ID保存已解析的类型、标题、用户名和姓名"""
+
+    def __init__(self, max_size=5000, ttl=3600):
+        """
+        初始化缓存
+
+        Args:
+            max_size: 最多缓存的条目数，超出时淘汰最久未使用的条目
+            ttl: 条目有效期（秒）
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """
+        读取一个条目
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            dict: 缓存的信息，不存在或已过期时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        """写入一个条目"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, peer_id):
+        """
+        使某个peer的会话和用户信息失效
+
+        Args:
+            peer_id: 会话或用户ID
+        """
+        with self._lock:
+            for key in (('chat', peer_id), ('user', peer_id)):
+                if self._entries.pop(key, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        获取缓存指标
+
+        Returns:
+            dict: 命中、未命中、淘汰和失效次数，条目数及命中率
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
 class MessageFormatter:
     """消息格式化类"""
     
+    # 会话和发送者信息缓存，由所有提取调用共享
+    entity_cache = EntityCache()
+    
     CHAT_TYPE_COLORS = {
         'private': Back.BLUE,
         'group': Back.GREEN,
@@ -126,6 +211,143 @@ class MessageFormatter:
         else:
             return f"ID:{sender_id}" if sender_id else "Unknown"
     
+    @classmethod
+    def configure_cache(cls, config):
+        """
+        根据配置重建会话和发送者信息缓存
+
+        Args:
+            config: 配置对象
+        """
+        cache_config = config.get('entity_cache', {})
+        cls.entity_cache = EntityCache(
+            max_size=cache_config.get('max_size', 5000),
+            ttl=cache_config.get('ttl', 3600)
+        )
+    
+    @staticmethod
+    def _resolve_chat(chat):
+        """从会话实体中解析ID、类型和标题"""
+        chat_id = chat.id
+        
+        # 确定聊天类型
+        chat_type = 'private'  # 默认为私聊
+        if hasattr(chat, 'type'):
+            chat_type = chat.type
+        elif hasattr(chat, 'megagroup') and chat.megagroup:
+            chat_type = 'supergroup'
+        elif hasattr(chat, 'gigagroup') and chat.gigagroup:
+            chat_type = 'supergroup'
+        elif hasattr(chat, 'broadcast') and chat.broadcast:
+            chat_type = 'channel'
+        elif hasattr(chat, 'is_group') and chat.is_group:
+            chat_type = 'group'
+        
+        # 确定聊天标题
+        chat_title = None
+        if hasattr(chat, 'title') and chat.title:
+            chat_title = chat.title
+        elif hasattr(chat, 'first_name'):
+            chat_title = chat.first_name
+            if hasattr(chat, 'last_name') and chat.last_name:
+                chat_title += f" {chat.last_name}"
+        else:
+            chat_title = f"Chat {chat_id}"
+        
+        return {
+            'chat_id': chat_id,
+            'chat_title': chat_title,
+            'chat_type': chat_type
+        }
+    
+    @staticmethod
+    def _resolve_sender(sender):
+        """从用户实体中解析ID、用户名和姓名"""
+        return {
+            'sender_id': sender.id,
+            'sender_username': getattr(sender, 'username', ''),
+            'sender_first_name': getattr(sender, 'first_name', ''),
+            'sender_last_name': getattr(sender, 'last_name', '')
+        }
+    
+    @staticmethod
+    def _get_chat_info(message):
+        """获取消息所在会话的信息，优先读取缓存"""
+        key = ('chat', message.chat_id)
+        if message.chat_id is not None:
+            chat_info = MessageFormatter.entity_cache.get(key)
+            if chat_info is not None:
+                return chat_info
+        if not message.chat:
+            return None
+        chat_info = MessageFormatter._resolve_chat(message.chat)
+        if message.chat_id is not None:
+            MessageFormatter.entity_cache.put(key, chat_info)
+        return chat_info
+    
+    @staticmethod
+    def _get_sender_info(message):
+        """获取消息发送者的信息，优先读取缓存"""
+        key = ('user', message.sender_id)
+        if message.sender_id is not None:
+            sender_info = MessageFormatter.entity_cache.get(key)
+            if sender_info is not None:
+                return sender_info
+        if not message.sender:
+            return None
+        sender_info = MessageFormatter._resolve_sender(message.sender)
+        if message.sender_id is not None:
+            MessageFormatter.entity_cache.put(key, sender_info)
+        return sender_info
+    
+    @staticmethod
+    def _get_forward_name(forward):
+        """获取转发来源的名称，优先读取缓存"""
+        key = ('user', forward.sender_id)
+        sender_info = None
+        if forward.sender_id is not None:
+            sender_info = MessageFormatter.entity_cache.get(key)
+        if sender_info is None:
+            if not forward.sender:
+                return "Unknown"
+            sender_info = MessageFormatter._resolve_sender(forward.sender)
+            if forward.sender_id is not None:
+                MessageFormatter.entity_cache.put(key, sender_info)
+        return sender_info['sender_username'] or sender_info['sender_first_name'] or str(sender_info['sender_id'])
+    
+    @staticmethod
+    def get_media_type(media):
+        """
+        获取媒体类型名称
+        
+        Args:
+            media: Telethon消息的media属性
+            
+        Returns:
+            str: 媒体类型，如Photo、Video、Audio、Image、Document: 文件名，或媒体类名；没有媒体时返回None
+        """
+        if not media:
+            return None
+        media_type = media.__class__.__name__
+        if media_type == "MessageMediaUnsupported":
+            return media_type
+        
+        # 处理其他类型的媒体，尝试获取更多信息
+        if hasattr(media, 'photo'):
+            return 'Photo'
+        if hasattr(media, 'document'):
+            doc = media.document
+            mime_type = getattr(doc, 'mime_type', '')
+            if 'video' in mime_type:
+                return 'Video'
+            if 'audio' in mime_type or 'voice' in mime_type:
+                return 'Audio'
+            if 'image' in mime_type:
+                return 'Image'
+            file_name = getattr(doc, 'attributes', [{}])[0].file_name if doc.attributes else ''
+            return f'Document{": " + file_name if file_name else ""}'
+        return media_type
+    
     @staticmethod
     def extract_message_data(message):
         """
@@ -147,85 +369,25 @@ class MessageFormatter:
             }
             
             # 添加聊天信息
-            if message.chat:
-                chat_id = message.chat.id
-                
-                # 确定聊天类型
-                chat_type = 'private'  # 默认为私聊
-                if hasattr(message.chat, 'type'):
-                    chat_type = message.chat.type
-                elif hasattr(message.chat, 'megagroup') and message.chat.megagroup:
-                    chat_type = 'supergroup'
-                elif hasattr(message.chat, 'gigagroup') and message.chat.gigagroup:
-                    chat_type = 'supergroup'
-                elif hasattr(message.chat, 'broadcast') and message.chat.broadcast:
-                    chat_type = 'channel'
-                elif hasattr(message.chat, 'is_group') and message.chat.is_group:
-                    chat_type = 'group'
-                
-                # 确定聊天标题
-                chat_title = None
-                if hasattr(message.chat, 'title') and message.chat.title:
-                    chat_title = message.chat.title
-                elif hasattr(message.chat, 'first_name'):
-                    chat_title = message.chat.first_name
-                    if hasattr(message.chat, 'last_name') and message.chat.last_name:
-                        chat_title += f" {message.chat.last_name}"
-                else:
-                    chat_title = f"Chat {chat_id}"
-                
-                message_data.update({
-                    'chat_id': chat_id,
-                    'chat_title': chat_title,
-                    'chat_type': chat_type
-                })
+            chat_info = MessageFormatter._get_chat_info(message)
+            if chat_info:
+                message_data.update(chat_info)
             
             # 添加发送者信息
-            if message.sender:
-                sender = message.sender
-                message_data.update({
-                    'sender_id': sender.id,
-                    'sender_username': getattr(sender, 'username', ''),
-                    'sender_first_name': getattr(sender, 'first_name', ''),
-                    'sender_last_name': getattr(sender, 'last_name', '')
-                })
+            sender_info = MessageFormatter._get_sender_info(message)
+            if sender_info:
+                message_data.update(sender_info)
             
             # 检查媒体类型
-            if message.media:
-                message_data['media_type'] = message.media.__class__.__name__
-                
+            message_data['media_type'] = MessageFormatter.get_media_type(message.media)
+            if message_data['media_type'] == "MessageMediaUnsupported" and not message_data['text']:
                 # 如果是不支持的媒体，尝试添加描述
-                if message.media.__class__.__name__ == "MessageMediaUnsupported":
-                    if not message_data['text']:
-                        message_data['text'] = "[不支持的媒体内容]"
-                
-                # 处理其他类型的媒体，尝试获取更多信息
-                elif hasattr(message.media, 'photo'):
-                    message_data['media_type'] = 'Photo'
-                elif hasattr(message.media, 'document'):
-                    doc = message.media.document
-                    mime_type = getattr(doc, 'mime_type', '')
-                    if 'video' in mime_type:
-                        message_data['media_type'] = 'Video'
-                    elif 'audio' in mime_type or 'voice' in mime_type:
-                        message_data['media_type'] = 'Audio'
-                    elif 'image' in mime_type:
-                        message_data['media_type'] = 'Image'
-                    else:
-                        file_name = getattr(doc, 'attributes', [{}])[0].file_name if doc.attributes else ''
-                        message_data['media_type'] = f'Document{": " + file_name if file_name else ""}'
-            else:
-                message_data['media_type'] = None
+                message_data['text'] = "[不支持的媒体内容]"
             
             # 检查转发信息
             message_data['is_forwarded'] = message.forward is not None
             if message.forward:
-                forward_sender = message.forward.sender
-                if forward_sender:
-                    forward_name = getattr(forward_sender, 'username', '') or getattr(forward_sender, 'first_name', '') or str(forward_sender.id)
-                else:
-                    forward_name = "Unknown"
-                message_data['forward_from'] = forward_name
+                message_data['forward_from'] = MessageFormatter._get_forward_name(message.forward)
             else:
                 message_data['forward_from'] = None
             
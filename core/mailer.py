@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import smtplib
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+class ReportMailer:
+    """报告邮件发送：邮件先写入发件箱再发送，每个发送线程复用一个已登录的SMTP连接，失败的邮件按退避时间重试
+
+    每封邮件发送前在发件箱中标记为sending，只有发送失败的邮件会被重新标记为pending并重试；
+    发送途中进程退出或发送后未能删除记录时，邮件保持sending状态，不会被重发。
+    """
+
+    def __init__(self, db, smtp_config, max_attempts=6, retry_base_seconds=60, retry_max_seconds=3600):
+        """
+        初始化发送器
+
+        Args:
+            db: 数据库实例
+            smtp_config: SMTP设置，包括host、port、use_tls、username、password和timeout
+            max_attempts: 每封邮件最多发送的次数，之后标记为failed
+            retry_base_seconds: 第一次重试的等待秒数，之后每次加倍
+            retry_max_seconds: 重试等待的上限（秒）
+        """
+        self.db = db
+        self.smtp_config = smtp_config
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+        # 未能写入发件箱的发送结果：记录ID -> None（已发送）或(错误信息, 下次重试时间)，重试发件箱前补写
+        self._unmarked = {}
+        self._stats = {'sent': 0, 'failed': 0, 'connections': 0}
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        根据配置创建发送器
+
+        Args:
+            config: 配置对象
+            db: 数据库实例
+
+        Returns:
+            ReportMailer实例
+        """
+        report_config = config.get('daily_report', {})
+        return cls(
+            db,
+            config.get('smtp_settings', {}),
+            max_attempts=report_config.get('outbox_max_attempts', 6),
+            retry_base_seconds=report_config.get('outbox_retry_base_seconds', 60),
+            retry_max_seconds=report_config.get('outbox_retry_max_seconds', 3600)
+        )
+
+    @property
+    def sender(self):
+        """发件人地址"""
+        return self.smtp_config.get('username')
+
+    def _connect(self):
+        """建立并登录一个SMTP连接"""
+        server = smtplib.SMTP(self.smtp_config.get('host'), self.smtp_config.get('port'),
+                              timeout=self.smtp_config.get('timeout', 60))
+        if self.smtp_config.get('use_tls', True):
+            server.starttls()
+        server.login(self.smtp_config.get('username'), self.smtp_config.get('password'))
+        with self._lock:
+            self._sessions.append(server)
+            self._stats['connections'] += 1
+        return server
+
+    def _session(self):
+        """获取当前线程的SMTP连接，尚未连接时建立连接"""
+        server = getattr(self._local, 'server', None)
+        if server is None:
+            server = self._local.server = self._connect()
+        return server
+
+    def _drop_session(self):
+        """丢弃当前线程的SMTP连接"""
+        server = getattr(self._local, 'server', None)
+        self._local.server = None
+        if server is not None:
+            with self._lock:
+                if server in self._sessions:
+                    self._sessions.remove(server)
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _transmit(self, recipient, payload):
+        """通过当前线程的连接发送一封邮件，连接已被服务器关闭时重连一次"""
+        recipients = [r.strip() for r in recipient.split(',') if r.strip()]
+        try:
+            self._session().sendmail(self.sender, recipients, payload)
+        except smtplib.SMTPServerDisconnected:
+            self._drop_session()
+            self._session().sendmail(self.sender, recipients, payload)
+
+    def _retry_delay(self, attempts):
+        """第attempts次失败后的重试等待秒数"""
+        return min(self.retry_base_seconds * 2 ** (attempts - 1), self.retry_max_seconds)
+
+    def _mark(self, outbox_id, result):
+        """
+        把一次发送结果写入发件箱，失败时只记录日志，留到下次重试发件箱前补写
+
+        Args:
+            outbox_id: 发件箱记录ID
+            result: None表示已发送；否则为(错误信息, 下次重试的纪元秒或None)
+        """
+        try:
+            if result is None:
+                self.db.mark_outbox_sent(outbox_id)
+            else:
+                self.db.mark_outbox_failed(outbox_id, *result)
+        except Exception as e:
+            logger.error(f"更新发件箱状态失败 (发件箱ID: {outbox_id}): {e}")
+            with self._lock:
+                self._unmarked[outbox_id] = result
+            return False
+        with self._lock:
+            self._unmarked.pop(outbox_id, None)
+        return True
+
+    def _deliver(self, outbox_id, recipient, payload, attempts):
+        """发送发件箱中的一封邮件并更新其状态，返回是否发送成功"""
+        # 先持久化发送中状态，进程在发送途中退出时该邮件不会被再次发送
+        try:
+            self.db.mark_outbox_sending(outbox_id)
+        except Exception as e:
+            logger.error(f"无法标记邮件为发送中，留待下次重试 (发件箱ID: {outbox_id}): {e}")
+            with self._lock:
+                self._stats['failed'] += 1
+            return False
+        try:
+            self._transmit(recipient, payload)
+        except Exception as e:
+            # 服务器拒收时连接仍可用（smtplib已发送RSET），其他错误下连接可能处于未知状态，下次发送时重新连接
+            if not isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                self._drop_session()
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self._mark(outbox_id, (str(e), None))
+                logger.error(f"发送邮件失败，已达到重试上限 {self.max_attempts} 次 (发件箱ID: {outbox_id}): {e}")
+            else:
+                delay = self._retry_delay(attempts)
+                next_attempt_ts = int(datetime.now(timezone.utc).timestamp()) + delay
+                self._mark(outbox_id, (str(e), next_attempt_ts))
+                logger.error(f"发送邮件失败，{delay} 秒后重试 (发件箱ID: {outbox_id}): {e}")
+            with self._lock:
+                self._stats['failed'] += 1
+            return False
+        # 邮件已发出，删除记录失败时仍按发送成功处理；记录保持sending状态，不会被重发
+        self._mark(outbox_id, None)
+        with self._lock:
+            self._stats['sent'] += 1
+        return True
+
+    def send(self, msg):
+        """
+        写入发件箱并立即发送一封邮件
+
+        Args:
+            msg: email.message.Message对象，需包含To和Subject
+
+        Returns:
+            bool: 是否发送成功；失败的邮件留在发件箱中等待重试
+        """
+        if not msg['From']:
+            msg['From'] = self.sender
+        payload = msg.as_bytes()
+        outbox_id = self.db.add_outbox_message(msg['To'], msg['Subject'], payload)
+        if outbox_id is None:
+            # 发件箱不可用时仍尝试直接发送
+            try:
+                self._transmit(msg['To'], payload)
+                return True
+            except Exception as e:
+                self._drop_session()
+                logger.error(f"发送邮件失败: {e}")
+                return False
+        return self._deliver(outbox_id, msg['To'], payload, 0)
+
+    def flush_outbox(self, limit=100):
+        """
+        重试发件箱中已到重试时间的邮件，全部复用一个连接
+
+        Args:
+            limit: 本次最多重试的邮件数
+
+        Returns:
+            int: 本次发送成功的邮件数
+        """
+        sent = 0
+        try:
+            self._flush_unmarked()
+            rows = self.db.get_due_outbox(limit)
+            for row in rows:
+                if self._deliver(row['id'], row['recipient'], row['payload'], row['attempts']):
+                    sent += 1
+            if rows:
+                logger.info(f"发件箱重试完成: 成功 {sent}/{len(rows)} 封")
+        except Exception as e:
+            logger.error(f"重试发件箱邮件失败: {e}")
+        finally:
+            self.close()
+        return sent
+
+    def _flush_unmarked(self):
+        """补写之前未能写入发件箱的发送结果"""
+        with self._lock:
+            pending = list(self._unmarked.items())
+        for outbox_id, result in pending:
+            self._mark(outbox_id, result)
+
+    def close(self):
+        """关闭所有SMTP连接"""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for server in sessions:
+            try:
+                server.quit()
+            except Exception:
+                try:
+                    server.close()
+                except Exception:
+                    pass
+        # 各线程缓存的连接已关闭，下次使用时重新连接
+        self._local = threading.local()
+
+    def stats(self):
+        """
+        获取发送指标
+
+        Returns:
+            dict: 发送成功和失败的次数、建立的连接数，以及发件箱中各状态的邮件数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['outbox'] = self.db.get_outbox_stats()
+        return stats
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+from threading import Lock
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+class MaintenanceJob:
+    """数据库维护任务：按保留策略分批删除过期数据，然后回收空间并更新查询统计信息"""
+
+    def __init__(self, db, retention_days=0, chat_retention_days=None, media_retention_days=None,
+                 edit_retention_days=0, rollup_retention_days=0, batch_size=2000, batch_pause_ms=50,
+                 vacuum_pages=1000, shard_config=None, compression_config=None, media_dir=None):
+        """
+        初始化维护任务
+
+        保留天数为0表示永久保留。
+
+        Args:
+            db: 数据库实例
+            retention_days: 消息的默认保留天数
+            chat_retention_days: 各会话的保留天数，覆盖默认值
+            media_retention_days: 各媒体类型（如photo、video、document，text表示纯文本）的保留天数，
+                                  与会话的保留天数同时生效，先到期的为准
+            edit_retention_days: 编辑历史的保留天数，按被替换的时间计算
+            rollup_retention_days: 按小时统计表的保留天数，可以长于消息的保留天数
+            batch_size: 每批删除的条数
+            batch_pause_ms: 两批之间的间隔（毫秒），让出写连接给消息写入
+            vacuum_pages: 每次增量回收的页数
+            shard_config: 分片设置，非空时在清理前先把较早月份的消息归档到分片
+            compression_config: 文本压缩设置，非空时在清理后压缩较早的消息文本
+            media_dir: 媒体目录，非空时删除不再被任何消息引用的媒体文件
+        """
+        self.db = db
+        self.retention_days = retention_days
+        self.chat_retention_days = {int(k): v for k, v in (chat_retention_days or {}).items()}
+        self.media_retention_days = {k.lower(): v for k, v in (media_retention_days or {}).items()}
+        self.edit_retention_days = edit_retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000.0
+        self.vacuum_pages = vacuum_pages
+        self.shard_config = shard_config
+        self.compression_config = compression_config
+        self.media_dir = media_dir
+        self._lock = Lock()
+        self._running = False
+        self._last_report = None
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        根据配置创建维护任务
+
+        Args:
+            config: 配置对象
+            db: 数据库实例
+
+        Returns:
+            MaintenanceJob实例
+        """
+        maintenance_config = config.get('maintenance', {})
+        shard_config = None
+        if maintenance_config.get('archive_shards', False):
+            shard_config = config.get('database', {}).get('shards', {})
+        compression_config = config.get('compression', {})
+        return cls(
+            db,
+            retention_days=maintenance_config.get('retention_days', 0),
+            chat_retention_days=maintenance_config.get('chat_retention_days', {}),
+            media_retention_days=maintenance_config.get('media_retention_days', {}),
+            edit_retention_days=maintenance_config.get('edit_retention_days', 0),
+            rollup_retention_days=maintenance_config.get('rollup_retention_days', 0),
+            batch_size=maintenance_config.get('batch_size', 2000),
+            batch_pause_ms=maintenance_config.get('batch_pause_ms', 50),
+            vacuum_pages=maintenance_config.get('vacuum_pages', 1000),
+            shard_config=shard_config,
+            compression_config=compression_config if compression_config.get('enabled', False) else None,
+            media_dir=config.get('media', {}).get('dir', 'media')
+        )
+
+    def _message_rules(self, now_ts):
+        """
+        生成消息的删除规则
+
+        Returns:
+            list: (规则名, 筛选条件, 条件参数)
+        """
+        rules = []
+        for chat_id, days in self.chat_retention_days.items():
+            if days:
+                rules.append((f'chat:{chat_id}', 'chat_id = ? AND date_ts < ?', (chat_id, now_ts - days * DAY)))
+        if self.retention_days:
+            where = 'date_ts < ?'
+            params = (now_ts - self.retention_days * DAY,)
+            if self.chat_retention_days:
+                where += f" AND chat_id NOT IN ({','.join('?' for _ in self.chat_retention_days)})"
+                params = (*params, *self.chat_retention_days)
+            rules.append(('default', where, params))
+        for media_type, days in self.media_retention_days.items():
+            if not days:
+                continue
+            cutoff = now_ts - days * DAY
+            if media_type == 'text':
+                rules.append(("media:text", "date_ts < ? AND (media_type IS NULL OR media_type = '')", (cutoff,)))
+            else:
+                # 文档类型的media_type带有文件名，如 "Document: a.pdf"
+                rules.append((
+                    f'media:{media_type}',
+                    'date_ts < ? AND (LOWER(media_type) = ? OR LOWER(media_type) LIKE ?)',
+                    (cutoff, media_type, media_type + ':%')
+                ))
+        return rules
+
+    def _purge(self, delete_batch, *args):
+        """分批删除直到没有符合条件的行，两批之间暂停，返回删除的总数"""
+        total = 0
+        while True:
+            deleted = delete_batch(*args, batch_size=self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            time.sleep(self.batch_pause)
+
+    def _expired_shards(self, now_ts):
+        """获取全部消息都已超过保留期的分片，有会话的保留期更长时不整月删除"""
+        if not self.retention_days:
+            return []
+        if any(not days or days > self.retention_days for days in self.chat_retention_days.values()):
+            return []
+        cutoff = now_ts - self.retention_days * DAY
+        return [shard['month'] for shard in self.db.get_shards() if shard['max_ts'] is not None and shard['max_ts'] < cutoff]
+
+    def _purge_shards(self, rules, report):
+        """
+        对未整月删除的分片执行删除规则：未冻结的分片分批删除，冻结的分片整体重写
+
+        Returns:
+            int: 重写冻结分片减少的字节数
+        """
+        shard_bytes = 0
+        for shard in self.db.get_shards():
+            if not shard['row_count']:
+                continue
+            month = shard['month']
+            try:
+                if shard['frozen']:
+                    deleted, saved = self.db.rewrite_frozen_shard(month, rules, self.batch_size)
+                    shard_bytes += saved
+                else:
+                    deleted = {
+                        name: self._purge(self.db.delete_shard_messages_batch, month, where, params)
+                        for name, where, params in rules
+                    }
+            except Exception as e:
+                logger.error(f"按保留策略删除分片中的消息失败 ({month}): {e}")
+                report['errors'].append(f'shard:{month}')
+                continue
+            for name, count in deleted.items():
+                report['deleted'][name] = report['deleted'].get(name, 0) + count
+        return shard_bytes
+
+    def _purge_media(self, report):
+        """删除不再被任何消息引用的媒体文件记录和文件"""
+        while True:
+            orphans = self.db.delete_orphan_media(self.batch_size)
+            for path, size in orphans:
+                try:
+                    os.remove(os.path.join(self.media_dir, path))
+                    report['media_files_deleted'] += 1
+                    report['media_bytes_deleted'] += size or 0
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"删除媒体文件失败 ({path}): {e}")
+            if len(orphans) < self.batch_size:
+                return
+            time.sleep(self.batch_pause)
+
+    def run(self):
+        """
+        执行一次维护：归档、按保留策略删除、压缩较早的文本、回收空间、更新统计信息
+
+        Returns:
+            dict: 维护报告，包含各规则删除的条数和回收的空间；已有维护在执行时返回None
+        """
+        with self._lock:
+            if self._running:
+                logger.warning("上一次数据库维护尚未结束，本次跳过")
+                return None
+            self._running = True
+        started = time.monotonic()
+        now_ts = int(datetime.now(timezone.utc).timestamp())
+        report = {'deleted': {}, 'edits_deleted': 0, 'rollups_deleted': 0, 'shards_dropped': [],
+                  'media_files_deleted': 0, 'media_bytes_deleted': 0, 'errors': []}
+        try:
+            before = self.db.get_storage_stats()
+
+            if self.shard_config is not None:
+                self.db.archive_shards(
+                    keep_months=self.shard_config.get('keep_months', 1),
+                    freeze_after_months=self.shard_config.get('freeze_after_months', 3),
+                    batch_size=self.shard_config.get('batch_size', 5000)
+                )
+
+            # 先整月删除全部过期的分片，其余分片和主库一样逐条按规则删除
+            shard_bytes = 0
+            for month in self._expired_shards(now_ts):
+                shard_bytes += self.db.drop_shard(month)
+                report['shards_dropped'].append(month)
+
+            rules = self._message_rules(now_ts)
+            for name, where, params in rules:
+                try:
+                    report['deleted'][name] = self._purge(self.db.delete_messages_batch, where, params)
+                except Exception as e:
+                    logger.error(f"按保留策略删除消息失败 ({name}): {e}")
+                    report['errors'].append(name)
+            if rules:
+                shard_bytes += self._purge_shards(rules, report)
+
+            if self.media_dir:
+                try:
+                    self._purge_media(report)
+                except Exception as e:
+                    logger.error(f"删除无引用的媒体文件失败: {e}")
+                    report['errors'].append('media')
+
+            if self.edit_retention_days:
+                report['edits_deleted'] = self._purge(self.db.delete_edits_batch, now_ts - self.edit_retention_days * DAY)
+            if self.rollup_retention_days:
+                report['rollups_deleted'] = self.db.delete_rollups_before(now_ts - self.rollup_retention_days * DAY)
+
+            if self.compression_config is not None:
+                report['compression'] = self.db.compress_cold_text(
+                    min_age_days=self.compression_config.get('min_age_days', 30),
+                    codec=self.compression_config.get('codec', 'zlib'),
+                    level=self.compression_config.get('level', 6),
+                    batch_size=self.batch_size,
+                    sample_size=self.compression_config.get('sample_size', 5000),
+                    dictionary_size=self.compression_config.get('dictionary_size', 32768)
+                )
+
+            if before['auto_vacuum'] == 2:
+                pages = 0
+                while True:
+                    freed = self.db.incremental_vacuum(self.vacuum_pages)
+                    pages += freed
+                    if freed < self.vacuum_pages:
+                        break
+                    time.sleep(self.batch_pause)
+                report['pages_vacuumed'] = pages
+            else:
+                logger.warning("数据库未启用增量空间回收，删除的空间只会被后续写入复用；"
+                               "可运行一次 python main.py --vacuum 启用")
+            self.db.checkpoint()
+            self.db.optimize()
+
+            after = self.db.get_storage_stats()
+            # 主库文件的大小不含WAL；未归还给文件系统的空间留在空闲页中，可被后续写入复用
+            report['free_pages'] = after['freelist_count']
+            report['free_bytes'] = after['free_bytes']
+            report['file_bytes_before'] = before['file_bytes']
+            report['file_bytes_after'] = after['file_bytes']
+            report['reclaimed_bytes'] = max(before['file_bytes'] - after['file_bytes'], 0) + shard_bytes
+        except Exception as e:
+            logger.error(f"数据库维护失败: {e}")
+            report['errors'].append(str(e))
+        finally:
+            report['finished_at'] = datetime.now(timezone.utc).isoformat()
+            report['duration_seconds'] = round(time.monotonic() - started, 1)
+            with self._lock:
+                self._running = False
+                self._last_report = report
+
+        logger.info(
+            f"数据库维护完成: 删除消息 {sum(report['deleted'].values())} 条，"
+            f"编辑历史 {report['edits_deleted']} 条，统计行 {report['rollups_deleted']} 行，"
+            f"分片 {len(report['shards_dropped'])} 个，媒体文件 {report['media_files_deleted']} 个"
+            f" ({report['media_bytes_deleted'] / 1024 / 1024:.1f}MB)，"
+            f"回收空间 {report.get('reclaimed_bytes', 0) / 1024 / 1024:.1f}MB，"
+            f"空闲 {report.get('free_bytes', 0) / 1024 / 1024:.1f}MB，"
+            f"耗时 {report['duration_seconds']}秒"
+        )
+        return report
+
+    def stats(self):
+        """
+        获取维护状态
+
+        Returns:
+            dict: 是否正在执行，以及最近一次维护的报告
+        """
+        with self._lock:
+            return {'running': self._running, 'last_report': self._last_report}
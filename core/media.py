@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from functools import partial
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# 默认下载的媒体类型（与MessageFormatter.get_media_type的结果对应，小写）
+DEFAULT_MEDIA_TYPES = ('photo', 'image', 'video', 'audio', 'document')
+
+def _hash_file(path, chunk_size=MB):
+    """计算文件的sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class MediaDownloader:
+    """媒体下载器：由固定数量的协程在后台下载媒体，按内容哈希保存，相同文件只写一次"""
+
+    def __init__(self, db, media_dir='media', chat_ids=None, media_types=DEFAULT_MEDIA_TYPES,
+                 workers=2, max_queue_size=1000, size_caps_mb=None, default_cap_mb=50, quota_mb=10240):
+        """
+        初始化下载器
+
+        Args:
+            db: 数据库实例
+            media_dir: 媒体文件保存目录
+            chat_ids: 只下载这些会话的媒体，为空时下载全部会话
+            media_types: 要下载的媒体类型
+            workers: 同时下载的数量
+            max_queue_size: 等待下载的消息上限，超出时丢弃
+            size_caps_mb: 各媒体类型的大小上限（MB），未列出的类型使用default_cap_mb
+            default_cap_mb: 默认大小上限（MB）
+            quota_mb: 媒体目录的总容量上限（MB）
+        """
+        self.db = db
+        self.media_dir = media_dir
+        self.chat_ids = set(chat_ids or [])
+        self.media_types = {t.lower() for t in media_types}
+        self.workers = workers
+        self.size_caps = {k.lower(): v * MB for k, v in (size_caps_mb or {}).items()}
+        self.default_cap = default_cap_mb * MB
+        self.quota = quota_mb * MB
+        self.queue = None
+        self.max_queue_size = max_queue_size
+        self._tasks = []
+        self._lock = Lock()
+        self._used_bytes = 0
+        self._stats = {
+            'queued': 0,
+            'dropped': 0,
+            'skipped_size': 0,
+            'skipped_quota': 0,
+            'downloaded': 0,
+            'deduplicated': 0,
+            'failed': 0,
+            'bytes_downloaded': 0,
+            'download_seconds': 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        根据配置创建下载器
+
+        Args:
+            config: 配置对象
+            db: 数据库实例
+
+        Returns:
+            MediaDownloader实例，未启用时返回None
+        """
+        media_config = config.get('media', {})
+        if not media_config.get('enabled', False):
+            return None
+        return cls(
+            db,
+            media_dir=media_config.get('dir', 'media'),
+            chat_ids=media_config.get('chat_ids', []),
+            media_types=media_config.get('types', DEFAULT_MEDIA_TYPES),
+            workers=media_config.get('workers', 2),
+            max_queue_size=media_config.get('max_queue_size', 1000),
+            size_caps_mb=media_config.get('size_caps_mb', {}),
+            default_cap_mb=media_config.get('default_cap_mb', 50),
+            quota_mb=media_config.get('quota_mb', 10240)
+        )
+
+    def start(self):
+        """在当前事件循环中启动下载协程，重复调用时忽略"""
+        if self._tasks:
+            return
+        os.makedirs(os.path.join(self.media_dir, 'tmp'), exist_ok=True)
+        self._used_bytes = self.db.get_media_usage()
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        logger.info(
+            f"媒体下载已启动 (并发数: {self.workers}, 已用空间: {self._used_bytes / MB:.1f}MB / {self.quota / MB:.0f}MB)"
+        )
+
+    def stop(self):
+        """停止下载协程，队列中未下载的媒体将被放弃"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _count(self, key, amount=1):
+        """累加一个计数器"""
+        with self._lock:
+            self._stats[key] += amount
+
+    @staticmethod
+    def _media_kind(message_data):
+        """获取媒体类型，文档类型去掉文件名"""
+        media_type = message_data.get('media_type')
+        if not media_type:
+            return None
+        return media_type.split(':', 1)[0].lower()
+
+    def submit(self, message, message_data):
+        """
+        提交一条消息的媒体，只做判断和入队，不会阻塞调用方
+
+        Args:
+            message: Telethon消息对象
+            message_data: 消息数据字典
+        """
+        if self.queue is None or not message.file:
+            return
+        kind = self._media_kind(message_data)
+        if kind not in self.media_types:
+            return
+        if self.chat_ids and message_data.get('chat_id') not in self.chat_ids and message.chat_id not in self.chat_ids:
+            return
+
+        size = message.file.size or 0
+        if size > self.size_caps.get(kind, self.default_cap):
+            self._count('skipped_size')
+            return
+        try:
+            self.queue.put_nowait((message, message_data, kind, size))
+            self._count('queued')
+        except asyncio.QueueFull:
+            self._count('dropped')
+
+    async def _worker(self):
+        """下载循环"""
+        while True:
+            message, message_data, kind, size = await self.queue.get()
+            try:
+                await self._download(message, message_data, kind, size)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._count('failed')
+                logger.error(f"下载媒体失败 (chat_id: {message_data.get('chat_id')}, "
+                             f"message_id: {message_data.get('message_id')}): {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _download(self, message, message_data, kind, size):
+        """下载一条消息的媒体并登记到数据库"""
+        loop = asyncio.get_running_loop()
+        media = message.photo or message.document
+        telegram_file_id = getattr(media, 'id', None)
+        link = partial(
+            self.db.save_media, message_data.get('dedup_scope') or 0, message_data.get('chat_id'),
+            message_data.get('message_id'), kind
+        )
+
+        # 转发或重复发送的媒体在Telegram中是同一个文件，已下载过则无需再次下载
+        if telegram_file_id is not None:
+            sha256 = await loop.run_in_executor(None, self.db.find_media_by_telegram_id, telegram_file_id)
+            if sha256:
+                await loop.run_in_executor(None, partial(link, sha256))
+                self._count('deduplicated')
+                return
+
+        # 下载前在锁内预留预计的大小，并发下载的总量不会超过配额；失败或内容已存在时释放
+        with self._lock:
+            if self._used_bytes + size > self.quota:
+                self._stats['skipped_quota'] += 1
+                return
+            self._used_bytes += size
+        reserved = size
+
+        tmp_path = os.path.join(self.media_dir, 'tmp', uuid.uuid4().hex)
+        started = time.monotonic()
+        try:
+            await message.download_media(file=tmp_path)
+            elapsed = time.monotonic() - started
+            sha256 = await loop.run_in_executor(None, _hash_file, tmp_path)
+            actual_size = os.path.getsize(tmp_path)
+            # 查找和移动之间没有await，其他下载协程不会同时保存同一内容
+            relative_path = self._stored_path(sha256)
+            if relative_path is not None:
+                # 内容相同的文件已存在（扩展名可能不同），不再保存第二份
+                self._count('deduplicated')
+                with self._lock:
+                    self._used_bytes -= reserved
+            else:
+                relative_path = os.path.join(sha256[:2], sha256[2:4], sha256 + (message.file.ext or ''))
+                final_path = os.path.join(self.media_dir, relative_path)
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                shutil.move(tmp_path, final_path)
+                with self._lock:
+                    self._used_bytes += actual_size - reserved
+                    self._stats['downloaded'] += 1
+                    self._stats['bytes_downloaded'] += actual_size
+                    self._stats['download_seconds'] += elapsed
+            reserved = 0
+            await loop.run_in_executor(None, partial(
+                link, sha256, path=relative_path, size=actual_size,
+                mime_type=message.file.mime_type, telegram_file_id=telegram_file_id
+            ))
+        finally:
+            if reserved:
+                with self._lock:
+                    self._used_bytes -= reserved
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _stored_path(self, sha256):
+        """
+        按内容哈希查找已保存的文件，不区分扩展名
+
+        Args:
+            sha256: 文件内容的sha256
+
+        Returns:
+            str: 相对于媒体目录的文件路径，不存在时返回None
+        """
+        directory = os.path.join(sha256[:2], sha256[2:4])
+        try:
+            names = os.listdir(os.path.join(self.media_dir, directory))
+        except FileNotFoundError:
+            return None
+        for name in sorted(names):
+            if name.split('.', 1)[0] == sha256:
+                return os.path.join(directory, name)
+        return None
+
+    def stats(self):
+        """
+        获取下载指标
+
+        Returns:
+            dict: 队列深度、下载和跳过的数量、已用空间和下载速度
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['used_mb'] = round(self._used_bytes / MB, 1)
+        stats['quota_mb'] = self.quota / MB
+        stats['queue_depth'] = self.queue.qsize() if self.queue else 0
+        seconds = stats['download_seconds']
+        stats['throughput_mb_s'] = round(stats['bytes_downloaded'] / MB / seconds, 2) if seconds else 0.0
+        return stats
@@ -1,75 +1,82 @@
 import logging
-import smtplib
-import jieba
 import os
+import html
 import io # Import the io module
+import time
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from wordcloud import WordCloud
+from core.terms import TermIndexer
+from core.mailer import ReportMailer
 
 logger = logging.getLogger(__name__)
 
+def render_wordcloud(frequencies, font_path, max_words, width=1200, height=800):
+    """
+    根据词频渲染词云，在渲染进程中执行
+
+    Args:
+        frequencies: (词, 次数) 列表
+        font_path: 字体文件路径
+        max_words: 最多显示的词数
+        width: 图片宽度
+        height: 图片高度
+
+    Returns:
+        tuple: (PNG图片数据, 渲染耗时秒数)
+    """
+    started = time.perf_counter()
+    wordcloud = WordCloud(
+        font_path=font_path,
+        width=width,
+        height=height,
+        background_color='white',
+        max_words=max_words
+    ).generate_from_frequencies(dict(frequencies))
+    img_byte_arr = io.BytesIO()
+    wordcloud.to_image().save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue(), time.perf_counter() - started
+
+def _render_process(conn, frequencies, font_path, max_words):
+    """渲染进程的入口：渲染一个会话的词云，把结果或错误信息发回主进程"""
+    try:
+        conn.send(('ok', render_wordcloud(frequencies, font_path, max_words)))
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        conn.close()
+
 class DailyReporter:
-    def __init__(self, config, db):
+    def __init__(self, config, db, indexer=None, mailer=None):
         self.report_config = config.get('daily_report', {})
-        self.smtp_config = config.get('smtp_settings', {})
         self.db = db
+        # 邮件先写入发件箱再发送，失败的邮件由调度器按退避时间重试
+        self.mailer = mailer or ReportMailer.from_config(config, db)
+        # 汇总模式下所有会话的词云合并为一封邮件
+        self.digest = self.report_config.get('digest', False)
+        # 词频由TermIndexer在后台增量统计，生成报告时只需读取汇总结果
+        self.indexer = indexer or TermIndexer.from_config(config, db)
+        self.report_days = self.report_config.get('report_days', 1)
+        self.max_words = self.report_config.get('max_words', 200)
+        # 词云渲染是CPU密集的，每个会话在单独的进程中渲染，超时时可以单独结束；邮件在线程池中并行发送
+        self.workers = self.report_config.get('workers', min(4, os.cpu_count() or 1))
+        self.smtp_workers = self.report_config.get('smtp_workers', 2)
+        self.chat_timeout = self.report_config.get('chat_timeout_seconds', 300)
         # 确保词云有中文字体，这里我们假设服务器上存在这个字体文件
         # 在Windows上，它可能是 'C:/Windows/Fonts/simhei.ttf'
         # 在Linux上，可能是 '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc'
         # 我们让它可配置
         self.font_path = self.report_config.get('font_path', 'simhei.ttf') 
 
-    def _generate_wordcloud(self, text):
-        """生成词云图片并返回其二进制数据"""
-        if not text:
-            logger.warning("没有足够的文本来生成词云。")
-            return None
-        
-        try:
-            # 使用jieba进行中文分词
-            word_list = jieba.lcut(text)
-            processed_text = " ".join(word_list)
-            
-            # 检查字体路径是否存在
-            if not os.path.exists(self.font_path):
-                logger.error(f"指定的字体文件不存在: {self.font_path}。词云可能无法正确显示中文。")
-                # 可以在这里回退到默认字体，但中文会是乱码
-            
-            wordcloud = WordCloud(
-                font_path=self.font_path,
-                width=1200,
-                height=800,
-                background_color='white'
-            ).generate(processed_text)
-            
-            # --- NEW: Save image to a memory buffer with a specific format ---
-            img_byte_arr = io.BytesIO()
-            wordcloud.to_image().save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
-            return img_byte_arr
-            # --- END NEW ---
-            
-        except Exception as e:
-            logger.error(f"生成词云失败: {e}")
-            return None
-
-    def _send_email(self, image_data, chat_title="Overall"):
-        """发送包含词云图片的邮件"""
-        if not image_data:
-            logger.warning("没有词云图片数据，邮件未发送。")
-            return
-
-        recipient = self.report_config.get('recipient_email')
-        if not recipient:
-            logger.error("未配置收件人邮箱，邮件无法发送。")
-            return
-            
+    def _build_message(self, image_data, chat_title):
+        """生成一个会话的报告邮件"""
         msg = MIMEMultipart()
-        msg['From'] = self.smtp_config.get('username')
-        msg['To'] = recipient
+        msg['To'] = self.report_config.get('recipient_email')
         msg['Subject'] = f"Telegram每日词云报告 - {chat_title} - {datetime.now().strftime('%Y-%m-%d')}"
         
         # 邮件正文
@@ -80,48 +87,206 @@ class DailyReporter:
         image = MIMEImage(image_data, _subtype='png', name='wordcloud.png')
         image.add_header('Content-ID', '<wordcloud_image>')
         msg.attach(image)
+        return msg
+
+    def _build_digest(self, items):
+        """生成包含多个会话词云的汇总邮件，items为 (会话标题, 图片数据) 列表"""
+        msg = MIMEMultipart('related')
+        msg['To'] = self.report_config.get('recipient_email')
+        msg['Subject'] = f"Telegram每日词云报告汇总 - {len(items)}个会话 - {datetime.now().strftime('%Y-%m-%d')}"
         
-        try:
-            server = smtplib.SMTP(self.smtp_config.get('host'), self.smtp_config.get('port'))
-            if self.smtp_config.get('use_tls', True):
-                server.starttls()
-            server.login(self.smtp_config.get('username'), self.smtp_config.get('password'))
-            server.send_message(msg)
-            server.quit()
+        titles = '、'.join(title for title, _ in items)
+        sections = ''.join(
+            f'<h3>{html.escape(str(title))}</h3><img src="cid:wordcloud_{i}" alt="{html.escape(str(title))}"><br>'
+            for i, (title, _) in enumerate(items)
+        )
+        body = MIMEMultipart('alternative')
+        body.attach(MIMEText(f"您好，\n\n这是群组/会话【{titles}】今日的Telegram聊天词云报告，词云见附件。\n\n祝好！",
+                             'plain', 'utf-8'))
+        body.attach(MIMEText(f"<p>您好，</p><p>这是今日的Telegram聊天词云报告。</p>{sections}<p>祝好！</p>",
+                             'html', 'utf-8'))
+        msg.attach(body)
+        
+        for i, (_, image_data) in enumerate(items):
+            image = MIMEImage(image_data, _subtype='png', name=f'wordcloud_{i}.png')
+            image.add_header('Content-ID', f'<wordcloud_{i}>')
+            msg.attach(image)
+        return msg
+
+    def _send_email(self, image_data, chat_title="Overall"):
+        """发送包含词云图片的邮件，返回是否发送成功"""
+        if not image_data:
+            logger.warning("没有词云图片数据，邮件未发送。")
+            return False
+
+        recipient = self.report_config.get('recipient_email')
+        if not recipient:
+            logger.error("未配置收件人邮箱，邮件无法发送。")
+            return False
+        
+        if self.mailer.send(self._build_message(image_data, chat_title)):
             logger.info(f"每日报告已成功发送到 {recipient}")
-        except Exception as e:
-            logger.error(f"发送邮件失败: {e}")
+            return True
+        return False
 
-    def run_report(self):
-        """执行报告生成和发送的完整流程"""
-        logger.info("开始生成每日词云报告...")
+    def _collect_targets(self, days):
+        """获取各报告对象的标题和高频词，未配置目标会话时返回一份所有消息的总报告"""
         target_chat_ids = self.report_config.get('target_chat_ids')
+        if not target_chat_ids:
+            logger.info("未配置目标Chat ID，将为所有会话生成一份总报告。")
+            return [{
+                'chat_id': None,
+                'title': "所有消息汇总",
+                'frequencies': self.db.get_top_terms(days, limit=self.max_words)
+            }]
+        return [{
+            'chat_id': chat_id,
+            'title': self.db.get_chat_title(chat_id),
+            'frequencies': self.db.get_top_terms(days, chat_id=chat_id, limit=self.max_words)
+        } for chat_id in target_chat_ids]
+
+    def _deliver(self, image_data, result):
+        """发送一个会话的报告并记录耗时"""
+        started = time.monotonic()
+        sent = self._send_email(image_data, chat_title=result['title'])
+        result['send_seconds'] = round(time.monotonic() - started, 2)
+        result['status'] = 'sent' if sent else 'send_failed'
 
-        if target_chat_ids:
-            # 为每个目标chat_id生成并发送报告
-            for chat_id in target_chat_ids:
-                logger.info(f"正在为 Chat ID: {chat_id} 生成报告...")
-                chat_title = self.db.get_chat_title(chat_id)
-                text_data = self.db.get_messages_for_last_24_hours(chat_id=chat_id)
-                
-                if text_data:
-                    image_bytes = self._generate_wordcloud(text_data)
-                    self._send_email(image_bytes, chat_title=chat_title)
-                else:
-                    logger.info(f"Chat ID: {chat_id} (标题: {chat_title}) 过去24小时内无有效消息，跳过报告。")
+    def _deliver_digest(self, rendered):
+        """把已渲染的会话合并为一封邮件发送，rendered为 (图片数据, 结果) 列表"""
+        started = time.monotonic()
+        sent = False
+        if not self.report_config.get('recipient_email'):
+            logger.error("未配置收件人邮箱，邮件无法发送。")
         else:
-            # 如果没有配置目标，则按原逻辑处理所有消息
-            logger.info("未配置目标Chat ID，将为所有会话生成一份总报告。")
-            text_data = self.db.get_messages_for_last_24_hours()
-            if text_data:
-                image_bytes = self._generate_wordcloud(text_data)
-                self._send_email(image_bytes, chat_title="所有消息汇总")
+            sent = self.mailer.send(self._build_digest([(result['title'], image_data) for image_data, result in rendered]))
+            if sent:
+                logger.info(f"每日报告汇总已成功发送，共 {len(rendered)} 个会话")
+        seconds = round(time.monotonic() - started, 2)
+        for _, result in rendered:
+            result['send_seconds'] = seconds
+            result['status'] = 'sent' if sent else 'send_failed'
+
+    def _render_all(self, renders, on_rendered):
+        """
+        渲染各会话的词云，渲染完一个就交给on_rendered(图片数据, 结果)
+
+        每个会话在单独的进程中渲染，最多同时运行workers个进程。每个会话从其进程启动起计时，
+        超过chat_timeout秒记为超时并只结束该进程，不影响其他会话。
+
+        Args:
+            renders: (词频, 结果) 列表
+            on_rendered: 渲染成功时的回调
+        """
+        # 调度线程所在的进程还运行着事件循环和网页服务，子进程用spawn方式启动，不继承这些线程的状态
+        context = multiprocessing.get_context('spawn')
+        queued = list(renders)
+        running = {}
+        try:
+            while queued or running:
+                while queued and len(running) < self.workers:
+                    frequencies, result = queued.pop(0)
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(
+                        target=_render_process, args=(sender, frequencies, self.font_path, self.max_words),
+                        name=f"report-render-{result['chat_id']}", daemon=True
+                    )
+                    process.start()
+                    sender.close()
+                    running[receiver] = (process, result, time.monotonic())
+                for receiver in wait_connections(list(running), timeout=1):
+                    process, result, _ = running.pop(receiver)
+                    try:
+                        status, payload = receiver.recv()
+                    except EOFError:
+                        status, payload = 'error', '渲染进程意外退出'
+                    receiver.close()
+                    process.join()
+                    if status == 'ok':
+                        image_data, seconds = payload
+                        result['render_seconds'] = round(seconds, 2)
+                        on_rendered(image_data, result)
+                    else:
+                        result['status'] = 'render_failed'
+                        result['error'] = payload
+                        logger.error(f"生成词云失败 (Chat: {result['title']}): {payload}")
+                now = time.monotonic()
+                for receiver, (process, result, started) in list(running.items()):
+                    if now - started > self.chat_timeout:
+                        del running[receiver]
+                        process.terminate()
+                        process.join()
+                        receiver.close()
+                        result['status'] = 'timeout'
+                        logger.error(f"生成词云超时 (Chat: {result['title']}, 超过 {self.chat_timeout} 秒)")
+        finally:
+            # 出错退出时结束仍在运行的渲染进程
+            for receiver, (process, _, _) in running.items():
+                process.terminate()
+                process.join()
+                receiver.close()
+
+    def run_report(self):
+        """
+        执行报告生成和发送的完整流程
+
+        Returns:
+            list: 各会话的结果，包含状态、词数和渲染、发送耗时
+        """
+        logger.info("开始生成每日词云报告...")
+        run_started = time.monotonic()
+        # 先处理尚未分词的最新消息
+        self.indexer.run()
+        days = self.indexer.recent_days(self.report_days)
+
+        results = []
+        renders = []
+        for target in self._collect_targets(days):
+            frequencies = target.pop('frequencies')
+            result = dict(target, terms=len(frequencies), status='skipped', render_seconds=None, send_seconds=None)
+            results.append(result)
+            if not frequencies:
+                logger.info(f"Chat ID: {target['chat_id']} (标题: {target['title']}) 报告期内无有效消息，跳过报告。")
+                continue
+            renders.append((frequencies, result))
+
+        if renders:
+            # 检查字体路径是否存在
+            if not os.path.exists(self.font_path):
+                logger.error(f"指定的字体文件不存在: {self.font_path}。词云可能无法正确显示中文。")
+            # 每个发送线程复用一个SMTP连接，汇总模式下只发送一封邮件
+            send_pool = ThreadPoolExecutor(max_workers=self.smtp_workers, thread_name_prefix='report-smtp')
+            sends = []
+            rendered = []
+            if self.digest:
+                on_rendered = lambda image_data, result: rendered.append((image_data, result))
             else:
-                logger.info("过去24小时内无任何有效消息，跳过总报告。")
-        
-        logger.info("每日报告任务执行完毕。")
+                on_rendered = lambda image_data, result: sends.append(send_pool.submit(self._deliver, image_data, result))
+            try:
+                self._render_all(renders, on_rendered)
+                if rendered:
+                    self._deliver_digest(rendered)
+                wait(sends)
+            finally:
+                send_pool.shutdown(wait=True)
+                self.mailer.close()
+
+        self._log_summary(results, time.monotonic() - run_started)
+        return results
+
+    @staticmethod
+    def _log_summary(results, elapsed):
+        """记录各会话的结果和耗时"""
+        for result in results:
+            logger.info(
+                f"报告 {result['title']} (Chat ID: {result['chat_id']}): {result['status']}，"
+                f"词数 {result['terms']}，渲染 {result['render_seconds']}秒，发送 {result['send_seconds']}秒"
+                + (f"，错误: {result['error']}" if result.get('error') else '')
+            )
+        sent = sum(1 for result in results if result['status'] == 'sent')
+        logger.info(f"每日报告任务执行完毕: 发送 {sent}/{len(results)} 份，总耗时 {elapsed:.1f}秒。")
 
-def run_daily_report(config, db):
+def run_daily_report(config, db, indexer=None, mailer=None):
     """一个独立的函数，用于被调度器调用"""
-    reporter = DailyReporter(config, db)
-    reporter.run_report() 
\ No newline at end of file
+    reporter = DailyReporter(config, db, indexer, mailer)
+    return reporter.run_report() 
\ No newline at end of file
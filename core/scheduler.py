@@ -5,6 +5,9 @@ from threading import Thread
 from zoneinfo import ZoneInfo
 from functools import partial
 from core.reporter import run_daily_report
+from core.maintenance import MaintenanceJob
+from core.terms import TermIndexer
+from core.mailer import ReportMailer
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +18,9 @@ class ReportScheduler:
         self.db = db
         self.running = False
         self.thread = None
+        self.maintenance = None
+        self.indexer = None
+        self.mailer = None
 
     def _schedule_job(self):
         """设置调度任务"""
@@ -28,7 +34,17 @@ class ReportScheduler:
         try:
             logger.info(f"每日报告已计划在每天 {schedule_time_str} ({timezone_str}) 执行。")
             
-            job_func = partial(run_daily_report, self.config, self.db)
+            # 后台定期增量统计词频，生成报告时只需补齐最后几分钟的消息
+            self.indexer = TermIndexer.from_config(self.config, self.db)
+            interval = self.report_config.get('term_index_interval_minutes', 5)
+            schedule.every(interval).minutes.do(self.indexer.run)
+            
+            # 发送失败的报告邮件留在发件箱中，定期重试
+            self.mailer = ReportMailer.from_config(self.config, self.db)
+            retry_interval = self.report_config.get('outbox_retry_interval_minutes', 5)
+            schedule.every(retry_interval).minutes.do(self.mailer.flush_outbox)
+            
+            job_func = partial(run_daily_report, self.config, self.db, self.indexer, self.mailer)
             
             # Pass the timezone string directly to the 'at' method
             schedule.every().day.at(schedule_time_str, timezone_str).do(job_func)
@@ -36,6 +52,23 @@ class ReportScheduler:
         except Exception as e:
             logger.error(f"设置定时报告任务失败: {e}")
             
+    def _schedule_maintenance(self):
+        """设置数据库维护任务"""
+        maintenance_config = self.config.get('maintenance', {})
+        if not maintenance_config.get('enabled', False):
+            logger.info("数据库维护任务已禁用。")
+            return
+        
+        schedule_time_str = maintenance_config.get('schedule_time', '04:00')
+        timezone_str = maintenance_config.get('timezone', 'UTC')
+        
+        try:
+            self.maintenance = MaintenanceJob.from_config(self.config, self.db)
+            schedule.every().day.at(schedule_time_str, timezone_str).do(self.maintenance.run)
+            logger.info(f"数据库维护已计划在每天 {schedule_time_str} ({timezone_str}) 执行。")
+        except Exception as e:
+            logger.error(f"设置数据库维护任务失败: {e}")
+            
     def _run_pending(self):
         """在一个循环中运行所有待定的调度任务"""
         self.running = True
@@ -48,6 +81,7 @@ class ReportScheduler:
     def start(self):
         """在后台线程中启动调度器"""
         self._schedule_job()
+        self._schedule_maintenance()
         self.thread = Thread(target=self._run_pending, daemon=True)
         self.thread.start()
 
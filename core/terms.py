@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from collections import Counter
+from datetime import datetime, date
+from threading import Lock
+from zoneinfo import ZoneInfo
+from core.tokenizer import get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+EPOCH = date(1970, 1, 1)
+
+class TermIndexer:
+    """词频索引：后台按消息ID增量分词，把每天每个会话的词频累加到term_counts表"""
+
+    def __init__(self, db, timezone='UTC', batch_size=2000, initial_days=2, tokenizer=None):
+        """
+        初始化词频索引
+
+        Args:
+            db: 数据库实例
+            timezone: 划分日期使用的时区，与每日报告的时区一致
+            batch_size: 每批分词的消息数
+            initial_days: 首次运行时只处理最近几天的消息
+            tokenizer: 分词器，为空时使用全局共享的分词器
+        """
+        self.db = db
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.timezone = ZoneInfo(timezone)
+        self.batch_size = batch_size
+        self.initial_days = initial_days
+        self._lock = Lock()
+        self._stats = {'runs': 0, 'messages': 0, 'terms': 0, 'last_run_seconds': 0.0}
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        根据配置创建词频索引
+
+        Args:
+            config: 配置对象
+            db: 数据库实例
+
+        Returns:
+            TermIndexer实例
+        """
+        report_config = config.get('daily_report', {})
+        return cls(
+            db,
+            timezone=report_config.get('timezone', 'UTC'),
+            batch_size=report_config.get('term_batch_size', 2000)
+        )
+
+    def day_of(self, ts):
+        """
+        获取纪元秒在报告时区下的纪元天数
+
+        Args:
+            ts: 纪元秒
+
+        Returns:
+            int: 纪元天数
+        """
+        return (datetime.fromtimestamp(ts, self.timezone).date() - EPOCH).days
+
+    def recent_days(self, count=1):
+        """
+        获取报告时区下最近几天的纪元天数
+
+        Args:
+            count: 天数，1表示只取今天
+
+        Returns:
+            list: 纪元天数列表，今天在最后
+        """
+        today = (datetime.now(self.timezone).date() - EPOCH).days
+        return list(range(today - count + 1, today + 1))
+
+    def _count_batch(self, rows):
+        """统计一批消息的词频"""
+        rows = [
+            row for row in rows
+            if row['text'] and row['chat_id'] is not None and row['date_ts'] is not None
+            and row['media_type'] != 'MessageMediaUnsupported'
+        ]
+        counts = Counter()
+        for row, terms in zip(rows, self.tokenizer.tokenize_many(row['text'] for row in rows)):
+            day = self.day_of(row['date_ts'])
+            for term in terms:
+                counts[(day, row['chat_id'], term)] += 1
+        return counts, len(rows)
+
+    def run(self):
+        """
+        处理上次之后入库的全部消息
+
+        Returns:
+            int: 本次分词的消息数
+        """
+        if not self._lock.acquire(blocking=False):
+            logger.debug("词频索引正在运行，本次跳过")
+            return 0
+        started = time.monotonic()
+        total = 0
+        try:
+            since_ts = int(time.time()) - self.initial_days * 86400
+            last_id = self.db.get_term_watermark(since_ts)
+            # 逐块读取、分词并保存，内存中只保留一块消息和它的词频
+            for rows in self.db.iter_texts_after(last_id, self.batch_size):
+                counts, messages = self._count_batch(rows)
+                if not self.db.save_term_counts(counts, rows[-1]['id']):
+                    break
+                total += messages
+                self._stats['terms'] += len(counts)
+            if total:
+                logger.info(f"词频索引已更新，新处理 {total} 条消息")
+        except Exception as e:
+            logger.error(f"更新词频索引失败: {e}")
+        finally:
+            self._stats['runs'] += 1
+            self._stats['messages'] += total
+            self._stats['last_run_seconds'] = round(time.monotonic() - started, 2)
+            self._lock.release()
+        return total
+
+    def stats(self):
+        """
+        获取索引指标
+
+        Returns:
+            dict: 运行次数、累计分词的消息数和写入的词频行数、最近一次运行耗时
+        """
+        return dict(self._stats)
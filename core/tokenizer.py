@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import jieba
+
+logger = logging.getLogger(__name__)
+
+# 与WordCloud默认的分词规则一致：至少两个字符，以字母、数字或汉字开头
+TERM_PATTERN = re.compile(r"^\w[\w']+$")
+
+# 常见的虚词、代词和口头语（单字已由TERM_PATTERN过滤）
+DEFAULT_STOPWORDS = frozenset('''
+我们 你们 他们 她们 它们 咱们 大家 自己 别人 人家 这个 那个 这些 那些 这里 那里 这样 那样 这么 那么
+什么 怎么 怎样 为什么 哪里 哪个 多少 没有 不是 就是 还是 也是 都是 只是 可是 但是 而且 并且 或者 因为
+所以 如果 虽然 然后 然而 而是 还有 已经 一个 一些 一下 一样 一直 一起 可以 可能 应该 需要 知道 觉得
+感觉 时候 现在 今天 明天 昨天 真的 其实 不过 只有 这种 那种 之后 之前 以后 以前 的话 不会 不要 不能
+没事 好的 好吧 是的 对的 哈哈 哈哈哈 哈哈哈哈 呵呵 嘿嘿 嗯嗯 啊啊 谢谢
+the and for are but not you your with this that have has had was were will would can could
+just what when where who how all any our out get got its it's i'm don't they them then than there
+from about into over also some more very been being http https www com
+'''.split())
+
+class Tokenizer:
+    """共享的中文分词器：启动时加载一次词典（可在后台线程中加载），过滤停用词，支持批量和多进程分词"""
+
+    def __init__(self, dictionary=None, user_dict=None, cache_dir=None, stopwords=None,
+                 stopwords_file=None, default_stopwords=True, parallel=0, parallel_min_texts=1000):
+        """
+        初始化分词器，词典在start()或第一次分词时加载
+
+        Args:
+            dictionary: 主词典文件，为空时使用jieba自带的词典
+            user_dict: 自定义词典文件（jieba格式：每行“词 词频 词性”，词频和词性可省略）
+            cache_dir: 词典缓存文件的目录，为空时使用系统临时目录；缓存存在时加载只需读取缓存
+            stopwords: 额外的停用词列表
+            stopwords_file: 停用词文件，每行一个词
+            default_stopwords: 是否使用内置的常见停用词
+            parallel: 批量分词使用的进程数，0表示在当前线程中分词
+            parallel_min_texts: 批量分词的条数达到此值时才使用多进程
+        """
+        self.dictionary = dictionary
+        self.user_dict = user_dict
+        self.cache_dir = cache_dir
+        self.parallel = parallel
+        self.parallel_min_texts = parallel_min_texts
+        self.stopwords = set(DEFAULT_STOPWORDS if default_stopwords else ())
+        self.stopwords.update(word.strip().lower() for word in stopwords or [] if word.strip())
+        self.stopwords_file = stopwords_file
+        self._jieba = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pool = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'load_seconds': None, 'texts': 0, 'parallel_batches': 0}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        根据配置创建分词器
+
+        Args:
+            config: 配置对象
+
+        Returns:
+            Tokenizer实例
+        """
+        tokenizer_config = config.get('tokenizer', {})
+        return cls(
+            dictionary=tokenizer_config.get('dictionary'),
+            user_dict=tokenizer_config.get('user_dict'),
+            cache_dir=tokenizer_config.get('cache_dir'),
+            stopwords=tokenizer_config.get('stopwords', []),
+            stopwords_file=tokenizer_config.get('stopwords_file'),
+            default_stopwords=tokenizer_config.get('default_stopwords', True),
+            parallel=tokenizer_config.get('parallel', 0),
+            parallel_min_texts=tokenizer_config.get('parallel_min_texts', 1000)
+        )
+
+    def settings(self):
+        """获取构造参数，用于在子进程中创建相同的分词器，停用词已包含停用词文件的内容"""
+        return {
+            'dictionary': self.dictionary,
+            'user_dict': self.user_dict,
+            'cache_dir': self.cache_dir,
+            'stopwords': sorted(self.stopwords),
+            'default_stopwords': False,
+        }
+
+    def start(self, background=True):
+        """
+        加载词典，重复调用时忽略
+
+        Args:
+            background: 是否在后台线程中加载；加载完成前的分词调用会等待
+        """
+        with self._start_lock:
+            if self._jieba is not None or self._ready.is_set():
+                return
+            self._jieba = jieba.Tokenizer(self.dictionary) if self.dictionary else jieba.Tokenizer()
+            self._jieba.tmp_dir = self.cache_dir
+        if background:
+            threading.Thread(target=self._load, name='tokenizer-load', daemon=True).start()
+        else:
+            self._load()
+
+    def _load(self):
+        """加载主词典、自定义词典和停用词"""
+        started = time.monotonic()
+        try:
+            jieba.setLogLevel(logging.WARNING)
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            self._jieba.initialize()
+            if self.user_dict:
+                self._jieba.load_userdict(self.user_dict)
+            if self.stopwords_file:
+                with open(self.stopwords_file, encoding='utf-8') as f:
+                    self.stopwords.update(line.strip().lower() for line in f if line.strip())
+            seconds = round(time.monotonic() - started, 2)
+            with self._stats_lock:
+                self._stats['load_seconds'] = seconds
+            logger.info(f"分词词典加载完成，耗时 {seconds} 秒，停用词 {len(self.stopwords)} 个")
+        except Exception as e:
+            logger.error(f"加载分词词典失败: {e}")
+        finally:
+            self._ready.set()
+
+    def _ensure_ready(self):
+        """确保词典已加载，尚未启动时在当前线程中加载"""
+        if not self._ready.is_set():
+            self.start(background=False)
+            self._ready.wait()
+
+    def tokenize(self, text):
+        """
+        分词，去掉标点、单字和停用词
+
+        Args:
+            text: 文本
+
+        Returns:
+            list: 词列表
+        """
+        self._ensure_ready()
+        with self._stats_lock:
+            self._stats['texts'] += 1
+        return self._filter(self._jieba.lcut(text))
+
+    def _filter(self, words):
+        """去掉标点、单字和停用词"""
+        return [word for word in words if TERM_PATTERN.match(word) and word.lower() not in self.stopwords]
+
+    def tokenize_many(self, texts):
+        """
+        批量分词，条数达到parallel_min_texts且启用了多进程时分给多个进程处理
+
+        Args:
+            texts: 文本列表
+
+        Returns:
+            list: 与texts一一对应的词列表
+        """
+        texts = list(texts)
+        self._ensure_ready()
+        if self.parallel > 1 and len(texts) >= self.parallel_min_texts:
+            try:
+                results = self._tokenize_parallel(texts)
+                with self._stats_lock:
+                    self._stats['texts'] += len(texts)
+                    self._stats['parallel_batches'] += 1
+                return results
+            except Exception as e:
+                logger.error(f"多进程分词失败，改为在当前线程中分词: {e}")
+                self._shutdown_pool()
+        with self._stats_lock:
+            self._stats['texts'] += len(texts)
+        return [self._filter(self._jieba.lcut(text)) for text in texts]
+
+    def _tokenize_parallel(self, texts):
+        """把文本平均分成若干块，交给进程池分词"""
+        with self._start_lock:
+            if self._pool is None:
+                # 子进程用spawn方式启动，不继承主进程中事件循环和网页服务的线程状态
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.parallel, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker, initargs=(self.settings(),)
+                )
+        size = -(-len(texts) // self.parallel)
+        chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+        results = []
+        for chunk_result in self._pool.map(_tokenize_worker, chunks):
+            results.extend(chunk_result)
+        return results
+
+    def _shutdown_pool(self):
+        """关闭分词进程池"""
+        with self._start_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        """释放分词进程池"""
+        self._shutdown_pool()
+
+    def stats(self):
+        """
+        获取分词器状态
+
+        Returns:
+            dict: 词典是否已加载、加载耗时、停用词数和累计分词的条数
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['ready'] = self._ready.is_set()
+        stats['stopwords'] = len(self.stopwords)
+        stats['parallel'] = self.parallel
+        return stats
+
+# 子进程中的分词器
+_worker_tokenizer = None
+
+def _init_worker(settings):
+    """进程池的初始化函数：在子进程中加载词典"""
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(**settings)
+    _worker_tokenizer.start(background=False)
+
+def _tokenize_worker(texts):
+    """在子进程中分词一块文本"""
+    return [_worker_tokenizer._filter(_worker_tokenizer._jieba.lcut(text)) for text in texts]
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def configure_tokenizer(config):
+    """
+    根据配置创建全局共享的分词器，应在程序启动时调用一次
+
+    Args:
+        config: 配置对象
+
+    Returns:
+        Tokenizer实例
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is not None:
+            _shared.close()
+        _shared = Tokenizer.from_config(config)
+        return _shared
+
+def get_tokenizer():
+    """
+    获取全局共享的分词器，尚未配置时使用默认设置创建
+
+    Returns:
+        Tokenizer实例
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Tokenizer()
+        return _shared
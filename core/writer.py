@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import queue
+import asyncio
+import logging
+from threading import Thread, Lock
+
+logger = logging.getLogger(__name__)
+
+# 队列结束标记
+_STOP = object()
+
+# 队列已满时的处理策略
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+
+class MessageWriter:
+    """消息写后（write-behind）队列，将消息按批次合并为一个事务写入数据库"""
+
+    def __init__(self, db, batch_size=500, flush_interval=0.2, max_queue_size=10000,
+                 overflow_policy='block', spill_file='write_spill.jsonl'):
+        """
+        初始化写入队列
+
+        Args:
+            db: 数据库实例
+            batch_size: 单批最大条数，达到后立即提交
+            flush_interval: 单批最长等待时间（秒），超时后立即提交
+            max_queue_size: 队列容量上限
+            overflow_policy: 队列已满时的策略：'block'等待空位，'drop'丢弃并计数，
+                'spill'追加到溢出文件，待队列空闲后再写入数据库
+            spill_file: 溢出文件路径，仅在'spill'策略下使用
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的队列溢出策略: {overflow_policy}")
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.spill_file = spill_file
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.running = False
+        self.thread = None
+        self._spill_lock = Lock()
+        self._stats_lock = Lock()
+        self._stats = {
+            'enqueued': 0,
+            'blocked': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        根据配置创建写入队列
+
+        Args:
+            config: 配置对象
+            db: 数据库实例
+
+        Returns:
+            MessageWriter实例，如果配置中禁用则返回None
+        """
+        writer_config = config.get('write_behind', {})
+        if not writer_config.get('enabled', True):
+            logger.info("写后队列已禁用，消息将逐条写入数据库。")
+            return None
+        return cls(
+            db,
+            batch_size=writer_config.get('batch_size', 500),
+            flush_interval=writer_config.get('flush_interval_ms', 200) / 1000.0,
+            max_queue_size=writer_config.get('max_queue_size', 10000),
+            overflow_policy=writer_config.get('overflow_policy', 'block'),
+            spill_file=writer_config.get('spill_file', 'write_spill.jsonl')
+        )
+
+    def start(self):
+        """在后台线程中启动写入循环"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = Thread(target=self._run, name='MessageWriter', daemon=True)
+        self.thread.start()
+        logger.info(f"写后队列已启动 (批大小: {self.batch_size}, 间隔: {int(self.flush_interval * 1000)}ms)")
+
+    def _count(self, key, amount=1):
+        """累加一个计数器"""
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def put(self, message_data):
+        """
+        将消息放入写入队列，队列已满时按溢出策略处理
+
+        该方法可能阻塞或写文件，不应在事件循环中直接调用，请使用put_async。
+
+        Args:
+            message_data: 消息数据字典
+
+        Returns:
+            bool: 消息是否被接收（入队或溢出到文件），被丢弃时返回False
+        """
+        try:
+            self.queue.put_nowait(message_data)
+        except queue.Full:
+            return self._handle_overflow(message_data)
+        self._count('enqueued')
+        return True
+
+    async def put_async(self, message_data):
+        """
+        在事件循环中安全地提交消息：队列未满时立即返回，
+        需要等待空位或写溢出文件时交由线程池执行，不阻塞事件循环
+
+        Args:
+            message_data: 消息数据字典
+
+        Returns:
+            bool: 消息是否被接收
+        """
+        try:
+            self.queue.put_nowait(message_data)
+        except queue.Full:
+            if self.overflow_policy == 'drop':
+                return self._handle_overflow(message_data)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._handle_overflow, message_data)
+        self._count('enqueued')
+        return True
+
+    def _handle_overflow(self, message_data):
+        """队列已满时按策略处理一条消息"""
+        if self.overflow_policy == 'block':
+            self._count('blocked')
+            self.queue.put(message_data)
+            self._count('enqueued')
+            return True
+
+        if self.overflow_policy == 'spill':
+            try:
+                line = json.dumps(message_data, ensure_ascii=False, default=str)
+                with self._spill_lock:
+                    with open(self.spill_file, 'a', encoding='utf-8') as f:
+                        f.write(line + '\n')
+                self._count('spilled')
+                return True
+            except Exception as e:
+                logger.error(f"写入溢出文件失败: {e}")
+
+        self._count('dropped')
+        logger.debug("写入队列已满，消息被丢弃")
+        return False
+
+    def _replay_spill(self):
+        """队列空闲时把溢出文件中的消息写回数据库"""
+        if self.overflow_policy != 'spill':
+            return
+        replay_file = self.spill_file + '.replay'
+        # 上次写回中途退出时遗留的文件先写回，否则会被下面的改名覆盖；已写入的消息按唯一键忽略
+        if os.path.exists(replay_file):
+            self._replay_file(replay_file)
+        if not os.path.exists(self.spill_file):
+            return
+        with self._spill_lock:
+            # 先改名，之后新的溢出写入新文件
+            os.replace(self.spill_file, replay_file)
+        self._replay_file(replay_file)
+
+    def _replay_file(self, replay_file):
+        """把一个溢出文件中的消息按批写入数据库，完成后删除文件"""
+        batch = []
+        with open(replay_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    logger.warning("溢出文件中有无法解析的行，已跳过")
+                    continue
+                if len(batch) >= self.batch_size:
+                    self._flush(batch)
+                    self._count('replayed', len(batch))
+                    batch = []
+        if batch:
+            self._flush(batch)
+            self._count('replayed', len(batch))
+        os.remove(replay_file)
+        logger.info("溢出文件中的消息已写入数据库")
+
+    def _replay_spill_safely(self):
+        """写回溢出文件，出错时只记录日志；未写完的文件保留，下次空闲时重试"""
+        try:
+            self._replay_spill()
+        except Exception as e:
+            logger.error(f"写回溢出文件失败: {e}")
+
+    def _flush_safely(self, batch):
+        """写入一批消息，出错时记录日志并把整批计为失败，写入线程继续运行"""
+        try:
+            self._flush(batch)
+        except Exception as e:
+            logger.error(f"写入一批消息失败，{len(batch)} 条消息未写入: {e}")
+            self._count('failed', len(batch))
+
+    def _run(self):
+        """写入循环：按数量或时间阈值收集一批消息并提交"""
+        # 处理上次运行遗留的溢出文件
+        self._replay_spill_safely()
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                self._replay_spill_safely()
+                continue
+            if item is _STOP:
+                break
+
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush_safely(batch)
+            if stopping:
+                break
+
+        # 结束前写入剩余的消息
+        remaining_items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining_items.append(item)
+        for i in range(0, len(remaining_items), self.batch_size):
+            self._flush_safely(remaining_items[i:i + self.batch_size])
+        self._replay_spill_safely()
+        logger.info("写后队列已停止。")
+
+    def _flush(self, batch):
+        """将一批消息写入数据库并记录耗时"""
+        started = time.perf_counter()
+        written = self.db.save_messages(batch)
+        if not written:
+            # 整批失败时逐条重试，避免一条坏数据拖累整批
+            written = sum(1 for m in batch if self.db.save_message(m) is not None)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._stats_lock:
+            self._stats['written'] += written
+            self._stats['failed'] += len(batch) - written
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            self._stats['total_flush_ms'] += elapsed_ms
+        logger.debug(f"写入一批消息: {written}/{len(batch)} 条，耗时 {elapsed_ms:.1f}ms")
+
+    def stop(self, timeout=30):
+        """
+        停止写入循环，并写入队列中剩余的全部消息
+
+        Args:
+            timeout: 等待放入结束标记和等待写入线程结束的最长时间（秒）
+
+        Returns:
+            int: 停止时仍留在队列中、未写入数据库的消息数
+        """
+        if not self.running:
+            return 0
+        self.running = False
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pending = self._pending()
+            logger.error(f"写入队列在 {timeout} 秒内一直是满的，无法通知写入线程停止，{pending} 条消息未写入数据库")
+            return pending
+        if self.thread:
+            self.thread.join(timeout=timeout)
+        pending = self._pending()
+        if pending:
+            logger.error(f"写后队列停止时还有 {pending} 条消息未写入数据库")
+        return pending
+
+    def _pending(self):
+        """队列中尚未写入的消息数（不含结束标记）"""
+        with self.queue.mutex:
+            return sum(1 for item in self.queue.queue if item is not _STOP)
+
+    def stats(self):
+        """
+        获取队列运行指标
+
+        Returns:
+            dict: 队列深度、写入条数、批次数和提交耗时等指标
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self.queue.qsize()
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
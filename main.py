@@ -16,7 +16,14 @@ from core.Tgbot import Tgbot
 from core.config import Config
 from core.database import Database
 from core.formatter import MessageFormatter
-from web.app import app, socketio # 导入Flask app和socketio实例
+from core.writer import MessageWriter
+from core.broadcaster import SocketBroadcaster
+from core.console import ConsoleWriter
+from core.filters import RecentMessages
+from core.media import MediaDownloader
+from core.maintenance import MaintenanceJob
+from core.tokenizer import configure_tokenizer
+from web.app import app, socketio, register_status_provider, set_db # 导入Flask app和socketio实例
 from core.scheduler import ReportScheduler # 导入调度器
 
 # 配置日志
@@ -26,13 +33,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 全局bot实例
-bot = None
+# 全局bot实例，每个账号一个
+bots = []
 
 def signal_handler(sig, frame):
     """处理信号中断"""
     print("\n正在退出程序...")
-    if bot:
+    for bot in bots:
         bot.stop()
     # scheduler is handled by daemon thread, no need to stop explicitly
     sys.exit(0)
@@ -44,7 +51,6 @@ def run_web_app():
     socketio.run(app, host='0.0.0.0', port=5000, use_reloader=False)
 
 def main():
-    global bot
     # 注册信号处理器
     signal.signal(signal.SIGINT, signal_handler)
     
@@ -53,6 +59,16 @@ def main():
     parser.add_argument('-c', '--config', default='config.json', help='配置文件路径')
     parser.add_argument('-d', '--db', default='data.db', help='数据库文件路径')
     parser.add_argument('--no-listen', action='store_true', help='登录后不监听消息')
+    parser.add_argument('--headless', action='store_true', help='不在控制台输出消息，适合作为后台服务运行')
+    parser.add_argument('--rebuild-search-index', action='store_true', help='重建全文搜索索引后退出')
+    parser.add_argument('--rebuild-rollups', action='store_true', help='根据历史消息重建统计汇总表后退出')
+    parser.add_argument('--archive-shards', action='store_true', help='把较早月份的消息归档到按月分片的数据库文件后退出')
+    parser.add_argument('--maintenance', action='store_true', help='按保留策略清理数据并回收空间后退出')
+    parser.add_argument('--vacuum', action='store_true', help='整理数据库并启用增量空间回收后退出')
+    parser.add_argument('--compress-text', action='store_true', help='按compression设置压缩较早的消息文本后退出')
+    parser.add_argument('--backfill', action='store_true', help='登录后补录历史消息，完成后退出')
+    parser.add_argument('--backfill-chat', type=int, action='append', metavar='CHAT_ID',
+                        help='只补录指定会话，可重复使用；默认使用配置中的backfill.chat_ids')
     args = parser.parse_args()
     
     # 加载配置
@@ -62,44 +78,137 @@ def main():
     
     config = Config(config_path)
     
+    # 维护命令：无需登录，执行完毕后退出
+    maintenance_commands = (
+        args.rebuild_search_index, args.rebuild_rollups, args.archive_shards,
+        args.maintenance, args.vacuum, args.compress_text
+    )
+    if any(maintenance_commands):
+        db = Database(args.db)
+        if args.archive_shards:
+            shard_config = config.get('database', {}).get('shards', {})
+            db.archive_shards(
+                keep_months=shard_config.get('keep_months', 1),
+                freeze_after_months=shard_config.get('freeze_after_months', 3),
+                batch_size=shard_config.get('batch_size', 5000)
+            )
+        if args.rebuild_search_index:
+            db.rebuild_search_index()
+        if args.rebuild_rollups:
+            db.rebuild_rollups()
+        if args.compress_text:
+            compression_config = config.get('compression', {})
+            db.compress_cold_text(
+                min_age_days=compression_config.get('min_age_days', 30),
+                codec=compression_config.get('codec', 'zlib'),
+                level=compression_config.get('level', 6),
+                sample_size=compression_config.get('sample_size', 5000),
+                dictionary_size=compression_config.get('dictionary_size', 32768)
+            )
+        if args.maintenance:
+            MaintenanceJob.from_config(config, db).run()
+        if args.vacuum:
+            db.enable_incremental_vacuum()
+        db.close()
+        return
+    
     # 检查必要的配置
-    api_id = config.get('api_id')
-    api_hash = config.get('api_hash')
+    accounts = config.accounts()
+    for account in accounts:
+        if not account.get('api_id') or not account.get('api_hash'):
+            logger.error(f"配置文件中缺少必要的API凭据 (账号: {account.get('session_name', 'autotg_session')})")
+            logger.info("请在配置文件中设置api_id和api_hash")
+            return
     
-    if not api_id or not api_hash:
-        logger.error("配置文件中缺少必要的API凭据")
-        logger.info("请在配置文件中设置api_id和api_hash")
-        return
+    # 初始化数据库，并与Web服务共享
+    db_config = config.get('database', {})
+    db = Database(args.db, read_pool_size=db_config.get('read_pool_size', 4))
+    set_db(db)
+    register_status_provider('compression', db.get_compression_stats)
+    
+    # 创建写后队列
+    writer = MessageWriter.from_config(config, db)
+    if writer:
+        writer.start()
+        register_status_provider('writer', writer.stats)
+    
+    MessageFormatter.configure_cache(config)
+    register_status_provider('entity_cache', MessageFormatter.entity_cache.stats)
+    
+    # 共享的分词器，词频索引和报告共用；启动时预先加载词典，避免第一次分词时等待
+    tokenizer = configure_tokenizer(config)
+    tokenizer_config = config.get('tokenizer', {})
+    if config.get('daily_report', {}).get('enabled', False) and tokenizer_config.get('preload', True):
+        tokenizer.start(background=tokenizer_config.get('background', True))
+    register_status_provider('tokenizer', tokenizer.stats)
     
-    # 初始化数据库
-    db = Database(args.db)
+    # 控制台输出在后台线程中进行，输出跟不上时丢弃，不阻塞消息接收
+    console = ConsoleWriter.from_config(config, MessageFormatter, headless=args.headless)
+    console.start()
+    register_status_provider('console', console.stats)
     
-    # 创建Tgbot实例
-    bot = Tgbot(config)
+    # 创建实时推送器，新消息按会话房间合并后批量推送
+    broadcaster = SocketBroadcaster.from_config(config, socketio)
+    register_status_provider('realtime', broadcaster.stats)
     
-    # 设置依赖
-    bot.set_database(db)
-    bot.set_message_formatter(MessageFormatter)
-    bot.set_socketio(socketio) # 将socketio实例传递给bot
+    # 媒体下载（可选）
+    media = MediaDownloader.from_config(config, db)
+    if media:
+        register_status_provider('media', media.stats)
+    
+    # 多个账号收到的同一条消息只处理一次
+    recent_messages = RecentMessages() if len(accounts) > 1 else None
+    if recent_messages:
+        register_status_provider('account_dedup', recent_messages.stats)
+    
+    # 为每个账号创建Tgbot实例，共享数据库、写入队列、控制台输出和推送器
+    for index, account in enumerate(accounts):
+        bot = Tgbot(account, is_primary=(index == 0))
+        bot.set_database(db)
+        bot.set_writer(writer)
+        bot.set_message_formatter(MessageFormatter)
+        bot.set_console(console)
+        bot.set_socketio(socketio) # 将socketio实例传递给bot
+        bot.set_broadcaster(broadcaster)
+        bot.set_recent_messages(recent_messages)
+        bot.set_media(media)
+        provider_name = 'filters' if len(accounts) == 1 else f'filters:{bot.session_name}'
+        register_status_provider(provider_name, bot.ingest_filter.stats)
+        bots.append(bot)
     
     # 初始化并启动报告调度器
     scheduler = ReportScheduler(config, db)
     scheduler.start()
+    if scheduler.maintenance:
+        register_status_provider('maintenance', scheduler.maintenance.stats)
+    if scheduler.indexer:
+        register_status_provider('term_index', scheduler.indexer.stats)
+    if scheduler.mailer:
+        register_status_provider('report_mail', scheduler.mailer.stats)
 
-    # 登录
-    if bot.login():
+    # 依次登录各个账号
+    if all(bot.login() for bot in bots):
         logger.info("登录成功！")
         
+        if args.backfill:
+            for bot in bots:
+                bot.backfill(args.backfill_chat)
+            if writer:
+                writer.stop()
+            db.close()
+            return
+        
         # 在新线程中启动Web服务器
         web_thread = Thread(target=run_web_app)
         web_thread.daemon = True
         web_thread.start()
+        broadcaster.start()
 
         # 主线程中开始监听消息
         if not args.no_listen:
             logger.info("开始监听消息和存储数据...")
             logger.info("按 Ctrl+C 停止运行")
-            bot.start()
+            Tgbot.start_all(bots)
         else:
             logger.info("消息监听已禁用。Web服务和调度器正在运行，请按 Ctrl+C 退出。")
             # 如果不监听，则等待web线程结束
@@ -111,6 +220,12 @@ def main():
     else:
         logger.error("登录失败！")
     
+    broadcaster.stop()
+    
+    # 写入队列中剩余的消息
+    if writer:
+        writer.stop()
+    
     # 关闭数据库连接
     db.close()
 
@@ -0,0 +1,68 @@
+import logging
+import sys
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+# 将项目根目录添加到Python路径中
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from core.database import Database
+
+# 配置日志
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def test_dictionary_trained_by_another_instance():
+    """
+    两个Database实例打开同一个文件（相当于运行中的服务和单独运行的 --compress-text），
+    第二个实例训练字典并压缩文本后，第一个实例仍能读取、搜索和编辑这些消息。
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(workdir, 'data.db')
+        service = Database(db_file)
+        old = datetime.now(timezone.utc) - timedelta(days=60)
+        service.save_messages([{
+            'message_id': i, 'chat_id': 1, 'sender_id': 2, 'chat_title': 'chat',
+            'text': f'这是第{i}条测试消息 https://example.com/page/{i % 7}',
+            'date': (old + timedelta(minutes=i)).isoformat()
+        } for i in range(1, 201)])
+
+        worker = Database(db_file)
+        result = worker.compress_cold_text(min_age_days=30, codec='zlib', batch_size=50)
+        assert result and result['rows'] > 0, result
+        worker.close()
+        assert not service.codec.dictionaries
+
+        messages = service.get_messages(chat_id=1, limit=10)
+        assert len(messages) == 10
+        assert messages[-1]['text'] == '这是第200条测试消息 https://example.com/page/4'
+        assert service.codec.dictionaries
+
+        results = service.search_messages('第150条测试消息')['results']
+        assert [r['message_id'] for r in results] == [150]
+
+        # 编辑已压缩的消息：旧版本解压后写入编辑历史
+        edited = dict(messages[-1], is_edited=True, text='已编辑')
+        service.save_messages([edited])
+        edits = service.get_message_edits(1, 200)
+        assert edits and edits[0]['text'] == '这是第200条测试消息 https://example.com/page/4'
+        service.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    """
+    一个用于检查压缩字典在多个进程间共享的测试脚本。
+    """
+    logger.info("--- 开始执行压缩字典测试 ---")
+    test_dictionary_trained_by_another_instance()
+    logger.info("--- 压缩字典测试执行完毕 ---")
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 from core.config import Config
 from core.database import Database
 from core.reporter import run_daily_report
+from core.tokenizer import configure_tokenizer
 
 # 配置日志
 logging.basicConfig(
@@ -30,6 +31,8 @@ def main():
         
     # 初始化数据库
     db = Database('data.db')
+    # 按配置加载分词器（自定义词典和停用词）
+    configure_tokenizer(config).start(background=False)
     
     # 直接调用报告生成和发送的核心函数
     try:
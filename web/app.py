@@ -1,14 +1,17 @@
 import sys
 import os
+import time
 import logging
+from datetime import datetime, timezone
 from flask import Flask, jsonify, request, render_template
-from flask_socketio import SocketIO
-from threading import Thread
+from flask_socketio import SocketIO, join_room, leave_room
+from threading import Thread, Lock
 
 # 将项目根目录添加到Python路径中，以便能够导入core模块
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from core.database import Database
+from core.broadcaster import room_for_chat
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,14 +22,34 @@ socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*")
 
 # 全局数据库实例
 db = None
+_db_lock = Lock()
+
+# 运行状态提供者：名称 -> 返回指标字典的函数
+status_providers = {}
+
+def register_status_provider(name, provider):
+    """
+    注册一个运行状态提供者，其指标会出现在 /api/status 中
+    
+    Args:
+        name: 指标分组名称
+        provider: 无参函数，返回指标字典
+    """
+    status_providers[name] = provider
+
+def set_db(database):
+    """设置共享的数据库实例，使Web服务与采集程序共用同一个写连接和读连接池"""
+    global db
+    db = database
 
 def get_db():
     """获取数据库连接"""
     global db
-    if db is None:
-        # 假设数据库文件在项目根目录
-        db_path = os.path.join(os.path.dirname(app.root_path), 'data.db')
-        db = Database(db_file=db_path)
+    with _db_lock:
+        if db is None:
+            # 假设数据库文件在项目根目录
+            db_path = os.path.join(os.path.dirname(app.root_path), 'data.db')
+            db = Database(db_file=db_path)
     return db
 
 @app.route('/')
@@ -34,14 +57,46 @@ def index():
     """渲染主页面"""
     return render_template('index.html')
 
+@app.route('/api/status', methods=['GET'])
+def get_status():
+    """获取后台组件的运行指标"""
+    status = {}
+    for name, provider in status_providers.items():
+        try:
+            status[name] = provider()
+        except Exception as e:
+            logging.error(f"获取运行指标失败 ({name}): {e}")
+            status[name] = {"error": str(e)}
+    return jsonify(status)
+
+@app.route('/api/sync/status', methods=['GET'])
+def get_sync_status():
+    """获取各会话的高水位、最近一次缺口大小和补回条数"""
+    try:
+        database = get_db()
+        return jsonify(database.get_sync_status())
+    except Exception as e:
+        logging.error(f"获取同步状态失败: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
     """获取所有会话列表（群组/用户）"""
     try:
         database = get_db()
-        # 通过查询数据库中所有不同的chat_id和chat_title来获取会话
-        database.cursor.execute("SELECT DISTINCT chat_id, chat_title FROM messages ORDER BY chat_title")
-        sessions = [{'id': row['chat_id'], 'title': row['chat_title']} for row in database.cursor.fetchall()]
+        # 私聊的chat_id是对方的用户ID，不同账号与同一用户的私聊按去重范围区分为不同的会话；
+        # 标题取自会话表中该chat_id的当前标题
+        rows = database.fetch_all('''
+            SELECT s.dedup_scope, s.chat_id, c.title
+            FROM chat_sync_state s LEFT JOIN chats c ON c.chat_id = s.chat_id
+            ORDER BY c.title, s.chat_id, s.dedup_scope
+        ''')
+        sessions = [{
+            'key': f"{row['dedup_scope']}:{row['chat_id']}",
+            'id': row['chat_id'],
+            'scope': row['dedup_scope'],
+            'title': row['title']
+        } for row in rows]
         return jsonify(sessions)
     except Exception as e:
         logging.error(f"获取会话列表失败: {e}")
@@ -49,51 +104,106 @@ def get_sessions():
 
 @app.route('/api/messages/<int:session_id>', methods=['GET'])
 def get_messages(session_id):
-    """根据会话ID获取消息"""
+    """根据会话ID和去重范围（scope）获取消息，使用 before_ts/before_id 游标向前翻页（兼容旧的 before_date）"""
     try:
         database = get_db()
+        dedup_scope = request.args.get('scope', 0, type=int)
         offset = request.args.get('offset', 0, type=int)
         limit = request.args.get('limit', 50, type=int)
+        before_date = request.args.get('before_date')
+        before_ts = request.args.get('before_ts', type=int)
+        before_id = request.args.get('before_id', type=int)
         
-        messages = database.get_messages(chat_id=session_id, limit=limit, offset=offset)
-        return jsonify(messages)
+        messages = database.get_messages(
+            chat_id=session_id, limit=limit, offset=offset,
+            before_date=before_date, before_id=before_id, before_ts=before_ts, dedup_scope=dedup_scope
+        )
+        # 返回的消息按时间正序排列，第一条即为下一页的游标位置；
+        # 游标使用有索引的date_ts，时间缺失的旧消息记为-1
+        next_cursor = None
+        if len(messages) >= limit and messages:
+            first = messages[0]
+            next_cursor = {
+                'before_ts': first['date_ts'] if first.get('date_ts') is not None else -1,
+                'before_id': first['id']
+            }
+        return jsonify({'messages': messages, 'next_cursor': next_cursor})
     except Exception as e:
         logging.error(f"获取消息失败: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/messages/<int:session_id>/<int:message_id>/edits', methods=['GET'])
+def get_message_edits(session_id, message_id):
+    """获取一条消息的编辑历史"""
+    try:
+        database = get_db()
+        dedup_scope = request.args.get('scope', 0, type=int)
+        return jsonify(database.get_message_edits(session_id, message_id, dedup_scope))
+    except Exception as e:
+        logging.error(f"获取消息编辑历史失败: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/search', methods=['GET'])
 def search_messages():
-    """全局搜索消息"""
+    """全局搜索消息，支持按会话、发送者、时间范围和媒体类型过滤，并按游标分页"""
     query = request.args.get('q', '')
-    if not query:
+    if not query.strip():
         return jsonify({"error": "Query parameter 'q' is required"}), 400
     
     try:
         database = get_db()
-        database.cursor.execute(
-            "SELECT * FROM messages WHERE text LIKE ? ORDER BY date DESC LIMIT 100",
-            (f'%{query}%',)
+        result = database.search_messages(
+            query,
+            chat_id=request.args.get('chat_id', type=int),
+            sender_id=request.args.get('sender_id', type=int),
+            date_from=request.args.get('date_from'),
+            date_to=request.args.get('date_to'),
+            media_type=request.args.get('media_type'),
+            limit=min(request.args.get('limit', 50, type=int), 200),
+            cursor=request.args.get('cursor'),
+            sort=request.args.get('sort', 'rank'),
+            dedup_scope=request.args.get('scope', type=int)
         )
-        results = [dict(row) for row in database.cursor.fetchall()]
-        return jsonify(results)
+        return jsonify(result)
     except Exception as e:
         logging.error(f"搜索消息失败: {e}")
         return jsonify({"error": str(e)}), 500
 
+# 统计图表使用北京时间 (UTC+8) 分桶
+DISPLAY_UTC_OFFSET = 8 * 3600
+WEEKDAY_NAMES = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+
+def local_day_start(days_ago=0):
+    """
+    获取北京时间某天零点对应的纪元秒
+    
+    Args:
+        days_ago: 距今天的天数，0表示今天
+        
+    Returns:
+        int: 纪元秒
+    """
+    local_now = int(time.time()) + DISPLAY_UTC_OFFSET
+    return (local_now // 86400 - days_ago) * 86400 - DISPLAY_UTC_OFFSET
+
+def local_date_str(day_index):
+    """将北京时间的天序号（纪元天数）转换为 YYYY-MM-DD 字符串"""
+    return datetime.fromtimestamp(day_index * 86400, timezone.utc).strftime('%Y-%m-%d')
+
 @app.route('/api/stats/daily_frequency', methods=['GET'])
 def daily_frequency():
     """获取过去7天的每日消息频率"""
     try:
         database = get_db()
-        # 使用北京时间 (UTC+8)，并以 created_at 为基准
-        database.cursor.execute("""
-            SELECT date(created_at, '+8 hours') as day, COUNT(*) as count
-            FROM messages
-            WHERE date(created_at, '+8 hours') >= date('now', '-7 days', '+8 hours')
-            GROUP BY day
-            ORDER BY day
-        """)
-        stats = [{'day': row['day'], 'count': row['count']} for row in database.cursor.fetchall()]
+        # 读取按小时汇总的统计表，时区只用于分桶
+        rows = database.fetch_all("""
+            SELECT (hour_ts + ?) / 86400 as day_index, SUM(count) as count
+            FROM stats_hourly_media
+            WHERE hour_ts >= ?
+            GROUP BY day_index
+            ORDER BY day_index
+        """, (DISPLAY_UTC_OFFSET, local_day_start(7)))
+        stats = [{'day': local_date_str(row['day_index']), 'count': row['count']} for row in rows]
         return jsonify(stats)
     except Exception as e:
         logging.error(f"获取每日消息频率失败: {e}")
@@ -104,18 +214,22 @@ def user_ranking():
     """获取过去7天用户发言排行"""
     try:
         database = get_db()
-        # 使用北京时间 (UTC+8)，并以 created_at 为基准
-        database.cursor.execute("""
-            SELECT sender_id, sender_username, sender_first_name, COUNT(*) as count
-            FROM messages
-            WHERE date(created_at, '+8 hours') >= date('now', '-7 days', '+8 hours') AND sender_id IS NOT NULL
-            GROUP BY sender_id
-            ORDER BY count DESC
-            LIMIT 10
-        """)
+        rows = database.fetch_all("""
+            SELECT r.sender_id, u.username, u.first_name, r.count
+            FROM (
+                SELECT sender_id, SUM(count) as count
+                FROM stats_hourly_sender
+                WHERE hour_ts >= ?
+                GROUP BY sender_id
+                ORDER BY count DESC
+                LIMIT 10
+            ) r
+            LEFT JOIN users u ON u.user_id = r.sender_id
+            ORDER BY r.count DESC
+        """, (local_day_start(7),))
         ranking = []
-        for row in database.cursor.fetchall():
-            name = row['sender_username'] or row['sender_first_name'] or f"ID: {row['sender_id']}"
+        for row in rows:
+            name = row['username'] or row['first_name'] or f"ID: {row['sender_id']}"
             ranking.append({'name': name, 'count': row['count']})
         return jsonify(ranking)
     except Exception as e:
@@ -127,24 +241,20 @@ def group_ranking():
     """获取过去7天群组消息量排行"""
     try:
         database = get_db()
-        # 筛选出群组/频道类型的消息 (chat_id通常是负数)
-        # 并按消息数量排序
-        # 使用北京时间 (UTC+8)，并以 created_at 为基准
+        # 筛选出群组/频道类型的会话，并按消息数量排序
         query = """
-            SELECT
-                chat_id,
-                chat_title,
-                COUNT(*) as count
-            FROM messages
+            SELECT c.chat_id, c.title, SUM(s.count) as count
+            FROM stats_hourly_chat s
+            JOIN chats c ON c.chat_id = s.chat_id
             WHERE
-                date(created_at, '+8 hours') >= date('now', '-7 days', '+8 hours')
-                AND (chat_type = 'group' OR chat_type = 'supergroup' OR chat_type = 'channel')
-            GROUP BY chat_id, chat_title
+                s.hour_ts >= ?
+                AND c.chat_type IN ('group', 'supergroup', 'channel')
+            GROUP BY c.chat_id
             ORDER BY count DESC
             LIMIT 10
         """
-        database.cursor.execute(query)
-        ranking = [{'name': row['chat_title'], 'count': row['count']} for row in database.cursor.fetchall()]
+        rows = database.fetch_all(query, (local_day_start(7),))
+        ranking = [{'name': row['title'], 'count': row['count']} for row in rows]
         return jsonify(ranking)
     except Exception as e:
         logging.error(f"获取群组消息量排行失败: {e}")
@@ -155,21 +265,20 @@ def message_type_distribution():
     """获取消息类型分布"""
     try:
         database = get_db()
-        # 将空或None的media_type视为'文本消息'
+        # 汇总表中纯文本消息的media_type为空字符串，显示为'文本消息'
         query = """
             SELECT
                 CASE
-                    WHEN media_type IS NULL THEN '文本消息'
                     WHEN media_type = '' THEN '文本消息'
                     ELSE media_type
                 END as type,
-                COUNT(*) as value
-            FROM messages
+                SUM(count) as value
+            FROM stats_hourly_media
             GROUP BY type
             ORDER BY value DESC
         """
-        database.cursor.execute(query)
-        stats = [{'name': row['type'], 'value': row['value']} for row in database.cursor.fetchall()]
+        rows = database.fetch_all(query)
+        stats = [{'name': row['type'], 'value': row['value']} for row in rows]
         return jsonify(stats)
     except Exception as e:
         logging.error(f"获取消息类型分布失败: {e}")
@@ -180,64 +289,45 @@ def activity_heatmap():
     """获取过去14天的每小时活跃度数据，用于生成热力图"""
     try:
         database = get_db()
-        # 使用北京时间 (UTC+8)，并以 created_at 为基准
-        query = """
-            WITH RECURSIVE 
-            date_series AS (
-            SELECT DATE('now', '-13 days', '+8 hours') as date_val
-            UNION ALL
-            SELECT DATE(date_val, '+1 day')
-            FROM date_series
-            WHERE date_val < DATE('now', '+8 hours')
-            ),
-            hour_series AS (
-            SELECT 0 as hour_val
-            UNION ALL
-            SELECT hour_val + 1
-            FROM hour_series
-            WHERE hour_val < 23
-            ),
-            date_hour_matrix AS (
-            SELECT 
-                d.date_val,
-                h.hour_val,
-                CASE STRFTIME('%w', d.date_val)
-                WHEN '0' THEN '周日'
-                WHEN '1' THEN '周一'
-                WHEN '2' THEN '周二'
-                WHEN '3' THEN '周三'
-                WHEN '4' THEN '周四'
-                WHEN '5' THEN '周五'
-                WHEN '6' THEN '周六'
-                END as weekday_name
-            FROM date_series d
-            CROSS JOIN hour_series h
-            )
-            SELECT 
-            dhm.date_val as date,
-            dhm.hour_val as hour,
-            dhm.weekday_name,
-            COALESCE(COUNT(m.id), 0) as message_count
-            FROM date_hour_matrix dhm
-            LEFT JOIN messages m ON 
-            DATE(m.created_at, '+8 hours') = dhm.date_val 
-            AND CAST(STRFTIME('%H', m.created_at, '+8 hours') AS INTEGER) = dhm.hour_val
-            GROUP BY dhm.date_val, dhm.hour_val, dhm.weekday_name
-            ORDER BY dhm.date_val, dhm.hour_val;
-        """
-        database.cursor.execute(query)
+        start_ts = local_day_start(13)
+        rows = database.fetch_all("""
+            SELECT (hour_ts + ?) / 3600 as hour_index, SUM(count) as message_count
+            FROM stats_hourly_media
+            WHERE hour_ts >= ?
+            GROUP BY hour_index
+        """, (DISPLAY_UTC_OFFSET, start_ts))
+        counts = {row['hour_index']: row['message_count'] for row in rows}
         
-        # 将数据处理成 [day, hour, count] 的格式
+        # 补全14天 x 24小时的矩阵，并处理成 [day, hour, count, weekday] 的格式
         # ECharts热力图需要这种格式
         heatmap_data = []
-        for row in database.cursor.fetchall():
-            heatmap_data.append([row['date'], int(row['hour']), row['message_count'], row['weekday_name']])
+        first_day = (start_ts + DISPLAY_UTC_OFFSET) // 86400
+        for day_index in range(first_day, first_day + 14):
+            day_str = local_date_str(day_index)
+            # 纪元第0天（1970-01-01）是周四
+            weekday_name = WEEKDAY_NAMES[(day_index + 3) % 7]
+            for hour in range(24):
+                heatmap_data.append([day_str, hour, counts.get(day_index * 24 + hour, 0), weekday_name])
             
         return jsonify(heatmap_data)
     except Exception as e:
         logging.error(f"获取活跃度热力图数据失败: {e}")
         return jsonify({"error": str(e)}), 500
 
+@socketio.on('subscribe')
+def on_subscribe(data):
+    """客户端订阅一个会话的实时消息"""
+    chat_id = (data or {}).get('chat_id')
+    if chat_id is not None:
+        join_room(room_for_chat(chat_id, (data or {}).get('scope', 0)))
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(data):
+    """客户端取消订阅一个会话的实时消息"""
+    chat_id = (data or {}).get('chat_id')
+    if chat_id is not None:
+        leave_room(room_for_chat(chat_id, (data or {}).get('scope', 0)))
+
 def run_web_app():
     """在eventlet服务器中运行Flask应用"""
     logging.info("启动Web服务器于 http://0.0.0.0:5000")